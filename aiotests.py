@@ -0,0 +1,89 @@
+""" Tests of stepford_aio
+
+These use ``async`` syntax and are only imported by ``tests`` on Python 3.7
+or later. The module is named so that test runners don't collect it on their
+own.
+"""
+import asyncio
+
+import stepford
+import stepford_aio
+
+
+class AsyncioTests(object):
+    """ Mixed into the test cases of ``tests`` """
+    def test_aio_create_delete(self):
+        async def _run():
+            users = await asyncio.gather(*[stepford_aio.create(
+                self.client_id, self.access_token) for _ in range(2)])
+            return users, await asyncio.gather(*[stepford_aio.delete(
+                user['id'], self.access_token) for user in users])
+
+        users, deleted = asyncio.run(_run())
+        self.assertEqual(len(set(user['id'] for user in users)), 2)
+        self.assertEqual(deleted, [True, True])
+
+        try:
+            asyncio.run(stepford_aio.delete(users[0]['id'], self.access_token))
+        except stepford.FacebookError as e:
+            self.assertEqual(e.api_code,
+                stepford.API_EC_UNABLE_TO_ACCESS_APPLICATION)
+
+    def test_aio_connect_registry(self):
+        registry = stepford.Registry()
+        previous = stepford.set_registry(registry)
+
+        async def _run():
+            users = await asyncio.gather(*[stepford_aio.create(
+                self.client_id, self.access_token) for _ in range(2)])
+            try:
+                first = await stepford_aio.connect(*users, workers=2)
+                friends = [friend['id'] async for friend in
+                    stepford_aio.iter_friends(users[0]['id'],
+                        users[0]['access_token'])]
+                # the friendship exists, so nothing is sent the second time
+                second = await stepford_aio.connect(*users, workers=2)
+                stored = registry.get(users[0]['id'])
+            finally:
+                await asyncio.gather(*[stepford_aio.delete(user['id'],
+                    self.access_token) for user in users])
+            return users, first, friends, second, stored
+
+        try:
+            users, first, friends, second, stored = asyncio.run(_run())
+            self.assertEqual(registry.get(users[0]['id']), None)
+        finally:
+            stepford.set_registry(previous)
+            registry.close()
+
+        edge = (users[0]['id'], users[1]['id'])
+        self.assertEqual((first, second), ({edge: True}, {edge: True}))
+        self.assertEqual(friends, [users[1]['id']])
+        self.assertEqual(stored['apps'], [self.client_id])
+
+    def test_aio_connect_errors(self):
+        urlopen = stepford_aio.urlopen
+
+        async def _run():
+            users = await asyncio.gather(*[stepford_aio.create(
+                self.client_id, self.access_token) for _ in range(3)])
+
+            async def _urlopen(url, data=None):
+                if '/friends/{}'.format(users[2]['id']) in url:
+                    raise ConnectionError('reset')
+                return await urlopen(url, data)
+
+            stepford_aio.urlopen = _urlopen
+            try:
+                return users, await stepford_aio.connect(*users, workers=3)
+            finally:
+                stepford_aio.urlopen = urlopen
+                await asyncio.gather(*[stepford_aio.delete(user['id'],
+                    self.access_token) for user in users])
+
+        # a failed edge doesn't abort the others
+        users, report = asyncio.run(_run())
+        self.assertEqual(report[(users[0]['id'], users[1]['id'])], True)
+        for edge in ((users[0]['id'], users[2]['id']),
+            (users[1]['id'], users[2]['id'])):
+            self.assertTrue(isinstance(report[edge], ConnectionError))
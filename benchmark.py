@@ -0,0 +1,231 @@
+""" Benchmarks stepford against a simulated Graph API
+
+Drives ``create``, ``get``, ``connect``, ``install``, ``uninstall`` and
+``delete`` at a configurable volume against :class:`stepford_fake.FakeGraphAPI`
+with a tunable round trip time, reporting per-operation latency percentiles
+and throughput along with peak memory use. ``connect`` is measured both one
+pair at a time and fanned out over groups of users
+(``connect(*group, workers=N)``, reported as ``connect_fanout``):
+
+    $ python benchmark.py --users 200 --density 0.1 --group-size 10 \\
+        --concurrency 16 --rtt 0.02 --output results.json
+"""
+
+import argparse
+import itertools
+import json
+import platform
+import random
+import sys
+import time
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None # pylint: disable=C0103
+try:
+    import resource
+except ImportError:
+    resource = None # pylint: disable=C0103
+
+import stepford
+from stepford_fake import FakeGraphAPI
+
+CLIENT_ID = '1000'
+CLIENT_SECRET = 'secret'
+CLIENT_B_ID = '2000'
+CLIENT_B_SECRET = 'secret_b'
+
+OPERATIONS = ('create', 'get', 'connect', 'connect_fanout', 'install',
+    'uninstall', 'delete')
+
+
+def percentile(values, pct):
+    """ Gets the nearest-rank percentile of a sorted list """
+    if not values:
+        return None
+    rank = max(0, int(round(pct / 100.0 * len(values) + 0.5)) - 1)
+    return values[min(rank, len(values) - 1)]
+
+
+def measure(func, items, concurrency):
+    """ Applies ``func`` to ``items`` concurrently, timing each call
+
+    :return: A ``(results, stats)`` tuple, where ``results`` holds the
+             successful results
+    """
+    def _timed(item): # pylint: disable=C0111
+        start = time.time()
+        try:
+            return func(item), None, time.time() - start
+        except Exception as err: # pylint: disable=W0703
+            return None, err, time.time() - start
+
+    results, latencies, errors = [], [], 0
+    start = time.time()
+    for _, (res, err, latency), _ in stepford._imap( # pylint: disable=W0212
+        _timed, items, concurrency):
+        latencies.append(latency)
+        if err is None:
+            results.append(res)
+        else:
+            errors += 1
+    wall = time.time() - start
+
+    latencies.sort()
+    return results, {
+        'count': len(latencies),
+        'errors': errors,
+        'wall': wall,
+        'ops_per_sec': len(latencies) / wall if wall else None,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+    }
+
+
+def peak_memory():
+    """ Gets the peak memory use in bytes """
+    if tracemalloc is not None and tracemalloc.is_tracing():
+        return tracemalloc.get_traced_memory()[1]
+    if resource is not None:
+        # kilobytes on Linux, bytes on OS X
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+    return None
+
+
+def run(args):
+    """ Runs the benchmark
+
+    :return: The results, as a JSON-serializable ``dict``
+    """
+    rng = random.Random(args.seed)
+    results = {}
+
+    with FakeGraphAPI(latency=args.rtt) as fake:
+        fake.add_app(CLIENT_ID, CLIENT_SECRET)
+        fake.add_app(CLIENT_B_ID, CLIENT_B_SECRET)
+        stepford.set_session(stepford.Session(pool_size=args.concurrency))
+        token = stepford.app_token(CLIENT_ID, CLIENT_SECRET)
+        b_token = stepford.app_token(CLIENT_B_ID, CLIENT_B_SECRET)
+
+        users, results['create'] = measure(
+            lambda _: stepford.create(CLIENT_ID, token),
+            range(args.users), args.concurrency)
+
+        _, results['get'] = measure(
+            lambda _: stepford.get(CLIENT_ID, token),
+            range(args.listings), args.concurrency)
+
+        pairs = [pair for pair in itertools.combinations(users, 2)
+            if rng.random() < args.density]
+        _, results['connect'] = measure(
+            lambda pair: stepford.connect(*pair),
+            pairs, args.concurrency)
+
+        def _fanout(group): # pylint: disable=C0111
+            report = stepford.connect(*group, workers=args.concurrency)
+            for res in report.values():
+                if res is not True:
+                    raise res
+            return report
+
+        # groups are connected one at a time, each fanning out over
+        # concurrency workers
+        groups = [users[idx:idx + args.group_size]
+            for idx in range(0, len(users), args.group_size)]
+        groups = [group for group in groups if len(group) > 1]
+        _, results['connect_fanout'] = measure(_fanout, groups, 1)
+
+        _, results['install'] = measure(
+            lambda user: stepford.install(user['id'], b_token, CLIENT_ID,
+                token), users, args.concurrency)
+
+        _, results['uninstall'] = measure(
+            lambda user: stepford.uninstall(user['id'], CLIENT_B_ID, b_token),
+            users, args.concurrency)
+
+        _, results['delete'] = measure(
+            lambda user: stepford.delete(user['id'], token),
+            users, args.concurrency)
+
+        requests = fake.requests
+
+    return {
+        'config': {
+            'users': args.users,
+            'listings': args.listings,
+            'density': args.density,
+            'edges': len(pairs),
+            'group_size': args.group_size,
+            'concurrency': args.concurrency,
+            'rtt': args.rtt,
+            'seed': args.seed,
+        },
+        'platform': {
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+        },
+        'requests': requests,
+        'retries': stepford.get_session().retry.retries,
+        'peak_memory': peak_memory(),
+        'results': results,
+    }
+
+
+def report(results, out):
+    """ Writes a human readable summary of ``results`` to ``out`` """
+    def _ms(value): # pylint: disable=C0111
+        return '-' if value is None else '{:.1f}'.format(value * 1000)
+
+    out.write('{:<14} {:>7} {:>7} {:>10} {:>9} {:>9} {:>9}\n'.format(
+        'operation', 'count', 'errors', 'ops/s', 'p50 ms', 'p95 ms',
+        'p99 ms'))
+    for name in OPERATIONS:
+        stats = results['results'][name]
+        out.write('{:<14} {:>7} {:>7} {:>10.1f} {:>9} {:>9} {:>9}\n'.format(
+            name, stats['count'], stats['errors'], stats['ops_per_sec'] or 0,
+            _ms(stats['p50']), _ms(stats['p95']), _ms(stats['p99'])))
+
+    out.write('{} requests, {} retries, peak memory {:.1f} MiB\n'.format(
+        results['requests'], results['retries'],
+        (results['peak_memory'] or 0) / 1024.0 / 1024.0))
+
+
+def main(argv=None):
+    """ The benchmark's entry point """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=100,
+        help='the number of users to create')
+    parser.add_argument('--listings', type=int, default=10,
+        help='the number of full user listings to fetch')
+    parser.add_argument('--density', type=float, default=0.1,
+        help='the fraction of user pairs to connect')
+    parser.add_argument('--group-size', type=int, default=10,
+        help='the number of users in each group connected by fan-out')
+    parser.add_argument('--concurrency', type=int,
+        default=stepford.DEFAULT_WORKERS,
+        help='the number of concurrent requests')
+    parser.add_argument('--rtt', type=float, default=0.01,
+        help='the simulated round trip time in seconds')
+    parser.add_argument('--seed', type=int, default=0,
+        help='seeds the choice of user pairs to connect')
+    parser.add_argument('--trace-memory', action='store_true',
+        help='measure peak memory with tracemalloc (slower)')
+    parser.add_argument('--output', metavar='PATH',
+        help='write machine-readable results to PATH as JSON')
+    args = parser.parse_args(argv)
+
+    if args.trace_memory and tracemalloc is not None:
+        tracemalloc.start()
+
+    results = run(args)
+    report(results, sys.stdout)
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump(results, out, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,101 @@
+""" Tests of the pytest plugin, run with ``python -m pytest plugintests.py``
+
+The module requires pytest and is named so that nose doesn't collect it.
+"""
+import json
+
+import pytest
+
+import stepford
+from stepford_fake import FakeGraphAPI
+
+pytest_plugins = ['pytester'] # pylint: disable=C0103
+
+CLIENT_ID = '1000'
+CLIENT_SECRET = 'secret'
+
+SUITE = """
+import stepford
+
+def test_user(stepford_user):
+    assert stepford_user['access_token']
+
+def test_friends(stepford_user, stepford_friends):
+    userids = sorted(user['id'] for user in stepford_friends)
+    assert stepford_user['id'] not in userids
+    for user in stepford_friends:
+        friends = [friend['id'] for friend in stepford.iter_friends(
+            user['id'], user['access_token'])]
+        assert sorted(friends + [user['id']]) == userids
+"""
+
+
+@pytest.fixture(name='fake')
+def fake_fixture():
+    """ A FakeGraphAPI with an app, and a token cache of its own """
+    cache = stepford.set_token_cache(stepford.TokenCache())
+    try:
+        with FakeGraphAPI() as api:
+            api.add_app(CLIENT_ID, CLIENT_SECRET)
+            yield api
+    finally:
+        stepford.set_token_cache(cache)
+
+
+def _run(pytester, monkeypatch, basetemp, *args):
+    """ Runs the suite in-process, so that it talks to the fake """
+    monkeypatch.setenv('PYTEST_DISABLE_PLUGIN_AUTOLOAD', '1')
+    monkeypatch.delenv('STEPFORD_APP', raising=False)
+    return pytester.runpytest('-p', 'pytest_stepford',
+        '--basetemp={}'.format(basetemp), *args)
+
+
+def _pool(path):
+    """ Reads the state of a SharedUserPool """
+    with open(str(path)) as state:
+        return json.load(state)
+
+
+def test_fixtures_lease_and_release(pytester, monkeypatch, fake):
+    pytester.makepyfile(SUITE)
+    monkeypatch.delenv('PYTEST_XDIST_WORKER', raising=False)
+    result = _run(pytester, monkeypatch, pytester.path / 'run',
+        '--stepford-app', '{}:{}'.format(CLIENT_ID, CLIENT_SECRET),
+        '--stepford-pool-size', '2')
+    users = fake.users(CLIENT_ID)
+
+    result.assert_outcomes(passed=2)
+    # a user and a group of 3 friends, all released
+    pool = _pool(pytester.path / 'run' / 'stepford-{}.json'.format(CLIENT_ID))
+    assert pool['leased'] == {}
+    assert sorted(user['id'] for _, user in pool['warm']) == sorted(
+        user['id'] for user in users)
+    assert len(users) == 4
+    # the group's friendships don't outlive the session
+    for user in users:
+        assert list(stepford.iter_friends(user['id'],
+            user['access_token'])) == []
+
+
+def test_xdist_workers_share_pool(pytester, monkeypatch, fake):
+    pytester.makepyfile(SUITE)
+    # as created by xdist before starting workers
+    (pytester.path / 'run').mkdir()
+    for worker in ('gw0', 'gw1'):
+        # workers get a directory of their own within the run's
+        monkeypatch.setenv('PYTEST_XDIST_WORKER', worker)
+        result = _run(pytester, monkeypatch, pytester.path / 'run' / worker,
+            '--stepford-app', '{}:{}'.format(CLIENT_ID, CLIENT_SECRET))
+        result.assert_outcomes(passed=2)
+    users = fake.users(CLIENT_ID)
+
+    pool = _pool(pytester.path / 'run' / 'stepford-{}.json'.format(CLIENT_ID))
+    assert pool['leased'] == {}
+    # the second worker leased the users created by the first one
+    assert len(pool['warm']) == len(users) == stepford.DEFAULT_USER_POOL_SIZE
+
+
+def test_skipped_without_app(pytester, monkeypatch):
+    pytester.makepyfile(SUITE)
+    result = _run(pytester, monkeypatch, pytester.path / 'run')
+    result.assert_outcomes(skipped=2)
@@ -0,0 +1,114 @@
+""" pytest fixtures for Facebook test users
+
+The plugin is registered through the ``pytest11`` entry point when stepford
+is installed. Fixtures are configured with the ``--stepford-app`` option, the
+``STEPFORD_APP`` environment variable or the ``stepford_app`` ini setting
+(all in the ``client_id:client_secret`` format); tests using them are skipped
+when no app is configured.
+
+Users are leased from a :class:`stepford.SharedUserPool` kept in pytest's
+temporary directory. When running under ``pytest-xdist``, all workers share
+the directory of the test run and so lease from a single warm pool.
+"""
+
+import os
+
+import pytest
+
+import stepford
+
+
+def pytest_addoption(parser):
+    """ Registers the plugin's command line options and ini settings """
+    group = parser.getgroup('stepford', 'Facebook test users')
+    group.addoption('--stepford-app', metavar='CLIENT_ID:CLIENT_SECRET',
+        help='the app owning the test users')
+    group.addoption('--stepford-pool-size', type=int, metavar='N',
+        help='the number of warm test users to create up front')
+    parser.addini('stepford_app', 'the app owning the test users, as '
+        'client_id:client_secret')
+    parser.addini('stepford_pool_size', 'the number of warm test users to '
+        'create up front', default=str(stepford.DEFAULT_USER_POOL_SIZE))
+    parser.addini('stepford_friends', 'the number of users in the '
+        'stepford_friends group', default='3')
+
+
+def _setting(config, name, env=None):
+    """ Gets a setting from the command line, environment or ini file """
+    value = config.getoption(name)
+    if value is None and env is not None:
+        value = os.environ.get(env)
+    if value is None:
+        value = config.getini(name) or None
+    return value
+
+
+@pytest.fixture(scope='session')
+def stepford_app(pytestconfig):
+    """ The ``(client_id, client_secret)`` of the app owning the test users
+    """
+    app = _setting(pytestconfig, 'stepford_app', 'STEPFORD_APP')
+    if not app:
+        pytest.skip('no stepford app configured (see --stepford-app)')
+
+    client_id, sep, client_secret = app.partition(':')
+    if not sep:
+        raise pytest.UsageError(
+            'expected client_id:client_secret, got {!r}'.format(app))
+    return client_id, client_secret
+
+
+@pytest.fixture(scope='session')
+def stepford_app_token(stepford_app): # pylint: disable=W0621
+    """ The app token of the app owning the test users """
+    return stepford.app_token(*stepford_app)
+
+
+@pytest.fixture(scope='session')
+def stepford_pool(pytestconfig, tmp_path_factory, stepford_app, # pylint: disable=W0621
+    stepford_app_token):
+    """ The :class:`stepford.SharedUserPool` test users are leased from """
+    root = tmp_path_factory.getbasetemp()
+    if os.environ.get('PYTEST_XDIST_WORKER'):
+        # workers get their own directory within the test run's
+        root = root.parent
+
+    size = _setting(pytestconfig, 'stepford_pool_size')
+    return stepford.SharedUserPool(
+        str(root / 'stepford-{}.json'.format(stepford_app[0])),
+        stepford_app[0], stepford_app_token, size=int(size))
+
+
+@pytest.fixture(scope='session')
+def stepford_user(stepford_pool): # pylint: disable=W0621
+    """ A test user leased for the session """
+    user = stepford_pool.lease()
+    yield user
+    stepford_pool.release(user)
+
+
+@pytest.fixture(scope='session')
+def stepford_friends(pytestconfig, stepford_pool): # pylint: disable=W0621
+    """ A group of test users leased for the session, all friends with each
+    other. The friendships are removed before the users are released.
+    """
+    users = [stepford_pool.lease()
+        for _ in range(int(pytestconfig.getini('stepford_friends')))]
+    by_id = dict((user['id'], user) for user in users)
+    report = {}
+    try:
+        report = stepford.connect(*users, workers=len(users))
+        for res in report.values():
+            if res is not True:
+                raise res
+        yield users
+    finally:
+        # if this fails, the users stay leased rather than being handed out
+        # with friends
+        stepford._check(stepford._imap(
+            lambda edge: stepford._call(*stepford._unfriend_op(
+                by_id[edge[0]], by_id[edge[1]])),
+            [edge for edge, res in report.items() if res is True],
+            len(users)))
+        for user in users:
+            stepford_pool.release(user)
@@ -27,6 +27,12 @@ setup(name='stepford',
         'Topic :: Utilities',
     ],
     long_description=README,
+    py_modules=['stepford', 'stepford_aio', 'stepford_fake',
+        'pytest_stepford'],
     install_requires=requires,
+    entry_points={
+        'console_scripts': ['stepford = stepford:main'],
+        'pytest11': ['stepford = pytest_stepford'],
+    },
     test_suite='tests.TestStepford',
 )
@@ -1,19 +1,58 @@
 """ Implementation of the Facebook test user API
 """
 
+import argparse
+import bisect
+import hashlib
+import itertools
+import logging
+import multiprocessing
+import os
+import random
+import re
+import socket
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from codecs import getincrementaldecoder
 from functools import wraps
+from io import BytesIO
 try:
-    from urllib2 import urlopen, HTTPError
+    from urllib2 import HTTPError
     from urllib import urlencode
-    from urlparse import parse_qsl
+    from urlparse import parse_qsl, urlsplit, urlunsplit
+    from httplib import HTTPConnection, HTTPSConnection, HTTPException
 except ImportError:
-    from urllib.request import urlopen
-    from urllib.parse import urlencode, parse_qsl
+    from urllib.parse import urlencode, parse_qsl, urlsplit, urlunsplit
     from urllib.error import HTTPError
+    from http.client import HTTPConnection, HTTPSConnection, HTTPException
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
 try:
     import simplejson as json
 except ImportError:
     import json
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # pylint: disable=C0103
+try:
+    import yaml
+except ImportError:
+    yaml = None # pylint: disable=C0103
+try:
+    _STRING_TYPES = basestring
+except NameError:
+    _STRING_TYPES = str
 
 _URIROOT = 'https://graph.facebook.com'
 
@@ -25,6 +64,50 @@ API_EC_TEST_ACCOUNTS_TOO_MANY = 2900
 
 # other errors encountered
 API_EC_UNABLE_TO_ACCESS_APPLICATION = 200
+API_EC_INVALID_OAUTH_TOKEN = 190
+API_EC_SESSION_KEY_INVALID = 102
+
+# transient errors, as documented @
+# https://developers.facebook.com/docs/graph-api/using-graph-api/error-handling
+API_EC_UNKNOWN = 1
+API_EC_SERVICE = 2
+API_EC_TOO_MANY_CALLS = 4
+API_EC_USER_TOO_MANY_CALLS = 17
+API_EC_RATE_LIMIT_EXCEEDED = 613
+
+# errors retried by default
+RETRY_API_CODES = frozenset([
+    API_EC_UNKNOWN,
+    API_EC_SERVICE,
+    API_EC_TOO_MANY_CALLS,
+    API_EC_USER_TOO_MANY_CALLS,
+    API_EC_RATE_LIMIT_EXCEEDED,
+])
+RETRY_STATUSES = frozenset([500, 502, 503, 504])
+
+# errors signalling that the access token used is no longer valid
+_AUTH_ERROR_CODES = frozenset([
+    API_EC_INVALID_OAUTH_TOKEN,
+    API_EC_SESSION_KEY_INVALID,
+])
+
+# the number of idle keep-alive connections kept per host
+DEFAULT_POOL_SIZE = 10
+
+# the number of threads used by concurrent operations
+DEFAULT_WORKERS = 8
+
+# the number of warm test users kept by user pools by default
+DEFAULT_USER_POOL_SIZE = 10
+
+# the maximum number of operations the Graph API accepts per batch request
+MAX_BATCH_SIZE = 50
+
+# the number of test users routed to each app by AppShards by default
+DEFAULT_SHARD_CAPACITY = 2000
+
+# the number of bytes read off of the socket at a time when streaming
+_CHUNK_SIZE = 16384
 
 
 class FacebookError(HTTPError): # pylint: disable=R0901
@@ -67,205 +150,3757 @@ class FacebookError(HTTPError): # pylint: disable=R0901
         self.type = data['type']
 
 
-def translate_http_error(func):
-    """ HTTPError to FacebookError translation decorator
+class _Response(object):
+    """ A fully read response, mimicking the bits of ``addinfourl`` in use
+    """
+    def __init__(self, url, code, headers, body):
+        self.url = url
+        self.code = code
+        self.headers = headers
+        self.size = len(body)
+        self._fp = BytesIO(body)
 
-    Decorates functions, handles :py:class:`urllib2.HTTPError` exceptions and
-    translates them into :class:`stepford.FacebookError`
+    def read(self, amt=None):
+        """ Reads from the response body """
+        return self._fp.read() if amt is None else self._fp.read(amt)
 
-    :param func: The function to decorate with translation handling
+    def close(self):
+        """ Closes the response """
+        self._fp.close()
+
+    def getcode(self):
+        """ Returns the HTTP status code """
+        return self.code
+
+    def info(self):
+        """ Returns the response headers """
+        return self.headers
+
+
+class _StreamedResponse(object):
+    """ A response whose body is read off of the connection on demand
+
+    ``release`` is called once the body has been read in full (with ``True``)
+    or the response is closed early (with ``False``).
     """
-    @wraps(func)
-    def inner(*args, **kwargs): # pylint: disable=C0111
-        try:
-            return func(*args, **kwargs)
-        except HTTPError as err:
-            raise FacebookError(err)
-    return inner
+    def __init__(self, url, resp, release):
+        self.url = url
+        self.code = resp.status
+        self.headers = resp.msg
+        self.size = int(resp.getheader('Content-Length') or 0)
+        self._resp = resp
+        self._release = release
 
+    def read(self, amt=None):
+        """ Reads from the response body """
+        resp = self._resp
+        if resp is None:
+            return b''
+        data = resp.read() if amt is None else resp.read(amt)
+        if amt is None or resp.isclosed():
+            self._resp = None
+            self._release(True)
+        return data
 
-@translate_http_error
-def app_token(client_id, client_secret):
-    """ Gets the app token
+    def close(self):
+        """ Discards the rest of the response body """
+        if self._resp is not None:
+            self._resp = None
+            self._release(False)
 
-    The app token is used in all ``stepford`` transactions. It is provided by
-    Facebook and only changes when your app secret has been changed.
+    def getcode(self):
+        """ Returns the HTTP status code """
+        return self.code
 
-    :param client_id: Your app's client ID, as provided by Facebook
-    :param client_secret: Your app's client secret, as provided by Facebook
+    def info(self):
+        """ Returns the response headers """
+        return self.headers
 
-    :return: A dict containing the app token
+
+def _error_body(err):
+    """ Peeks at the body of an HTTPError without consuming it """
+    try:
+        body = err.fp.read()
+        err.fp.seek(0)
+        return body
+    except (AttributeError, IOError, ValueError):
+        return b''
+
+
+def _error_code(err):
+    """ Peeks at the Facebook error code of an HTTPError without consuming
+    its body
+
+    :return: The error code, or ``None`` if there isn't one
     """
-    resp = urlopen('{}/oauth/access_token?{}'.format(_URIROOT, urlencode({
-        'client_id': client_id,
-        'client_secret': client_secret,
-        'grant_type': 'client_credentials',
-    })))
+    try:
+        return json.loads(_error_body(err).decode())['error']['code']
+    except (AttributeError, ValueError, KeyError, TypeError):
+        return None
 
-    return dict(parse_qsl(resp.read().decode()))['access_token']
 
+def _endpoint(path):
+    """ Normalizes a URL path, replacing IDs with ``{id}`` """
+    return '/' + '/'.join('{id}' if seg.isdigit() else seg
+        for seg in path.split('/') if seg)
 
-@translate_http_error
-def get(client_id, access_token):
-    """ Gets a list of available test users
 
-    :param client_id: Your app's client ID, as provided by Facebook
-    :param access_token: Your app's access_token, as retrieved by ``app_token``
-                         (alternatively, this can be retrieved by Facebook's
-                         testing toolset).
-    
-    :return: A list of ``dict`` elements containing user details
+def _notify(hooks, url, data, start, attempt, resp=None, err=None):
+    """ Sends a request event to ``hooks``
+
+    See :meth:`stepford.Session.add_hook` for the event's contents.
     """
-    resp = urlopen('{}/{}/accounts/test-users?{}'.format(_URIROOT,
-        client_id, urlencode({'access_token': access_token})))
+    parts = urlsplit(url)
+    override = dict(parse_qsl(parts.query)).get('method')
+    if override is None and data is not None:
+        override = dict(parse_qsl(data.decode())).get('method')
+    method = (override or ('GET' if data is None else 'POST')).upper()
+    endpoint = _endpoint(parts.path)
 
-    return json.loads(resp.read().decode())['data']
+    if resp is not None:
+        status, api_code, size = resp.code, None, getattr(resp, 'size', None)
+    elif isinstance(err, HTTPError):
+        status, api_code, size = err.code, _error_code(err), len(
+            _error_body(err))
+    else:
+        status, api_code, size = None, None, None
 
+    event = {
+        'operation': '{} {}'.format(method, endpoint),
+        'endpoint': endpoint,
+        'method': method,
+        'status': status,
+        'api_code': api_code,
+        'bytes': size,
+        'latency': time.time() - start,
+        'retries': attempt - 1,
+        'error': None if err is None else repr(err),
+    }
+    for hook in hooks:
+        hook(event)
 
-# pylint: disable=R0913
-@translate_http_error
-def create(client_id, access_token, installed=True, name=None,
-    locale='en_US', permissions='read_stream'):
-    """ Creates a test user
 
-    :param client_id: Your app's client ID, as provided by Facebook
-    :param access_token: Your app's access_token, as retrieved by ``app_token``
-                         (alternatively, this can be retrieved by Facebook's
-                         testing toolset).
-    :param installed: Whether or not the user should be created with your app
-                      installed.
-    :param name: The name of the test user. If ``None``, this will be
-                 auto-generated by Facebook.
-    :param locale: The user's default locale.
-    :param permissions: The scope approved by the test user. This should be a
-                        comma-delimited list of resource types approved by this
-                        user for your application.
+# latency histogram bucket upper bounds, from 1ms to ~65s
+_LATENCY_BUCKETS = [0.001 * 2 ** i for i in range(17)]
 
-    :return: A ``dict`` containing user details
+
+class StatsCollector(object):
+    """ Collects per-operation request statistics
+
+    Register an instance as a session hook (see
+    :meth:`stepford.Session.add_hook`) to keep counts, error counts, retries,
+    bytes received and a latency histogram per operation (i.e. ``POST
+    /{id}/accounts/test-users``).
     """
-    resp = urlopen('{}/{}/accounts/test-users?{}'.format(
-        _URIROOT,
-        client_id,
-        urlencode({
-            'installed': installed,
-            'locale': locale,
-            'permissions': permissions,
-            'method': 'post',
-            'access_token': access_token,
-            'name': name,
-        })))
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
 
-    return json.loads(resp.read().decode())
+    def __call__(self, event):
+        latency = event['latency']
+        with self._lock:
+            stats = self._stats.get(event['operation'])
+            if stats is None:
+                stats = self._stats[event['operation']] = {
+                    'count': 0,
+                    'errors': 0,
+                    'retries': 0,
+                    'bytes': 0,
+                    'latency_sum': 0.0,
+                    'latency_min': latency,
+                    'latency_max': latency,
+                    'histogram': [0] * (len(_LATENCY_BUCKETS) + 1),
+                }
 
+            stats['count'] += 1
+            stats['errors'] += event['error'] is not None
+            stats['retries'] += event['retries']
+            stats['bytes'] += event['bytes'] or 0
+            stats['latency_sum'] += latency
+            stats['latency_min'] = min(stats['latency_min'], latency)
+            stats['latency_max'] = max(stats['latency_max'], latency)
+            stats['histogram'][bisect.bisect_left(_LATENCY_BUCKETS,
+                latency)] += 1
 
-@translate_http_error
-def delete(userid, access_token):
-    """ Deletes a test user
+    def percentile(self, operation, pct):
+        """ Estimates a latency percentile from the histogram
 
-    :param userid: The ID of the user to delete.
-    :param client_id: Your app's client ID, as provided by Facebook
-    :param access_token: Your app's access_token, as retrieved by ``app_token``
-                         (alternatively, this can be retrieved by Facebook's
-                         testing toolset).
+        :param operation: The operation, as found in the event
+        :param pct: The percentile, from 0 to 100
 
-    :return: ``True`` on success
+        :return: The upper bound of the histogram bucket containing the
+                 percentile (capped at the maximum latency seen), or ``None``
+                 if the operation hasn't been seen
+        """
+        with self._lock:
+            stats = self._stats.get(operation)
+            if stats is None:
+                return None
+
+            target, seen = pct / 100.0 * stats['count'], 0
+            for idx, count in enumerate(stats['histogram']):
+                seen += count
+                if count and seen >= target:
+                    break
+            bound = _LATENCY_BUCKETS[idx] if idx < len(_LATENCY_BUCKETS) \
+                else stats['latency_max']
+            return min(bound, stats['latency_max'])
+
+    def snapshot(self):
+        """ Gets a copy of the statistics collected so far
+
+        :return: A ``dict`` mapping operations to their statistics
+        """
+        with self._lock:
+            return dict((operation, dict(stats,
+                histogram=list(stats['histogram'])))
+                for operation, stats in self._stats.items())
+
+    def merge(self, snapshot):
+        """ Adds the statistics of a snapshot, i.e. one taken in another
+        process, to those collected so far
+
+        :param snapshot: A snapshot, as returned by
+                         :meth:`~stepford.StatsCollector.snapshot`
+        """
+        with self._lock:
+            for operation, other in snapshot.items():
+                stats = self._stats.get(operation)
+                if stats is None:
+                    self._stats[operation] = dict(other,
+                        histogram=list(other['histogram']))
+                    continue
+
+                for key in ('count', 'errors', 'retries', 'bytes',
+                    'latency_sum'):
+                    stats[key] += other[key]
+                stats['latency_min'] = min(stats['latency_min'],
+                    other['latency_min'])
+                stats['latency_max'] = max(stats['latency_max'],
+                    other['latency_max'])
+                stats['histogram'] = [count + other_count for count,
+                    other_count in zip(stats['histogram'], other['histogram'])]
+
+    def reset(self):
+        """ Discards all statistics """
+        with self._lock:
+            self._stats = {}
+
+
+class LogSink(object):
+    """ Logs request events as structured log records
+
+    Each event is logged as a JSON message, and attached to the record as its
+    ``stepford`` attribute for use by structured log handlers.
+
+    :param logger (optional): The logger to use, defaults to the ``stepford``
+                              logger
+    :param level: The level to log successful requests at. Failed requests
+                  are logged as warnings.
     """
-    resp = urlopen('{}/{}?{}'.format(_URIROOT, userid, urlencode({
-        'method': 'delete',
-        'access_token': access_token,
-    })))
+    def __init__(self, logger=None, level=logging.DEBUG):
+        self.logger = logger or logging.getLogger('stepford')
+        self.level = level
 
-    return resp.read() == b'true'
+    def __call__(self, event):
+        level = self.level if event['error'] is None else logging.WARNING
+        if self.logger.isEnabledFor(level):
+            self.logger.log(level, json.dumps(event, sort_keys=True),
+                extra={'stepford': event})
 
 
-@translate_http_error
-def connect(*users):
-    """ Creates friendships between test user accounts
+class RetryPolicy(object):
+    """ Retries transient errors with exponential backoff and jitter
 
-    :param users: A list of users to create friendships for.
+    Requests failing with one of ``statuses``, one of ``api_codes`` or a
+    connection error are retried up to ``max_attempts`` times in total. The
+    n-th retry waits up to ``backoff * 2 ** (n - 1)`` seconds, capped at
+    ``max_backoff``. With ``jitter`` enabled, the actual delay is picked at
+    random between 0 and that value, spreading out retries from concurrent
+    callers.
+
+    .. warning:: Retried ``create`` calls may leave behind a user if
+                 Facebook created it but failed to respond.
+
+    .. attribute:: retries
+
+       The number of retries performed so far
+
+    .. attribute:: exhausted
+
+       The number of requests that still failed after ``max_attempts``
+
+    :param max_attempts: The maximum number of attempts per request.
+                         ``1`` disables retries.
+    :param backoff: The base delay in seconds
+    :param max_backoff: The maximum delay in seconds
+    :param jitter: Whether or not to randomize delays
+    :param api_codes: The Facebook error codes to retry
+    :param statuses: The HTTP status codes to retry
     """
-    if len(users) <= 1:
-        raise ValueError('len(users) must be > 1')
+    # pylint: disable=R0913
+    def __init__(self, max_attempts=3, backoff=0.5, max_backoff=30.0,
+        jitter=True, api_codes=RETRY_API_CODES, statuses=RETRY_STATUSES):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.api_codes = frozenset(api_codes)
+        self.statuses = frozenset(statuses)
+        self.retries = 0
+        self.exhausted = 0
+        self._lock = threading.Lock()
 
-    def _connect(user_a, user_b): # pylint: disable=C0111
-        return urlopen('{}/{}/friends/{}?{}'.format(_URIROOT,
-            user_a['id'], user_b['id'], urlencode({
-                'access_token': user_a['access_token'],
-                'method': 'post'
-            })))
+    def retriable(self, err):
+        """ Checks whether ``err`` is worth retrying """
+        if isinstance(err, HTTPError):
+            return err.code in self.statuses or \
+                _error_code(err) in self.api_codes
+        return isinstance(err, (HTTPException, socket.error))
 
-    for idx, user_a in enumerate(users[:-1]):
-        for user_b in users[idx + 1:]:
-            _connect(user_a, user_b)
-            _connect(user_b, user_a)
+    def delay(self, attempt, err):
+        """ Decides whether to retry a failed attempt
 
+        :param attempt: The number of the attempt that failed, starting at 1
+        :param err: The exception the attempt failed with
 
-@translate_http_error
-def update(userid, access_token, name=None, pwd=None):
-    """ Updates the given user
+        :return: The number of seconds to wait before retrying, or ``None`` if
+                 the request shouldn't be retried
+        """
+        if not self.retriable(err):
+            return None
 
-    :param userid: The ID of the user to be updated
-    :param access_token: The app access token
-    :param name (optional): If specified, what name to assign to the user
-    :param pwd (optional): If specified, what password to assign to the user
+        with self._lock:
+            if attempt >= self.max_attempts:
+                self.exhausted += 1
+                return None
+            self.retries += 1
 
-    :return: ``True`` on success
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        return random.uniform(0, delay) if self.jitter else delay
+
+    def reset(self):
+        """ Resets the counters """
+        with self._lock:
+            self.retries = self.exhausted = 0
+
+    def __getstate__(self):
+        # locks can't be pickled, i.e. for create_parallel's workers
+        state = dict(self.__dict__)
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+class TokenBucket(object):
+    """ A thread safe token bucket
+
+    Tokens are added at ``rate`` per second, up to ``burst``. Each request
+    consumes a token. Rather than blocking, :meth:`~stepford.TokenBucket.reserve`
+    returns how long the caller has to wait for its token, which lets the
+    same bucket be used from both threads and coroutines.
+
+    :param rate: The sustained number of requests per second
+    :param burst (optional): The maximum number of requests that can be made
+                             at once, defaults to ``rate`` (or 1 if lower)
     """
-    query = {
-        'method': 'post',
-        'access_token': access_token,
-    }
-    if name is not None:
-        query['name'] = name
+    def __init__(self, rate, burst=None):
+        if rate <= 0:
+            raise ValueError('rate must be > 0')
 
-    if pwd is not None:
-        query['password'] = pwd
+        self.rate = float(rate)
+        self.burst = float(max(1, rate) if burst is None else burst)
+        self._tokens = self.burst
+        self._stamp = time.time()
+        self._lock = threading.Lock()
 
-    resp = urlopen('{}/{}?{}'.format(_URIROOT, userid, urlencode(query)))
-    return resp.code == 200
+    def _take(self, tokens, stamp, count):
+        """ Refills ``tokens`` since ``stamp`` and takes ``count`` of them
 
+        :return: A ``(tokens, stamp, delay)`` tuple
+        """
+        now = time.time()
+        tokens = min(self.burst, tokens + (now - stamp) * self.rate) - count
+        return tokens, now, max(0.0, -tokens / self.rate)
 
-@translate_http_error
-def install(userid, install_to_token, clientid, access_token, scope=None):
-    """ Installs an app for the given user
+    def reserve(self, count=1):
+        """ Reserves tokens
 
-    :param userid: The user to install the app for
-    :param install_to_token: The app token for the app being installed
-    :param clientid: The client_id of the app that owns the test user
-    :param access_token: The app token of the app that owns the test user
-    :param scope: The scope to install the app for the test user with
+        Tokens may be reserved ahead of time, in which case later callers
+        queue up behind earlier ones.
 
-    :return: ``True`` on success
+        :param count: The number of tokens to reserve
+
+        :return: The number of seconds to wait before using the tokens
+        """
+        with self._lock:
+            self._tokens, self._stamp, delay = self._take(self._tokens,
+                self._stamp, count)
+        return delay
+
+    def acquire(self, count=1):
+        """ Blocks until ``count`` tokens are available """
+        time.sleep(self.reserve(count))
+
+    def __getstate__(self):
+        # locks can't be pickled, i.e. for create_parallel's workers
+        state = dict(self.__dict__)
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+class FileTokenBucket(TokenBucket):
+    """ A token bucket shared across processes
+
+    The bucket's state is kept in ``path`` and guarded by an exclusive file
+    lock, so that all processes using the same path share a single rate
+    limit. Requires :py:mod:`fcntl` (i.e. a POSIX platform).
+
+    :param path: The file to keep the bucket's state in
+    :param rate: The sustained number of requests per second
+    :param burst (optional): The maximum number of requests that can be made
+                             at once
     """
-    query = {
-        'installed': 'true',
-        'uid': userid,
-        'owner_access_token': access_token,
-        'access_token': install_to_token,
-        'method': 'post',
-    }
-    if scope is not None:
-        query['scope'] = scope
+    def __init__(self, path, rate, burst=None):
+        if fcntl is None:
+            raise RuntimeError('FileTokenBucket requires fcntl')
 
-    resp = urlopen('{}/{}/accounts/test-users?{}'.format(_URIROOT,
-        clientid, urlencode(query)))
-    return resp.code == 200
+        TokenBucket.__init__(self, rate, burst)
+        self.path = path
 
+    def reserve(self, count=1):
+        with open(self.path, 'a+') as state:
+            fcntl.flock(state, fcntl.LOCK_EX)
+            try:
+                state.seek(0)
+                try:
+                    tokens, stamp = json.loads(state.read())
+                except ValueError:
+                    tokens, stamp = self.burst, time.time()
 
-@translate_http_error
-def uninstall(userid, clientid, access_token):
-    """ Uninstalls an app for the given user
+                tokens, stamp, delay = self._take(tokens, stamp, count)
+                state.seek(0)
+                state.truncate()
+                state.write(json.dumps([tokens, stamp]))
+                state.flush()
+            finally:
+                fcntl.flock(state, fcntl.LOCK_UN)
+        return delay
 
-    :param userid: The user to uninstall the app for
-    :param clientid: The client id of the app being removed
-    :param access_token: The access token of the app being removed
 
-    :return: ``True`` on success
+class RateLimiter(object):
+    """ Applies :class:`stepford.TokenBucket` rate limits per client ID
+
+    The client ID of a request is taken from its app access token (which is
+    of the form ``client_id|...``) or, failing that, from the first path
+    segment of the URL (i.e. ``/[client_id]/accounts/test-users``). Requests
+    made with a user's own token (i.e. friend requests) are on behalf of the
+    user in the first path segment: they are attributed to the app owning
+    the user, as set with :meth:`~stepford.RateLimiter.set_owner` or found in
+    the registry (see :meth:`stepford.set_registry`). Requests for client IDs
+    without a bucket of their own use the ``default`` bucket, if there is
+    one.
+
+    .. code-block:: python
+
+        limiter = stepford.RateLimiter(default=stepford.TokenBucket(50))
+        limiter.set_limit([client_id], stepford.FileTokenBucket(
+            '/tmp/stepford-[client_id].bucket', 20))
+        stepford.set_session(stepford.Session(limiter=limiter))
+
+    :param default (optional): The bucket for all other requests
     """
-    resp = urlopen('{}/{}/accounts/test-users?{}'.format(_URIROOT,
-        clientid, urlencode({
-            'access_token': access_token,
-            'method': 'delete',
-            'uid': userid,
-        })))
-    return resp.code == 200
+    def __init__(self, default=None):
+        self.default = default
+        self._buckets = {}
+        self._owners = {}
+
+    def set_limit(self, client_id, bucket):
+        """ Sets the bucket used for ``client_id``, or removes it if ``None``
+        """
+        if bucket is None:
+            self._buckets.pop(client_id, None)
+        else:
+            self._buckets[client_id] = bucket
+
+    def set_owner(self, client_id, *userids):
+        """ Attributes requests made on behalf of test users to their app
+
+        :param client_id: The client ID of the app owning the users
+        :param userids: The IDs of the users
+        """
+        for userid in userids:
+            self._owners[str(userid)] = client_id
+
+    def _bucket(self, url, data):
+        """ Looks up the bucket for a request """
+        parts = urlsplit(url)
+        query = dict(parse_qsl(parts.query))
+        if data is not None:
+            query.update(parse_qsl(data.decode()))
+
+        token = query.get('access_token', '')
+        if '|' in token:
+            client_id = token.split('|', 1)[0]
+        else:
+            client_id = parts.path.strip('/').split('/', 1)[0]
+            if client_id in self._owners:
+                client_id = self._owners[client_id]
+            elif client_id not in self._buckets and _registry is not None:
+                user = _registry.get(client_id)
+                if user is not None and user.get('client_id') is not None:
+                    client_id = user['client_id']
+        return self._buckets.get(client_id, self.default)
+
+    def reserve(self, url, data=None):
+        """ Reserves a token for a request
+
+        :return: The number of seconds to wait before sending the request
+        """
+        bucket = self._bucket(url, data)
+        return 0.0 if bucket is None else bucket.reserve()
+
+
+class Session(object):
+    """ A pool of keep-alive HTTP(S) connections
+
+    Opening a new connection to the Graph API for each call means paying for
+    a TCP and TLS handshake every time. A :class:`stepford.Session` keeps
+    connections open once a response has been read and hands them out again
+    on subsequent calls to the same host. All module-level functions share a
+    default session (see :meth:`stepford.set_session`).
+
+    Sessions are thread safe: a connection is only ever used by a single
+    request at a time and additional connections are opened on demand when
+    all pooled ones are busy.
+
+    :param pool_size: The maximum number of idle connections kept per host.
+                      Connections released while the pool is full are closed.
+    :param timeout: The socket timeout (in seconds) used for new connections.
+    :param retry (optional): The :class:`stepford.RetryPolicy` applied to
+                             failed requests. A default policy is used if not
+                             specified.
+    :param limiter (optional): A :class:`stepford.RateLimiter` consulted
+                               before every request (including retries)
+    """
+    # pylint: disable=R0913
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, timeout=None, retry=None,
+        limiter=None):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retry = RetryPolicy() if retry is None else retry
+        self.limiter = limiter
+        self.hooks = []
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def add_hook(self, hook):
+        """ Registers a callable invoked with an event for every request
+
+        Events are ``dict`` elements with the following keys:
+
+        * ``operation``: the ``method`` and ``endpoint``, i.e.
+          ``DELETE /{id}``
+        * ``endpoint``: the URL path, with IDs replaced by ``{id}``
+        * ``method``: the effective HTTP method
+        * ``status``: the HTTP status, ``None`` on connection errors
+        * ``api_code``: the Facebook error code, if any
+        * ``bytes``: the size of the response body
+        * ``latency``: the total time taken in seconds, including retries
+        * ``retries``: the number of retries performed
+        * ``error``: a description of the error raised, if any
+
+        Hooks are called from the requesting thread and should be quick.
+
+        :param hook: The callable, i.e. a :class:`stepford.StatsCollector`
+        """
+        self.hooks = self.hooks + [hook]
+
+    def remove_hook(self, hook):
+        """ Unregisters a hook """
+        self.hooks = [other for other in self.hooks if other is not hook]
+
+    def _acquire(self, key):
+        """ Gets an idle connection for ``key`` or opens a new one
+
+        :return: A ``(connection, reused)`` tuple
+        """
+        with self._lock:
+            idle = self._pools.get(key)
+            if idle:
+                return idle.pop(), True
+
+        scheme, netloc = key
+        cls = HTTPSConnection if scheme == 'https' else HTTPConnection
+        if self.timeout is None:
+            return cls(netloc), False
+        return cls(netloc, timeout=self.timeout), False
+
+    def _release(self, key, conn):
+        """ Returns ``conn`` to the pool, closing it if the pool is full """
+        with self._lock:
+            idle = self._pools.setdefault(key, [])
+            if len(idle) < self.pool_size:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def urlopen(self, url, data=None, stream=False):
+        """ Performs a request against ``url``, retrying transient errors
+
+        :param url: The absolute URL to request
+        :param data (optional): A form-encoded request body. If given, the
+                                request is sent as a ``POST`` rather than a
+                                ``GET``.
+        :param stream (optional): Leave the body of successful responses to be
+                                  read off of the connection by the caller.
+                                  The connection is only returned to the pool
+                                  once the body has been read in full, and is
+                                  closed if the response is closed early.
+                                  Failures reading the body aren't retried.
+
+        :raises: :py:class:`urllib2.HTTPError` for responses with a status
+                 code >= 400
+        :return: A file-like response object exposing ``code`` and ``read``
+        """
+        hooks, attempt = self.hooks, 1
+        start = time.time() if hooks else None
+        while True:
+            try:
+                resp = (self._urlopen(url, data, stream=True) if stream
+                    else self._urlopen(url, data))
+            except (HTTPError, HTTPException, socket.error) as err:
+                # HTTPError isn't a socket.error on Python 2
+                delay = self.retry.delay(attempt, err)
+                if delay is None:
+                    if hooks:
+                        _notify(hooks, url, data, start, attempt, err=err)
+                    raise
+            else:
+                if hooks:
+                    _notify(hooks, url, data, start, attempt, resp=resp)
+                return resp
+            time.sleep(delay)
+            attempt += 1
+
+    def _urlopen(self, url, data, stream=False):
+        """ Performs a single attempt at a request """
+        if self.limiter is not None:
+            time.sleep(self.limiter.reserve(url, data))
+
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = urlunsplit(('', '', parts.path or '/', parts.query, ''))
+
+        if data is None:
+            method, headers = 'GET', {}
+        else:
+            method, headers = 'POST', {
+                'Content-Type': 'application/x-www-form-urlencoded'}
+
+        conn, reused = self._acquire(key)
+        while True:
+            try:
+                conn.request(method, path, data, headers)
+                resp = conn.getresponse()
+                if stream and resp.status < 400:
+                    return _StreamedResponse(url, resp,
+                        lambda complete: self._finish(key, conn, resp,
+                            complete))
+                body = resp.read()
+                break
+            except (HTTPException, socket.error):
+                conn.close()
+                if not reused:
+                    raise
+                # the server dropped an idle connection, try a fresh one
+                conn, reused = self._acquire(key)
+
+        self._finish(key, conn, resp)
+
+        if resp.status >= 400:
+            raise HTTPError(url, resp.status, resp.reason, resp.msg,
+                BytesIO(body))
+        return _Response(url, resp.status, resp.msg, body)
+
+    def _finish(self, key, conn, resp, complete=True):
+        """ Releases ``conn`` once ``resp`` has been read, if it can be reused
+        """
+        if complete and not resp.will_close:
+            self._release(key, conn)
+        else:
+            conn.close()
+
+    def close(self):
+        """ Closes all idle connections """
+        with self._lock:
+            pools, self._pools = self._pools, {}
+        for idle in pools.values():
+            for conn in idle:
+                conn.close()
+
+
+_session = Session() # pylint: disable=C0103
+
+
+def get_session():
+    """ Gets the session shared by all module-level functions """
+    return _session
+
+
+def set_session(session):
+    """ Replaces the session shared by all module-level functions
+
+    :param session: A :class:`stepford.Session`, or any object providing a
+                    compatible ``urlopen`` method (i.e. a custom transport)
+
+    :return: The previously active session
+    """
+    global _session # pylint: disable=W0603,C0103
+    previous, _session = _session, session
+    return previous
+
+
+def urlopen(url, data=None, stream=False):
+    """ Opens ``url`` using the shared session
+
+    This is the single request path used by every API call in ``stepford``.
+
+    :param url: The absolute URL to request
+    :param data (optional): A form-encoded ``POST`` body
+    :param stream (optional): Read the response body off of the connection on
+                              demand, see :meth:`stepford.Session.urlopen`
+    """
+    if stream:
+        return _session.urlopen(url, data, stream=True)
+    return _session.urlopen(url, data)
+
+
+class TokenCache(object):
+    """ Caches app tokens retrieved by :meth:`stepford.app_token`
+
+    Tokens are keyed on the client ID and a hash of the client secret, so
+    rotating an app's secret naturally results in a cache miss. Cached tokens
+    are discarded whenever a call using them fails with an authentication
+    error (see :data:`stepford.API_EC_INVALID_OAUTH_TOKEN`).
+
+    :param ttl (optional): The number of seconds a token is cached for. By
+                           default, tokens are cached until they're rejected.
+    :param path (optional): A file to persist tokens to, allowing them to be
+                            reused across processes. The file contains app
+                            tokens and should be treated as a secret.
+    """
+    def __init__(self, ttl=None, path=None):
+        self.ttl = ttl
+        self.path = path
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(client_id, client_secret):
+        """ Builds the cache key for an app """
+        return '{}:{}'.format(client_id, hashlib.sha256(
+            client_secret.encode()).hexdigest())
+
+    def _load(self):
+        """ Reads the on-disk cache """
+        try:
+            with open(self.path) as cache:
+                return json.load(cache)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _dump(self, tokens):
+        """ Atomically replaces the on-disk cache """
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(
+            os.path.abspath(self.path)))
+        with os.fdopen(fd, 'w') as cache:
+            json.dump(tokens, cache)
+        getattr(os, 'replace', os.rename)(tmp, self.path)
+
+    def get(self, client_id, client_secret):
+        """ Gets a cached token
+
+        :return: The app token, or ``None`` if it isn't cached
+        """
+        key = self._key(client_id, client_secret)
+        with self._lock:
+            entry = self._tokens.get(key)
+            if entry is None and self.path is not None:
+                entry = self._load().get(key)
+
+            if entry is None:
+                return None
+
+            token, expires = entry
+            if expires is not None and expires <= time.time():
+                self._tokens.pop(key, None)
+                return None
+
+            self._tokens[key] = entry
+            return token
+
+    def set(self, client_id, client_secret, token):
+        """ Caches a token """
+        key = self._key(client_id, client_secret)
+        entry = (token, None if self.ttl is None else time.time() + self.ttl)
+        with self._lock:
+            self._tokens[key] = entry
+            if self.path is not None:
+                tokens = self._load()
+                tokens[key] = entry
+                self._dump(tokens)
+
+    def discard(self, *tokens):
+        """ Removes the given tokens from the cache """
+        tokens = set(token for token in tokens
+            if isinstance(token, _STRING_TYPES))
+        with self._lock:
+            for key, entry in list(self._tokens.items()):
+                if entry[0] in tokens:
+                    del self._tokens[key]
+
+            if self.path is not None:
+                cached = self._load()
+                stale = [key for key, entry in cached.items()
+                    if entry[0] in tokens]
+                if stale:
+                    for key in stale:
+                        del cached[key]
+                    self._dump(cached)
+
+    def clear(self):
+        """ Removes all cached tokens """
+        with self._lock:
+            self._tokens = {}
+            if self.path is not None:
+                self._dump({})
+
+
+_token_cache = TokenCache() # pylint: disable=C0103
+
+
+def set_token_cache(cache):
+    """ Replaces the cache used by :meth:`stepford.app_token`
+
+    :param cache: A :class:`stepford.TokenCache`, or ``None`` to disable
+                  caching
+
+    :return: The previously active cache
+    """
+    global _token_cache # pylint: disable=W0603,C0103
+    previous, _token_cache = _token_cache, cache
+    return previous
+
+
+def _imap(func, iterable, workers=DEFAULT_WORKERS):
+    """ Lazily applies ``func`` to each item of ``iterable`` on a thread pool
+
+    Items are only pulled from ``iterable`` as workers become available, so
+    lazy inputs of any size are processed in bounded memory. Exceptions raised
+    by ``func`` are captured rather than propagated; exceptions raised while
+    pulling from ``iterable`` are re-raised once all workers have finished.
+
+    :param func: The callable to apply to each item
+    :param iterable: The items to process
+    :param workers: The maximum number of concurrent calls to ``func``
+
+    :return: An iterator of ``(item, result, error)`` tuples, in completion
+             order. ``error`` is ``None`` on success.
+    """
+    items = iter(iterable)
+    lock = threading.Lock()
+    results = Queue(maxsize=max(1, workers) * 2)
+    stop = threading.Event()
+    failures = []
+    done = object()
+
+    def _work(): # pylint: disable=C0111
+        while not stop.is_set():
+            with lock:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    break
+                except Exception as err: # pylint: disable=W0703
+                    failures.append(err)
+                    stop.set()
+                    break
+            try:
+                results.put((item, func(item), None))
+            except Exception as err: # pylint: disable=W0703
+                results.put((item, None, err))
+        results.put(done)
+
+    threads = [threading.Thread(target=_work) for _ in range(max(1, workers))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    running = len(threads)
+    try:
+        while running:
+            res = results.get()
+            if res is done:
+                running -= 1
+            else:
+                yield res
+    finally:
+        # the consumer may bail early, unblock and drain the workers
+        stop.set()
+        while running:
+            if results.get() is done:
+                running -= 1
+
+    if failures:
+        raise failures[0]
+
+
+def _translate(err, args, kwargs):
+    """ Translates ``err``, evicting rejected tokens from the token cache
+
+    :param err: The :py:class:`urllib2.HTTPError` to translate
+    :param args: The positional arguments of the failed call
+    :param kwargs: The keyword arguments of the failed call
+
+    :return: A :class:`stepford.FacebookError`
+    """
+    error = FacebookError(err)
+    if error.api_code in _AUTH_ERROR_CODES and _token_cache is not None:
+        _token_cache.discard(*(list(args) + list(kwargs.values())))
+    return error
+
+
+def _check(results):
+    """ Raises the first error of a set of ``_imap`` results
+
+    :return: A ``dict`` mapping items to results
+    """
+    done, errors = {}, []
+    for item, res, err in results:
+        if err is None:
+            done[item] = res
+        else:
+            errors.append(err)
+    if errors:
+        raise errors[0]
+    return done
+
+
+def translate_http_error(func):
+    """ HTTPError to FacebookError translation decorator
+
+    Decorates functions, handles :py:class:`urllib2.HTTPError` exceptions and
+    translates them into :class:`stepford.FacebookError`. If the error shows
+    that an access token was rejected, any of the function's arguments that
+    are cached app tokens are evicted from the token cache.
+
+    :param func: The function to decorate with translation handling
+    """
+    @wraps(func)
+    def inner(*args, **kwargs): # pylint: disable=C0111
+        try:
+            return func(*args, **kwargs)
+        except FacebookError:
+            raise
+        except HTTPError as err:
+            raise _translate(err, args, kwargs)
+    return inner
+
+
+def _relative_url(path, query):
+    """ Builds a URL relative to ``_URIROOT`` """
+    return '{}?{}'.format(path, urlencode(query))
+
+
+def _call(method, path, query, parse):
+    """ Performs a single Graph API operation
+
+    Operations are described by a ``(method, path, query, parse)`` tuple as
+    returned by the ``_*_op`` functions below, which allows them to be sent
+    either on their own or as part of a :class:`stepford.Batch`. Non-``GET``
+    methods are sent using the Graph API's ``method`` query override.
+    """
+    if method != 'GET':
+        query = dict(query, method=method.lower())
+    resp = urlopen('{}/{}'.format(_URIROOT, _relative_url(path, query)))
+    return parse(resp.code, resp.read())
+
+
+class User(MutableMapping):
+    """ A compact record of a test user's details
+
+    Users yielded by :meth:`stepford.iter_users` (and returned by the bulk
+    helpers built on it) are stored using ``__slots__`` rather than a
+    ``dict`` per user, which adds up when handling tens of thousands of them.
+    :meth:`stepford.create` and :meth:`stepford.get` still return ``dict``
+    elements.
+    Records behave like a ``dict`` (``user['id']``, ``user.get('email')``,
+    ``dict(user)``...) and also expose the ``id``, ``access_token`` and
+    ``login_url`` attributes. Other details, i.e. ``email`` and ``password``,
+    are kept in a ``dict`` created only when needed.
+    """
+    __slots__ = ('id', 'access_token', 'login_url', '_extra')
+    _FIELDS = ('id', 'access_token', 'login_url')
+
+    def __init__(self, *args, **kwargs): # pylint: disable=W0231
+        details = dict(*args, **kwargs)
+        for key in self._FIELDS:
+            if key in details:
+                setattr(self, key, details.pop(key))
+        self._extra = details or None
+
+    def __getitem__(self, key):
+        if key in self._FIELDS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def __setitem__(self, key, value):
+        if key in self._FIELDS:
+            setattr(self, key, value)
+        elif self._extra is None:
+            self._extra = {key: value}
+        else:
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self._FIELDS:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        elif self._extra is None:
+            raise KeyError(key)
+        else:
+            del self._extra[key]
+
+    def __iter__(self):
+        for key in self._FIELDS:
+            if hasattr(self, key):
+                yield key
+        if self._extra:
+            for key in self._extra:
+                yield key
+
+    def __len__(self):
+        return (sum(1 for key in self._FIELDS if hasattr(self, key)) +
+            len(self._extra or ()))
+
+    def __repr__(self):
+        return 'User({!r})'.format(dict(self))
+
+    def __getstate__(self):
+        return dict(self)
+
+    def __setstate__(self, state):
+        self.__init__(state)
+
+    def copy(self):
+        """ Returns a shallow copy of the record """
+        return User(self)
+
+
+def _parse_json(code, body): # pylint: disable=W0613
+    """ Parses a JSON response body """
+    return json.loads(body.decode())
+
+
+def _parse_users(code, body): # pylint: disable=W0613
+    """ Parses the ``data`` list of users out of a JSON response body """
+    return list(_PageDecoder(BytesIO(body)))
+
+
+def _parse_true(code, body): # pylint: disable=W0613
+    """ Checks for a literal ``true`` response body """
+    return body == b'true'
+
+
+def _parse_ok(code, body): # pylint: disable=W0613
+    """ Checks for a 200 response """
+    return code == 200
+
+
+def _get_op(client_id, access_token):
+    """ Describes :meth:`stepford.get` """
+    return ('GET', '{}/accounts/test-users'.format(client_id),
+        {'access_token': access_token}, _parse_users)
+
+
+# pylint: disable=R0913
+def _create_op(client_id, access_token, installed=True, name=None,
+    locale='en_US', permissions='read_stream'):
+    """ Describes :meth:`stepford.create` """
+    return ('POST', '{}/accounts/test-users'.format(client_id), {
+        'installed': installed,
+        'locale': locale,
+        'permissions': permissions,
+        'access_token': access_token,
+        'name': name,
+    }, _parse_json)
+
+
+def _delete_op(userid, access_token):
+    """ Describes :meth:`stepford.delete` """
+    return ('DELETE', str(userid), {'access_token': access_token},
+        _parse_true)
+
+
+def _friend_op(user_a, user_b):
+    """ Describes one half of a friendship: a request from ``user_a`` to
+    ``user_b``, or the confirmation of ``user_b``'s request
+    """
+    return ('POST', '{}/friends/{}'.format(user_a['id'], user_b['id']),
+        {'access_token': user_a['access_token']}, _parse_ok)
+
+
+def _unfriend_op(user_a, user_b):
+    """ Describes the removal of the friendship between two users """
+    return ('DELETE', '{}/friends/{}'.format(user_a['id'], user_b['id']),
+        {'access_token': user_a['access_token']}, _parse_true)
+
+
+def _update_op(userid, access_token, name=None, pwd=None):
+    """ Describes :meth:`stepford.update` """
+    query = {'access_token': access_token}
+    if name is not None:
+        query['name'] = name
+
+    if pwd is not None:
+        query['password'] = pwd
+
+    return ('POST', str(userid), query, _parse_ok)
+
+
+def _install_op(userid, install_to_token, clientid, access_token, scope=None):
+    """ Describes :meth:`stepford.install` """
+    query = {
+        'installed': 'true',
+        'uid': userid,
+        'owner_access_token': access_token,
+        'access_token': install_to_token,
+    }
+    if scope is not None:
+        query['scope'] = scope
+
+    return ('POST', '{}/accounts/test-users'.format(clientid), query,
+        _parse_ok)
+
+
+def _uninstall_op(userid, clientid, access_token):
+    """ Describes :meth:`stepford.uninstall` """
+    return ('DELETE', '{}/accounts/test-users'.format(clientid), {
+        'access_token': access_token,
+        'uid': userid,
+    }, _parse_ok)
+
+
+@translate_http_error
+def app_token(client_id, client_secret):
+    """ Gets the app token
+
+    The app token is used in all ``stepford`` transactions. It is provided by
+    Facebook and only changes when your app secret has been changed, so it is
+    cached (see :meth:`stepford.set_token_cache`).
+
+    :param client_id: Your app's client ID, as provided by Facebook
+    :param client_secret: Your app's client secret, as provided by Facebook
+
+    :return: A dict containing the app token
+    """
+    cache = _token_cache
+    if cache is not None:
+        token = cache.get(client_id, client_secret)
+        if token is not None:
+            return token
+
+    resp = urlopen('{}/oauth/access_token?{}'.format(_URIROOT, urlencode({
+        'client_id': client_id,
+        'client_secret': client_secret,
+        'grant_type': 'client_credentials',
+    })))
+
+    token = dict(parse_qsl(resp.read().decode()))['access_token']
+    if cache is not None:
+        cache.set(client_id, client_secret, token)
+    return token
+
+
+@translate_http_error
+def get(client_id, access_token):
+    """ Gets a list of available test users
+
+    :param client_id: Your app's client ID, as provided by Facebook
+    :param access_token: Your app's access_token, as retrieved by ``app_token``
+                         (alternatively, this can be retrieved by Facebook's
+                         testing toolset).
+    
+    :return: A list of ``dict`` elements containing user details
+    """
+    _, path, query, _ = _get_op(client_id, access_token)
+    users = list(_iter_pages(path, query, None, (client_id, access_token)))
+    _register_users(users, client_id)
+    return users
+
+
+def iter_users(client_id, access_token, limit=None):
+    """ Lazily iterates over all test users, page by page
+
+    Unlike :meth:`stepford.get`, users are yielded as soon as the page they're
+    on has been fetched, and only a single page is held in memory at a time.
+
+    :param client_id: Your app's client ID, as provided by Facebook
+    :param access_token: Your app's access_token, as retrieved by ``app_token``
+    :param limit (optional): The number of users to fetch per page
+
+    :return: An iterator of :class:`stepford.User` records
+    """
+    _, path, query, _ = _get_op(client_id, access_token)
+    return _iter_pages(path, query, limit, (client_id, access_token), User)
+
+
+def iter_friends(userid, access_token, limit=None):
+    """ Lazily iterates over a test user's friends, page by page
+
+    :param userid: The ID of the user
+    :param access_token: The user's access token
+    :param limit (optional): The number of friends to fetch per page
+
+    :return: An iterator of ``dict`` elements with the friends' ``id`` and
+             ``name``
+    """
+    return _iter_pages('{}/friends'.format(userid),
+        {'access_token': access_token}, limit, (userid, access_token))
+
+
+def _iter_pages(path, query, limit, args, wrap=None):
+    """ Iterates over the ``data`` of a paged listing, following cursors
+
+    Pages are decoded as they're read off of the connection, so only the
+    elements yielded so far are ever held in memory.
+
+    :param args: The arguments of the calling function, used to evict
+                 rejected tokens when translating errors
+    :param wrap (optional): Called with each decoded element
+    """
+    if limit is not None:
+        query = dict(query, limit=limit)
+
+    url = '{}/{}'.format(_URIROOT, _relative_url(path, query))
+    while url:
+        # errors are translated by hand as decorators don't cover the
+        # generator's body
+        try:
+            resp = urlopen(url, stream=True)
+        except HTTPError as err:
+            raise _translate(err, args, {})
+
+        page = _PageDecoder(resp, wrap)
+        try:
+            for item in page:
+                yield item
+        finally:
+            resp.close()
+
+        url = page.count and page.extra.get('paging', {}).get('next')
+
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+class _PageDecoder(object):
+    """ Incrementally decodes a paged listing read from ``fp``
+
+    Iterating yields the elements of the ``data`` array as soon as they've
+    been read, so that neither the raw body nor the full document are ever
+    held in memory. Other members (i.e. ``paging``) are stored in ``extra``
+    and the number of elements is available as ``count`` once iteration
+    completes.
+
+    :param fp: A file-like object exposing ``read(amt)``
+    :param wrap (optional): Called with each decoded element
+    """
+    def __init__(self, fp, wrap=None):
+        self.extra = {}
+        self.count = 0
+        self._fp = fp
+        self._wrap = wrap
+        self._scan = json.JSONDecoder().scan_once
+        self._text = getincrementaldecoder('utf-8')()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        """ Reads the next chunk off of ``fp`` into the buffer """
+        if self._eof:
+            raise ValueError('Unexpected end of JSON document')
+        chunk = self._fp.read(_CHUNK_SIZE)
+        self._eof = not chunk
+        self._buf = self._buf[self._pos:] + self._text.decode(chunk,
+            self._eof)
+        self._pos = 0
+
+    def _peek(self):
+        """ Gets the next non-whitespace character, without consuming it """
+        if self._pos < len(self._buf) and not self._buf[self._pos].isspace():
+            return self._buf[self._pos]
+        while True:
+            self._pos = _WHITESPACE.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            self._fill()
+
+    def _expect(self, chars):
+        """ Consumes the next non-whitespace character, one of ``chars`` """
+        char = self._peek()
+        if char not in chars:
+            raise ValueError('Expected one of {!r} at {!r}'.format(chars,
+                char))
+        self._pos += 1
+        return char
+
+    def _value(self):
+        """ Decodes the next value, reading more of ``fp`` as needed """
+        self._peek()
+        while True:
+            try:
+                value, end = self._scan(self._buf, self._pos)
+            except (StopIteration, ValueError):
+                # the value is incomplete
+                self._fill()
+                continue
+            # a number may continue past the end of the buffer
+            if end < len(self._buf) or self._eof:
+                self._pos = end
+                return value
+            self._fill()
+
+    def __iter__(self):
+        self._expect('{')
+        if self._peek() == '}':
+            return
+        while True:
+            key = self._value()
+            self._expect(':')
+            if key == 'data':
+                self._expect('[')
+                if self._peek() != ']':
+                    while True:
+                        item = self._value()
+                        self.count += 1
+                        yield item if self._wrap is None else self._wrap(item)
+                        if self._expect(',]') == ']':
+                            break
+                else:
+                    self._pos += 1
+            else:
+                self.extra[key] = self._value()
+            if self._expect(',}') == '}':
+                return
+
+
+# pylint: disable=R0913
+@translate_http_error
+def create(client_id, access_token, installed=True, name=None,
+    locale='en_US', permissions='read_stream'):
+    """ Creates a test user
+
+    :param client_id: Your app's client ID, as provided by Facebook
+    :param access_token: Your app's access_token, as retrieved by ``app_token``
+                         (alternatively, this can be retrieved by Facebook's
+                         testing toolset).
+    :param installed: Whether or not the user should be created with your app
+                      installed.
+    :param name: The name of the test user. If ``None``, this will be
+                 auto-generated by Facebook.
+    :param locale: The user's default locale.
+    :param permissions: The scope approved by the test user. This should be a
+                        comma-delimited list of resource types approved by this
+                        user for your application.
+
+    :return: A ``dict`` containing user details
+    """
+    user = _call(*_create_op(client_id, access_token, installed, name, locale,
+        permissions))
+    _register_create(user, client_id, installed, name, locale, permissions)
+    return user
+
+
+@translate_http_error
+def delete(userid, access_token):
+    """ Deletes a test user
+
+    :param userid: The ID of the user to delete.
+    :param client_id: Your app's client ID, as provided by Facebook
+    :param access_token: Your app's access_token, as retrieved by ``app_token``
+                         (alternatively, this can be retrieved by Facebook's
+                         testing toolset).
+
+    :return: ``True`` on success
+    """
+    deleted = _call(*_delete_op(userid, access_token))
+    if deleted:
+        _register_delete(userid)
+    return deleted
+
+
+def _friend_state(users, workers):
+    """ Fetches the friends and incoming friend requests of ``users``
+
+    :return: A ``dict`` mapping user IDs to ``(friends, requests)`` tuples of
+             sets of user IDs
+    """
+    by_id = dict((user['id'], user) for user in users)
+
+    def _state(userid): # pylint: disable=C0111
+        user = by_id[userid]
+        friends = set(friend['id']
+            for friend in iter_friends(userid, user['access_token']))
+        requests = set(request['from']['id'] for request in _iter_pages(
+            '{}/friendrequests'.format(userid),
+            {'access_token': user['access_token']}, None,
+            (userid, user['access_token'])))
+        return friends, requests
+
+    return _check(_imap(_state, by_id, workers))
+
+
+def _missing_halves(user_a, user_b, state):
+    """ Works out which halves of a friendship still need to be sent
+
+    :param state: The ``_friend_state`` of the users. Users without state are
+                  assumed to have no friends or pending requests.
+
+    :return: A list of ``(sender, recipient)`` tuples, in the order they must
+             be sent in
+    """
+    friends_a, requests_a = state.get(user_a['id'], ((), ()))
+    requests_b = state.get(user_b['id'], ((), ()))[1]
+    if user_b['id'] in friends_a:
+        return []
+    if user_a['id'] in requests_b:
+        # only the confirmation is missing
+        return [(user_b, user_a)]
+    if user_b['id'] in requests_a:
+        return [(user_a, user_b)]
+    return [(user_a, user_b), (user_b, user_a)]
+
+
+@translate_http_error
+def connect(*users, **kwargs):
+    """ Creates friendships between test user accounts
+
+    By default, friendships are created sequentially and the first failure
+    is raised. When ``workers`` is given, the pairs are friended concurrently
+    and failures are reported per edge instead.
+
+    Unless ``skip_existing`` is ``False``, the users' friends and pending
+    friend requests are fetched first (one listing each) and only the missing
+    requests and confirmations are sent, so that connecting users that are
+    mostly connected already is cheap.
+
+    :param users: A list of users to create friendships for.
+    :param workers (optional): The number of concurrent workers to use.
+    :param skip_existing (optional): Whether or not to skip existing
+                                     friendships and requests.
+
+    :return: ``None`` when running sequentially, otherwise a ``dict`` mapping
+             each ``(user_a['id'], user_b['id'])`` edge to ``True`` on success
+             or the :class:`stepford.FacebookError` that was encountered.
+    """
+    workers = kwargs.pop('workers', None)
+    skip_existing = kwargs.pop('skip_existing', True)
+    if kwargs:
+        raise TypeError('unexpected keyword arguments: {}'.format(
+            ', '.join(kwargs)))
+
+    if len(users) <= 1:
+        raise ValueError('len(users) must be > 1')
+
+    state = _friend_state(users, workers or 1) if skip_existing else {}
+
+    def _connect(halves): # pylint: disable=C0111
+        # the reciprocal request confirms the first one, so the two halves of
+        # an edge must be sent in order
+        for sender, recipient in halves:
+            _call(*_friend_op(sender, recipient))
+        return True
+
+    pairs = ((user_a, user_b) for idx, user_a in enumerate(users[:-1])
+        for user_b in users[idx + 1:])
+
+    if workers is None:
+        for user_a, user_b in pairs:
+            _connect(_missing_halves(user_a, user_b, state))
+        return None
+
+    @translate_http_error
+    def _edge(pair): # pylint: disable=C0111
+        return _connect(_missing_halves(pair[0], pair[1], state))
+
+    report = {}
+    for (user_a, user_b), res, err in _imap(_edge, pairs, workers):
+        report[(user_a['id'], user_b['id'])] = res if err is None else err
+    return report
+
+
+@translate_http_error
+def update(userid, access_token, name=None, pwd=None):
+    """ Updates the given user
+
+    :param userid: The ID of the user to be updated
+    :param access_token: The app access token
+    :param name (optional): If specified, what name to assign to the user
+    :param pwd (optional): If specified, what password to assign to the user
+
+    :return: ``True`` on success
+    """
+    updated = _call(*_update_op(userid, access_token, name, pwd))
+    if updated:
+        _register_update(userid, name, pwd)
+    return updated
+
+
+def refresh_tokens(client_id, access_token, userids):
+    """ Fetches the current access tokens of several users
+
+    Tokens are looked up in a single pass over the app's user listing, which
+    stops as soon as all users have been found.
+
+    :param client_id: Your app's client ID, as provided by Facebook
+    :param access_token: Your app's access_token, as retrieved by ``app_token``
+    :param userids: The IDs of the users
+
+    :return: A ``dict`` mapping the IDs of the users that were found to their
+             :class:`stepford.User` records
+    """
+    wanted, found = set(str(userid) for userid in userids), {}
+    if not wanted:
+        return found
+
+    for user in iter_users(client_id, access_token):
+        if user['id'] in wanted:
+            found[user['id']] = user
+            if _registry is not None:
+                _registry.add(user, client_id)
+            if len(found) == len(wanted):
+                break
+    return found
+
+
+def update_many(client_id, access_token, updates, workers=DEFAULT_WORKERS):
+    """ Updates several users concurrently, refreshing their tokens
+
+    Changing a user's password invalidates their access token. Rather than
+    listing all users once per updated user to find their new token, the
+    updates are applied concurrently and the records of all updated users are
+    then refreshed in a single pass (see :meth:`stepford.refresh_tokens`).
+
+    :param client_id: Your app's client ID, as provided by Facebook
+    :param access_token: Your app's access_token, as retrieved by ``app_token``
+    :param updates: A ``dict`` mapping user IDs to ``dict`` elements of
+                    :meth:`stepford.update` arguments, i.e.
+                    ``{'pwd': 'secret'}``
+    :param workers: The number of updates to run concurrently
+
+    :return: A ``dict`` mapping user IDs to their refreshed
+             :class:`stepford.User` record on success, or the
+             :class:`stepford.FacebookError` that was encountered
+    """
+    results = dict((userid, res if err is None else err)
+        for userid, res, err in _imap(lambda userid: update(userid,
+            access_token, **updates[userid]), updates, workers))
+
+    users = refresh_tokens(client_id, access_token, [userid
+        for userid, res in results.items() if res is True])
+
+    for userid, res in results.items():
+        if res is True:
+            user = users.get(str(userid)) or User(id=str(userid))
+            if updates[userid].get('name') is not None:
+                user['name'] = updates[userid]['name']
+            results[userid] = user
+    return results
+
+
+@translate_http_error
+def install(userid, install_to_token, clientid, access_token, scope=None):
+    """ Installs an app for the given user
+
+    :param userid: The user to install the app for
+    :param install_to_token: The app token for the app being installed
+    :param clientid: The client_id of the app that owns the test user
+    :param access_token: The app token of the app that owns the test user
+    :param scope: The scope to install the app for the test user with
+
+    :return: ``True`` on success
+    """
+    installed = _call(*_install_op(userid, install_to_token, clientid,
+        access_token, scope))
+    if installed:
+        _register_install(userid, install_to_token)
+    return installed
+
+
+@translate_http_error
+def uninstall(userid, clientid, access_token):
+    """ Uninstalls an app for the given user
+
+    :param userid: The user to uninstall the app for
+    :param clientid: The client id of the app being removed
+    :param access_token: The access token of the app being removed
+
+    :return: ``True`` on success
+    """
+    uninstalled = _call(*_uninstall_op(userid, clientid, access_token))
+    if uninstalled:
+        _register_uninstall(userid, clientid)
+    return uninstalled
+
+
+def _app_tokens(apps, workers=DEFAULT_WORKERS):
+    """ Gets the tokens of ``(client_id, client_secret)`` apps concurrently
+
+    :return: A ``dict`` mapping client IDs to app tokens
+    """
+    apps = dict(apps)
+    return _check(_imap(lambda client_id: app_token(client_id,
+        apps[client_id]), apps, workers))
+
+
+def _matrix(func, users, apps, workers):
+    """ Applies ``func(userid, client_id)`` to every user and app concurrently
+
+    :return: A ``dict`` mapping ``(userid, client_id)`` cells to results or
+             errors
+    """
+    cells = itertools.product([user if isinstance(user, _STRING_TYPES)
+        else user['id'] for user in users], apps)
+    return dict((cell, res if err is None else err)
+        for cell, res, err in _imap(lambda cell: func(*cell), cells, workers))
+
+
+def install_many(users, apps, clientid, access_token, scope=None,
+    workers=DEFAULT_WORKERS):
+    """ Installs several apps for several users concurrently
+
+    Each app's token is fetched once (and cached, see
+    :meth:`stepford.set_token_cache`) before the installs are run on a pool of
+    ``workers`` threads. Failures are reported per cell rather than raised.
+
+    :param users: The users (or user IDs) to install the apps for
+    :param apps: A list of ``(client_id, client_secret)`` tuples for the apps
+                 being installed
+    :param clientid: The client_id of the app that owns the test users
+    :param access_token: The app token of the app that owns the test users
+    :param scope: The scope to install the apps for the test users with
+    :param workers: The number of installs to run concurrently
+
+    :return: A ``dict`` mapping each ``(user['id'], client_id)`` cell to
+             ``True`` on success or the :class:`stepford.FacebookError` that
+             was encountered
+    """
+    tokens = _app_tokens(apps, workers)
+    return _matrix(lambda userid, app_id: install(userid, tokens[app_id],
+        clientid, access_token, scope), users, tokens, workers)
+
+
+def uninstall_many(users, apps, workers=DEFAULT_WORKERS):
+    """ Uninstalls several apps for several users concurrently
+
+    See :meth:`stepford.install_many`.
+
+    :param users: The users (or user IDs) to uninstall the apps for
+    :param apps: A list of ``(client_id, client_secret)`` tuples for the apps
+                 being removed
+    :param workers: The number of uninstalls to run concurrently
+
+    :return: A ``dict`` mapping each ``(user['id'], client_id)`` cell to
+             ``True`` on success or the :class:`stepford.FacebookError` that
+             was encountered
+    """
+    tokens = _app_tokens(apps, workers)
+    return _matrix(lambda userid, app_id: uninstall(userid, app_id,
+        tokens[app_id]), users, tokens, workers)
+
+
+def purge(client_id, access_token, apps=(), workers=DEFAULT_WORKERS,
+    progress=None):
+    """ Deletes all test users of an app
+
+    Users are streamed from :meth:`stepford.iter_users` and deleted
+    concurrently. Users that can't be deleted because other apps are still
+    installed (:data:`stepford.API_EC_TEST_ACCOUNTS_CANT_DELETE`) have the
+    apps given in ``apps`` uninstalled and are then retried.
+
+    Deleting users while the listing is being paged through shifts later
+    users onto pages that were already read, so the listing is read again
+    until a pass turns up no users that haven't been processed yet. Users
+    that fail to be deleted aren't retried.
+
+    :param client_id: Your app's client ID, as provided by Facebook
+    :param access_token: Your app's access_token, as retrieved by ``app_token``
+    :param apps (optional): A list of ``(client_id, access_token)`` tuples for
+                            the other apps that may be installed for the
+                            users being deleted
+    :param workers: The number of users to delete concurrently
+    :param progress (optional): A callable invoked with ``(user, error)``
+                                each time a user has been processed, where
+                                ``error`` is ``None`` on success
+
+    :return: A ``dict`` with the number of users ``deleted``, a ``failed``
+             ``dict`` mapping user IDs to the :class:`stepford.FacebookError`
+             encountered, the ``elapsed`` time in seconds and the ``rate`` of
+             deletions per second.
+    """
+    def _purge(user): # pylint: disable=C0111
+        try:
+            return delete(user['id'], access_token)
+        except FacebookError as err:
+            if err.api_code != API_EC_TEST_ACCOUNTS_CANT_DELETE or not apps:
+                raise
+
+        for app_id, app_access_token in apps:
+            try:
+                uninstall(user['id'], app_id, app_access_token)
+            except FacebookError:
+                # most likely not installed for this user
+                pass
+        return delete(user['id'], access_token)
+
+    seen = set()
+
+    def _unseen(): # pylint: disable=C0111
+        for user in iter_users(client_id, access_token):
+            if user['id'] not in seen:
+                seen.add(user['id'])
+                yield user
+
+    report = {'deleted': 0, 'failed': {}}
+    start = time.time()
+    while True:
+        processed = len(seen)
+        for user, _, err in _imap(_purge, _unseen(), workers):
+            if err is None:
+                report['deleted'] += 1
+            else:
+                report['failed'][user['id']] = err
+            if progress is not None:
+                progress(user, err)
+        if len(seen) == processed:
+            break
+
+    report['elapsed'] = time.time() - start
+    report['rate'] = report['deleted'] / report['elapsed'] \
+        if report['elapsed'] else 0.0
+    return report
+
+
+class AppShards(object):
+    """ Spreads test users over several apps
+
+    Each app can only hold so many test users
+    (see :data:`stepford.API_EC_TEST_ACCOUNTS_TOO_MANY`). A
+    :class:`stepford.AppShards` creates users on whichever app has the most
+    room left and keeps a map of which app owns each user, so that later
+    operations are sent with the right app's token:
+
+    .. code-block:: python
+
+        shards = stepford.AppShards([([client_id], [client_secret]),
+            ([other_client_id], [other_client_secret])])
+        users = [shards.create() for _ in range(3000)]
+        client_id, token = shards.owner(users[0])
+        shards.delete(users[0])
+
+    The apps' tokens are fetched and their existing users listed
+    (concurrently) when the shards are created. Apps that report being full
+    are treated as such until the next :meth:`~stepford.AppShards.get`.
+
+    :param apps: A list of ``(client_id, client_secret)`` tuples
+    :param capacity: The number of users to route to each app at most
+    :param workers: The number of concurrent requests
+    """
+    def __init__(self, apps, capacity=DEFAULT_SHARD_CAPACITY,
+        workers=DEFAULT_WORKERS):
+        self.clients = [client_id for client_id, _ in apps]
+        self.capacity = capacity
+        self.workers = workers
+        self.tokens = _app_tokens(apps, workers)
+        self._owners = {}
+        self._counts = {}
+        self._full = set()
+        self._lock = threading.Lock()
+        self.get()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._owners)
+
+    def counts(self):
+        """ Gets the number of users owned by each app
+
+        :return: A ``dict`` mapping client IDs to user counts
+        """
+        with self._lock:
+            return dict(self._counts)
+
+    def owner(self, user):
+        """ Gets the app owning a user
+
+        :param user: The user (or user ID)
+
+        :raises: ``KeyError`` if the user isn't known
+        :return: A ``(client_id, access_token)`` tuple
+        """
+        userid = user if isinstance(user, _STRING_TYPES) else user['id']
+        with self._lock:
+            client_id = self._owners[userid]
+        return client_id, self.tokens[client_id]
+
+    def get(self):
+        """ Lists the users of all apps concurrently, rebuilding the shard map
+
+        :return: A list of :class:`stepford.User` records
+        """
+        listings = _check(_imap(lambda client_id: list(iter_users(client_id,
+            self.tokens[client_id])), self.clients, self.workers))
+
+        with self._lock:
+            self._owners = dict((user['id'], client_id)
+                for client_id, users in listings.items() for user in users)
+            self._counts = dict((client_id, len(users))
+                for client_id, users in listings.items())
+            self._full = set()
+        return [user for client_id in self.clients
+            for user in listings[client_id]]
+
+    def _reserve(self):
+        """ Reserves room for a user on the app with the most room left
+
+        :return: The app's client ID, or ``None`` if all apps are full
+        """
+        with self._lock:
+            candidates = [client_id for client_id in self.clients
+                if client_id not in self._full and
+                self._counts[client_id] < self.capacity]
+            if not candidates:
+                return None
+            client_id = min(candidates, key=self._counts.get)
+            self._counts[client_id] += 1
+            return client_id
+
+    def create(self, **kwargs):
+        """ Creates a user on the app with the most room left
+
+        If the app turns out to be full, the user is created on the next one.
+
+        :param kwargs: Any of the optional arguments of
+                       :meth:`stepford.create`
+
+        :raises: :class:`stepford.FacebookError` with
+                 :data:`stepford.API_EC_TEST_ACCOUNTS_TOO_MANY` if the apps
+                 report being full, ``RuntimeError`` if they are all at
+                 ``capacity``
+        :return: The new user, as returned by :meth:`stepford.create`
+        """
+        last_error = None
+        while True:
+            client_id = self._reserve()
+            if client_id is None:
+                if last_error is None:
+                    raise RuntimeError('all apps are at capacity')
+                raise last_error
+
+            try:
+                user = create(client_id, self.tokens[client_id], **kwargs)
+            except FacebookError as err:
+                with self._lock:
+                    self._counts[client_id] -= 1
+                    if err.api_code == API_EC_TEST_ACCOUNTS_TOO_MANY:
+                        self._full.add(client_id)
+                if err.api_code != API_EC_TEST_ACCOUNTS_TOO_MANY:
+                    raise
+                last_error = err
+                continue
+
+            with self._lock:
+                self._owners[user['id']] = client_id
+            return user
+
+    def delete(self, user):
+        """ Deletes a user using its owning app's token
+
+        :param user: The user (or user ID)
+
+        :return: ``True`` on success
+        """
+        userid = user if isinstance(user, _STRING_TYPES) else user['id']
+        client_id, token = self.owner(userid)
+        deleted = delete(userid, token)
+        if deleted:
+            with self._lock:
+                if self._owners.pop(userid, None) is not None:
+                    self._counts[client_id] -= 1
+        return deleted
+
+
+def _batch_result(url, sub, parse):
+    """ Translates a single batch sub-response into a result or error """
+    if sub is None:
+        # Facebook didn't get around to running the operation (i.e. the
+        # batch timed out or an operation it depends on failed)
+        return FacebookError(HTTPError(url, None, 'No response', {},
+            BytesIO(b'')))
+
+    body = (sub.get('body') or '').encode()
+    headers = dict((header['name'], header['value'])
+        for header in sub.get('headers') or ())
+    if sub['code'] >= 400:
+        return FacebookError(HTTPError(url, sub['code'], 'Batch error',
+            headers, BytesIO(body)))
+    return parse(sub['code'], body)
+
+
+class Batch(object):
+    """ Collects operations and sends them as Graph API batch requests
+
+    The Graph API accepts up to 50 operations per batch request. Operations
+    queued on a :class:`stepford.Batch` take the same arguments as their
+    module-level counterparts, but are only sent when
+    :meth:`~stepford.Batch.execute` is called:
+
+    .. code-block:: python
+
+        batch = stepford.Batch(app_token)
+        for _ in range(100):
+            batch.create(client_id, app_token)
+        users = batch.execute()
+
+    :param access_token: The fallback token for the batch request itself.
+                         Each operation is still sent with its own token.
+    :param size: The maximum number of operations per batch request
+    """
+    def __init__(self, access_token, size=MAX_BATCH_SIZE):
+        if not 0 < size <= MAX_BATCH_SIZE:
+            raise ValueError('size must be between 1 and {}'.format(
+                MAX_BATCH_SIZE))
+
+        self.access_token = access_token
+        self.size = size
+        self._calls = []
+
+    def __len__(self):
+        return len(self._calls)
+
+    def _add(self, *ops):
+        """ Queues a call made up of one or more dependent operations
+
+        :return: The index of the call's result
+        """
+        self._calls.append(ops)
+        return len(self._calls) - 1
+
+    def create(self, *args, **kwargs):
+        """ Queues a :meth:`stepford.create` call """
+        return self._add(_create_op(*args, **kwargs))
+
+    def delete(self, *args, **kwargs):
+        """ Queues a :meth:`stepford.delete` call """
+        return self._add(_delete_op(*args, **kwargs))
+
+    def update(self, *args, **kwargs):
+        """ Queues a :meth:`stepford.update` call """
+        return self._add(_update_op(*args, **kwargs))
+
+    def install(self, *args, **kwargs):
+        """ Queues a :meth:`stepford.install` call """
+        return self._add(_install_op(*args, **kwargs))
+
+    def uninstall(self, *args, **kwargs):
+        """ Queues a :meth:`stepford.uninstall` call """
+        return self._add(_uninstall_op(*args, **kwargs))
+
+    def connect(self, user_a, user_b):
+        """ Queues a friendship between two users
+
+        Both halves of the friendship are sent in the same batch request, the
+        confirmation depending on the initial friend request.
+        """
+        return self._add(_friend_op(user_a, user_b),
+            _friend_op(user_b, user_a))
+
+    def _chunks(self, calls):
+        """ Splits ``calls`` into batches, never splitting a single call """
+        chunk, count = [], 0
+        for ops in calls:
+            if chunk and count + len(ops) > self.size:
+                yield chunk
+                chunk, count = [], 0
+            chunk.append(ops)
+            count += len(ops)
+
+        if chunk:
+            yield chunk
+
+    def _send(self, chunk):
+        """ Sends a single batch request and demultiplexes its responses """
+        requests = []
+        for ops in chunk:
+            for idx, (method, path, query, _) in enumerate(ops):
+                request = {
+                    'method': method,
+                    'relative_url': _relative_url(path, query),
+                }
+                if idx:
+                    request['depends_on'] = 'op{}'.format(len(requests) - 1)
+                if idx < len(ops) - 1:
+                    request['name'] = 'op{}'.format(len(requests))
+                    request['omit_response_on_success'] = False
+                requests.append(request)
+
+        resp = urlopen('{}/'.format(_URIROOT), urlencode({
+            'access_token': self.access_token,
+            'batch': json.dumps(requests),
+        }).encode())
+
+        subs = iter(json.loads(resp.read().decode()))
+        results = []
+        for ops in chunk:
+            result = None
+            for (_, path, query, parse), sub in zip(ops, subs):
+                if not isinstance(result, FacebookError):
+                    result = _batch_result('{}/{}'.format(_URIROOT,
+                        _relative_url(path, query)), sub, parse)
+            results.append(result)
+        return results
+
+    def execute(self):
+        """ Sends all queued operations and clears the queue
+
+        Errors are returned rather than raised. When a batch request as a
+        whole fails, its error is returned for each of the calls it was
+        sending, while the results of the other batch requests are kept.
+
+        :return: A list with one entry per queued call, in the order the calls
+                 were queued. Each entry is either the result the equivalent
+                 module-level function would have returned, the
+                 :class:`stepford.FacebookError` it would have raised, or the
+                 connection error the batch request failed with.
+        """
+        calls, self._calls = self._calls, []
+        results = []
+        for chunk in self._chunks(calls):
+            try:
+                results.extend(self._send(chunk))
+            except HTTPError as err:
+                results.extend([_translate(err, (self.access_token,), {})] *
+                    len(chunk))
+            except (HTTPException, socket.error) as err:
+                results.extend([err] * len(chunk))
+        return results
+
+
+def _permissions(permissions):
+    """ Normalizes a comma-delimited permission list for comparison """
+    return frozenset(perm.strip() for perm in permissions.split(',')
+        if perm.strip())
+
+
+class UserPool(object):
+    """ A warm pool of test users, leased out and returned rather than
+    created and deleted
+
+    Creating and deleting test users is slow and counts against
+    :data:`API_EC_TEST_ACCOUNTS_TOO_MANY`. A :class:`stepford.UserPool` keeps
+    ``size`` users created ahead of time (replenished by a background thread),
+    hands them out with :meth:`~stepford.UserPool.lease` and takes them back
+    with :meth:`~stepford.UserPool.release`:
+
+    .. code-block:: python
+
+        with stepford.UserPool(client_id, app_token, size=10) as pool:
+            user = pool.lease(locale='fr_FR')
+            try:
+                [...]
+            finally:
+                pool.release(user)
+
+    Released users are reset (see :meth:`~stepford.UserPool.reset_user`)
+    rather than deleted. They are left in place when the pool is closed, and
+    with ``adopt``, up to ``size`` existing test users are adopted when the
+    pool is created, so that warm users carry over between runs. Adopted users
+    may be in use by other processes: only adopt users of apps that aren't
+    shared, or use a :class:`stepford.SharedUserPool`.
+
+    :param client_id: Your app's client ID, as provided by Facebook
+    :param access_token: Your app's access_token
+    :param size: The number of warm users to keep
+    :param installed: Whether or not new users have your app installed
+    :param locale: The default locale for new users
+    :param permissions: The default permissions for new users
+    :param reset (optional): A callable invoked with each released user
+                             instead of :meth:`~stepford.UserPool.reset_user`.
+                             It should undo any changes made by tests and
+                             return the user, or ``None`` if the user is
+                             gone. If it raises a
+                             :class:`stepford.FacebookError`, the user is
+                             deleted instead of returned to the pool.
+    :param adopt: Whether or not to adopt the app's existing test users
+    :param workers: The number of users to create concurrently
+    """
+    # seconds to wait before retrying after a failed replenishment
+    retry_interval = 5
+
+    # pylint: disable=R0913
+    def __init__(self, client_id, access_token, size=DEFAULT_USER_POOL_SIZE,
+        installed=True, locale='en_US', permissions='read_stream', reset=None,
+        adopt=False, workers=DEFAULT_WORKERS):
+        self.client_id = client_id
+        self.access_token = access_token
+        self.size = size
+        self.reset = self.reset_user if reset is None else reset
+        self.workers = workers
+        self.last_error = None
+        self._defaults = {
+            'installed': installed,
+            'locale': locale,
+            'permissions': permissions,
+        }
+        self._warm = []
+        self._leased = {}
+        self._names = {}
+        self._closed = False
+        self._cond = threading.Condition()
+
+        if adopt:
+            for user in itertools.islice(iter_users(client_id, access_token),
+                size):
+                # the listing only exposes tokens for users with the app
+                # installed, everything else about them is unknown
+                self._warm.append(({'installed': 'access_token' in user},
+                    dict(user)))
+            self._names.update(names([user['id'] for _, user in self._warm],
+                access_token))
+
+        self._thread = threading.Thread(target=self._replenish)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __len__(self):
+        with self._cond:
+            return len(self._warm)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @staticmethod
+    def _matches(attrs, filters):
+        """ Checks whether a user created with ``attrs`` satisfies ``filters``
+        """
+        for key, value in filters.items():
+            if value is None:
+                continue
+            if key not in attrs:
+                return False
+            if key == 'permissions':
+                if not _permissions(value) <= _permissions(attrs[key]):
+                    return False
+            elif attrs[key] != value:
+                return False
+        return True
+
+    def lease(self, locale=None, permissions=None, installed=None):
+        """ Leases a user from the pool
+
+        Filters that are ``None`` match any user. If no warm user matches, a
+        new one is created on the spot.
+
+        :param locale (optional): The locale the user must have
+        :param permissions (optional): The permissions the user must have
+                                       granted (at least)
+        :param installed (optional): Whether or not the user must have your app
+                                     installed
+
+        :return: A ``dict`` containing user details
+        """
+        filters = {
+            'locale': locale,
+            'permissions': permissions,
+            'installed': installed,
+        }
+        with self._cond:
+            for idx, (attrs, user) in enumerate(self._warm):
+                if self._matches(attrs, filters):
+                    del self._warm[idx]
+                    self._leased[user['id']] = attrs
+                    self._cond.notify_all()
+                    return user
+
+        attrs = dict(self._defaults)
+        attrs.update((key, value) for key, value in filters.items()
+            if value is not None)
+        user = create(self.client_id, self.access_token, **attrs)
+        try:
+            name = names([user['id']], self.access_token).get(user['id'])
+        except FacebookError:
+            # the name just won't be restored
+            name = None
+        with self._cond:
+            self._leased[user['id']] = attrs
+            self._names[user['id']] = name
+        return user
+
+    def reset_user(self, user):
+        """ Resets a released user, unless another ``reset`` was given
+
+        The user's name is restored and their token is refreshed (see
+        :meth:`stepford.refresh_tokens`), in case a test changed their name or
+        password.
+
+        :param user: The released user
+
+        :return: The reset user, or ``None`` if the user no longer exists
+        """
+        name = self._names.get(user['id'])
+        if name is not None:
+            update(user['id'], self.access_token, name=name)
+
+        found = refresh_tokens(self.client_id, self.access_token,
+            [user['id']]).get(user['id'])
+        if found is None:
+            return None
+        user = dict(user)
+        user.update(found)
+        return user
+
+    def release(self, user):
+        """ Returns a leased user to the pool, once it has been reset
+
+        :param user: A user previously returned by
+                     :meth:`~stepford.UserPool.lease`
+        """
+        with self._cond:
+            attrs = self._leased.pop(user['id'])
+
+        try:
+            reset = self.reset(user)
+        except FacebookError:
+            try:
+                delete(user['id'], self.access_token)
+            except FacebookError:
+                pass
+            reset = None
+
+        with self._cond:
+            if reset is None:
+                self._names.pop(user['id'], None)
+            else:
+                self._warm.append((attrs, reset))
+                self._cond.notify_all()
+
+    def _replenish(self):
+        """ Creates users in the background whenever the pool runs low """
+        def _create(_): # pylint: disable=C0111
+            return create(self.client_id, self.access_token, **self._defaults)
+
+        while True:
+            with self._cond:
+                while not self._closed and len(self._warm) >= self.size:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                deficit = self.size - len(self._warm)
+
+            created, failed = [], False
+            for _, user, err in _imap(_create, range(deficit), self.workers):
+                if err is None:
+                    created.append(user)
+                else:
+                    self.last_error, failed = err, True
+
+            try:
+                # names are restored when users are reset
+                found = names([user['id'] for user in created],
+                    self.access_token)
+            except Exception as err: # pylint: disable=W0703
+                self.last_error, found = err, {}
+
+            with self._cond:
+                self._names.update(found)
+                self._warm.extend((dict(self._defaults), user)
+                    for user in created)
+                self._cond.notify_all()
+
+            if failed:
+                with self._cond:
+                    if not self._closed:
+                        self._cond.wait(self.retry_interval)
+
+    def close(self, delete_users=False):
+        """ Stops replenishing the pool
+
+        :param delete_users: Whether or not to delete the pool's warm users.
+                             By default they are kept to be adopted by the
+                             next pool.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+
+        if delete_users:
+            with self._cond:
+                warm, self._warm = self._warm, []
+            for _ in _imap(lambda entry: delete(entry[1]['id'],
+                self.access_token), warm, self.workers):
+                pass
+
+
+class SharedUserPool(object):
+    """ A warm pool of test users shared by several processes
+
+    This is the multi-process counterpart of :class:`stepford.UserPool`, i.e.
+    for test suites run in parallel by ``pytest-xdist``. The pool's state is
+    kept in ``path`` and guarded by an exclusive file lock, so every process
+    using the same path leases users from the same warm pool rather than
+    creating its own. The first process to use the pool adopts up to ``size``
+    of the app's existing test users and creates any missing ones
+    (concurrently) while the others wait. Requires :py:mod:`fcntl` (i.e. a POSIX platform).
+
+    .. code-block:: python
+
+        pool = stepford.SharedUserPool('/tmp/stepford-pool.json', client_id,
+            app_token, size=20)
+        user = pool.lease(locale='fr_FR')
+        try:
+            [...]
+        finally:
+            pool.release(user)
+
+    Users are left in place once released so that they can be adopted by the
+    next run.
+
+    :param path: The file to keep the pool's state in
+    :param client_id: Your app's client ID, as provided by Facebook
+    :param access_token: Your app's access_token
+    :param size: The number of warm users to create up front
+    :param installed: Whether or not new users have your app installed
+    :param locale: The default locale for new users
+    :param permissions: The default permissions for new users
+    :param adopt: Whether or not to adopt the app's existing test users
+    :param workers: The number of users to create concurrently
+    """
+    # pylint: disable=R0913
+    def __init__(self, path, client_id, access_token,
+        size=DEFAULT_USER_POOL_SIZE,
+        installed=True, locale='en_US', permissions='read_stream', adopt=True,
+        workers=DEFAULT_WORKERS):
+        if fcntl is None:
+            raise RuntimeError('SharedUserPool requires fcntl')
+
+        self.path = path
+        self.client_id = client_id
+        self.access_token = access_token
+        self.size = size
+        self.adopt = adopt
+        self.workers = workers
+        self._defaults = {
+            'installed': installed,
+            'locale': locale,
+            'permissions': permissions,
+        }
+
+    def _update(self, func):
+        """ Applies ``func`` to the pool's state while holding the lock
+
+        The pool is filled first if this is the first time it's used.
+
+        :return: The result of ``func``
+        """
+        with open(self.path, 'a+') as state:
+            fcntl.flock(state, fcntl.LOCK_EX)
+            try:
+                state.seek(0)
+                try:
+                    pool = json.loads(state.read())
+                except ValueError:
+                    pool = self._fill()
+
+                res = func(pool)
+                state.seek(0)
+                state.truncate()
+                state.write(json.dumps(pool))
+                state.flush()
+            finally:
+                fcntl.flock(state, fcntl.LOCK_UN)
+        return res
+
+    def _fill(self):
+        """ Builds the initial state of the pool """
+        warm = []
+        if self.adopt:
+            # see UserPool
+            warm.extend([{'installed': 'access_token' in user}, dict(user)]
+                for user in itertools.islice(iter_users(self.client_id,
+                    self.access_token), self.size))
+
+        def _create(_): # pylint: disable=C0111
+            return create(self.client_id, self.access_token, **self._defaults)
+
+        warm.extend([dict(self._defaults), dict(user)] for user in _check(_imap(
+            _create, range(max(0, self.size - len(warm))),
+            self.workers)).values())
+        return {'warm': warm, 'leased': {}}
+
+    def __len__(self):
+        return self._update(lambda pool: len(pool['warm']))
+
+    def lease(self, locale=None, permissions=None, installed=None):
+        """ Leases a user from the pool, see :meth:`stepford.UserPool.lease`
+
+        :return: A :class:`stepford.User` record
+        """
+        filters = {
+            'locale': locale,
+            'permissions': permissions,
+            'installed': installed,
+        }
+
+        def _take(pool): # pylint: disable=C0111
+            for idx, (attrs, user) in enumerate(pool['warm']):
+                if UserPool._matches(attrs, filters):
+                    del pool['warm'][idx]
+                    pool['leased'][user['id']] = [attrs, user]
+                    return user
+
+        user = self._update(_take)
+        if user is not None:
+            return User(user)
+
+        attrs = dict(self._defaults)
+        attrs.update((key, value) for key, value in filters.items()
+            if value is not None)
+        user = create(self.client_id, self.access_token, **attrs)
+
+        def _lease(pool): # pylint: disable=C0111
+            pool['leased'][user['id']] = [attrs, dict(user)]
+        self._update(_lease)
+        return user
+
+    def release(self, user):
+        """ Returns a leased user to the pool
+
+        :param user: A user previously returned by
+                     :meth:`~stepford.SharedUserPool.lease`
+        """
+        def _release(pool): # pylint: disable=C0111
+            attrs, _ = pool['leased'].pop(user['id'])
+            pool['warm'].append([attrs, dict(user)])
+        self._update(_release)
+
+
+@translate_http_error
+def names(userids, access_token):
+    """ Looks up the names of test users
+
+    Users are looked up :data:`stepford.MAX_BATCH_SIZE` at a time, using the
+    Graph API's ``ids`` parameter.
+
+    :param userids: The IDs of the users
+    :param access_token: The app token of the app owning the users
+
+    :return: A ``dict`` mapping user IDs to names
+    """
+    userids, found = list(userids), {}
+    for idx in range(0, len(userids), MAX_BATCH_SIZE):
+        resp = urlopen('{}/?{}'.format(_URIROOT, urlencode({
+            'ids': ','.join(str(userid)
+                for userid in userids[idx:idx + MAX_BATCH_SIZE]),
+            'fields': 'name',
+            'access_token': access_token,
+        })))
+        for userid, user in json.loads(resp.read().decode()).items():
+            found[userid] = user.get('name')
+    return found
+
+
+def load_spec(path):
+    """ Loads a social graph fixture spec from a JSON or YAML file
+
+    YAML files (``.yml`` or ``.yaml``) require PyYAML.
+
+    :param path: The file to load
+
+    :return: The spec, see :meth:`stepford.provision`
+    """
+    with open(path) as spec:
+        if os.path.splitext(path)[1].lower() in ('.yml', '.yaml'):
+            if yaml is None:
+                raise RuntimeError('loading YAML specs requires PyYAML')
+            return yaml.safe_load(spec)
+        return json.load(spec)
+
+
+@translate_http_error
+def _owner_apps(userid, access_token):
+    """ Gets the client IDs of the apps installed for a test user """
+    resp = urlopen('{}/{}/ownerapps?{}'.format(_URIROOT, userid, urlencode({
+        'access_token': access_token})))
+    return set(app['id'] for app in json.loads(resp.read().decode())['data'])
+
+
+def provision(client_id, access_token, spec, apps=None,
+    workers=DEFAULT_WORKERS):
+    """ Provisions a social graph of test users from a fixture spec
+
+    The spec describes users (keyed by an arbitrary label) and the
+    friendships between them:
+
+    .. code-block:: python
+
+        {
+            'users': {
+                'alice': {'locale': 'fr_FR', 'apps': ['[other_client_id]']},
+                'bob': {'name': 'Bob', 'permissions': 'email'},
+                'carol': {'installed': False},
+            },
+            'edges': [['alice', 'bob']],
+        }
+
+    Each user may specify the ``name`` (defaulting to its label), ``locale``,
+    ``permissions`` and ``installed`` arguments of :meth:`stepford.create`,
+    and ``apps``, a list of other apps' client IDs to install.
+
+    Provisioning is incremental: existing test users are matched to the spec
+    by name, and only missing users, app installs and friendships are
+    created. Attributes other than the name only apply to newly created
+    users. Independent operations are run concurrently. If anything fails,
+    the first error is raised once the current step is complete; running
+    ``provision`` again picks up where it left off.
+
+    :param client_id: Your app's client ID, as provided by Facebook
+    :param access_token: Your app's access_token, as retrieved by ``app_token``
+    :param spec: The fixture spec, as a ``dict`` (see
+                 :meth:`stepford.load_spec`)
+    :param apps (optional): A ``dict`` mapping the client IDs of the other apps
+                            used in the spec to their app tokens
+    :param workers: The number of concurrent operations
+
+    :return: A ``dict`` with the provisioned ``users`` (mapping labels to user
+             details) and the labels of the users ``created``, the
+             ``(label, client_id)`` app ``installs`` and the ``(label,
+             label)`` ``edges`` that were added.
+    """
+    users, edges, apps = spec.get('users', {}), spec.get('edges', []), \
+        apps or {}
+    for edge in edges:
+        if len(edge) != 2 or edge[0] == edge[1]:
+            raise ValueError('invalid edge: {!r}'.format(edge))
+        for label in edge:
+            if label not in users:
+                raise ValueError('unknown user in edge: {!r}'.format(label))
+    for label, attrs in users.items():
+        for app in (attrs or {}).get('apps', ()):
+            if app not in apps:
+                raise ValueError('no token for app {!r} of user {!r}'.format(
+                    app, label))
+
+    def _name(label): # pylint: disable=C0111
+        return (users[label] or {}).get('name') or label
+
+    # match existing users by name
+    existing = dict((user['id'], user)
+        for user in iter_users(client_id, access_token))
+    by_name = {}
+    for userid, name in names(existing, access_token).items():
+        by_name.setdefault(name, []).append(existing[userid])
+
+    provisioned, missing = {}, []
+    for label in sorted(users):
+        matches = by_name.get(_name(label))
+        if matches:
+            provisioned[label] = matches.pop(0)
+        else:
+            missing.append(label)
+
+    def _create(label): # pylint: disable=C0111
+        attrs = users[label] or {}
+        kwargs = dict((key, attrs[key])
+            for key in ('installed', 'locale', 'permissions') if key in attrs)
+        return create(client_id, access_token, name=_name(label), **kwargs)
+
+    provisioned.update(_check(_imap(_create, missing, workers)))
+
+    # only existing users may already have apps installed or friends
+    def _installed(label): # pylint: disable=C0111
+        if label in missing:
+            return set()
+        return _owner_apps(provisioned[label]['id'], access_token)
+
+    wanted = [label for label in users if (users[label] or {}).get('apps')]
+    installed = _check(_imap(_installed, wanted, workers))
+    installs = [(label, app) for label in wanted
+        for app in users[label]['apps'] if app not in installed[label]]
+
+    def _install(pair): # pylint: disable=C0111
+        label, app = pair
+        return install(provisioned[label]['id'], apps[app], client_id,
+            access_token)
+
+    _check(_imap(_install, installs, workers))
+
+    # only existing users may already have friends or pending requests
+    involved = set(label for edge in edges for label in edge
+        if label not in missing)
+    state = _friend_state([provisioned[label] for label in involved],
+        workers)
+
+    added, halves, seen = [], {}, set()
+    for label_a, label_b in edges:
+        if frozenset((label_a, label_b)) in seen:
+            continue
+        seen.add(frozenset((label_a, label_b)))
+        halves[label_a, label_b] = _missing_halves(provisioned[label_a],
+            provisioned[label_b], state)
+        if halves[label_a, label_b]:
+            added.append((label_a, label_b))
+
+    @translate_http_error
+    def _connect(edge): # pylint: disable=C0111
+        for sender, recipient in halves[edge]:
+            _call(*_friend_op(sender, recipient))
+        return True
+
+    _check(_imap(_connect, added, workers))
+
+    return {
+        'users': provisioned,
+        'created': missing,
+        'installs': installs,
+        'edges': added,
+    }
+
+
+def snapshot(users, access_token, path=None, workers=DEFAULT_WORKERS):
+    """ Records the names, installed apps and friendships of test users
+
+    Only friendships between the given users are recorded, as seen by those
+    with an access token. Passwords can't be read back from the Graph API and
+    so aren't part of snapshots.
+
+    :param users: The users to record, as returned by :meth:`stepford.create`
+    :param access_token: The app token of the app owning the users
+    :param path (optional): A file to write the snapshot to, as compact JSON
+    :param workers: The number of concurrent requests
+
+    :return: The snapshot, a ``dict`` mapping user IDs to their ``name`` and
+             ``apps`` under ``users`` and listing the ``(id, id)`` friendships
+             under ``edges``
+    """
+    by_id = dict((user['id'], user) for user in users)
+    current = names(by_id, access_token)
+    apps = _check(_imap(lambda userid: _owner_apps(userid, access_token),
+        by_id, workers))
+    friends = _check(_imap(lambda userid: [friend['id'] for friend in
+        iter_friends(userid, by_id[userid]['access_token'])],
+        [userid for userid in by_id if 'access_token' in by_id[userid]],
+        workers))
+
+    snap = {
+        'users': dict((userid, {
+            'name': current.get(userid),
+            'apps': sorted(apps[userid]),
+        }) for userid in by_id),
+        'edges': sorted(list(edge) for edge in set(
+            tuple(sorted((userid, friend))) for userid in friends
+            for friend in friends[userid] if friend in by_id)),
+    }
+    if path is not None:
+        with open(path, 'w') as out:
+            json.dump(snap, out, separators=(',', ':'), sort_keys=True)
+    return snap
+
+
+def restore(snap, client_id, access_token, apps=None,
+    workers=DEFAULT_WORKERS):
+    """ Restores test users to a snapshot taken by :meth:`stepford.snapshot`
+
+    The users' current state is fetched and compared to the snapshot, and
+    only the differences (renames, app installs and uninstalls, friendships
+    to add or remove) are applied, concurrently. If anything fails, the first
+    error is raised once all changes have been attempted.
+
+    Friendships can only be read and changed with a user's access token,
+    which Facebook only hands out for users with your app installed. The
+    friendships of other users are left alone.
+
+    :param snap: The snapshot, or the path of a file it was written to
+    :param client_id: Your app's client ID, as provided by Facebook
+    :param access_token: Your app's access_token, as retrieved by ``app_token``
+    :param apps (optional): A ``dict`` mapping the client IDs of the other apps
+                            to install or uninstall to their app tokens
+    :param workers: The number of concurrent requests
+
+    :return: A ``dict`` listing the IDs of the users ``renamed``, the ``(id,
+             client_id)`` pairs ``installed`` and ``uninstalled`` and the
+             ``(id, id)`` friendships ``connected`` and ``disconnected``
+    """
+    if isinstance(snap, _STRING_TYPES):
+        with open(snap) as stored:
+            snap = json.load(stored)
+    wanted = snap['users']
+    tokens = dict(apps or {}, **{client_id: access_token})
+
+    # tokens change along with passwords, so fetch the current ones
+    users = {}
+    for user in iter_users(client_id, access_token):
+        if user['id'] in wanted:
+            users[user['id']] = user
+            if len(users) == len(wanted):
+                break
+    if len(users) != len(wanted):
+        raise ValueError('users no longer exist: {}'.format(', '.join(
+            sorted(set(wanted) - set(users)))))
+
+    current = names(users, access_token)
+    renamed = sorted(userid for userid in users
+        if current.get(userid) != wanted[userid]['name'])
+
+    installed = _check(_imap(lambda userid: _owner_apps(userid,
+        access_token), users, workers))
+    installs = sorted((userid, app) for userid in users
+        for app in set(wanted[userid]['apps']) - installed[userid])
+    uninstalls = sorted((userid, app) for userid in users
+        for app in installed[userid] - set(wanted[userid]['apps']))
+    for _, app in installs + uninstalls:
+        if app not in tokens:
+            raise ValueError('no token for app {!r}'.format(app))
+
+    # users without the app installed come without a token
+    befriendable = dict((userid, user) for userid, user in users.items()
+        if 'access_token' in user)
+    state = _friend_state(befriendable.values(), workers)
+    edges = set(tuple(edge) for edge in snap['edges']
+        if all(userid in befriendable for userid in edge))
+    existing = set((userid, friend) for userid in befriendable
+        for friend in state[userid][0]
+        if friend in befriendable and userid < friend)
+    connected = sorted(edges - existing)
+    disconnected = sorted(existing - edges)
+
+    ops = [('rename', userid) for userid in renamed] + \
+        [('install',) + pair for pair in installs] + \
+        [('uninstall',) + pair for pair in uninstalls] + \
+        [('connect',) + edge for edge in connected] + \
+        [('disconnect',) + edge for edge in disconnected]
+
+    @translate_http_error
+    def _apply(op): # pylint: disable=C0111
+        kind, userid, other = (op + (None,))[:3]
+        if kind == 'rename':
+            return update(userid, access_token, name=wanted[userid]['name'])
+        if kind == 'install':
+            return install(userid, tokens[other], client_id, access_token)
+        if kind == 'uninstall':
+            return uninstall(userid, other, tokens[other])
+        if kind == 'connect':
+            for sender, recipient in _missing_halves(users[userid],
+                users[other], state):
+                _call(*_friend_op(sender, recipient))
+            return True
+        return _call(*_unfriend_op(users[userid], users[other]))
+
+    _check(_imap(_apply, ops, workers))
+
+    return {
+        'renamed': renamed,
+        'installed': installs,
+        'uninstalled': uninstalls,
+        'connected': connected,
+        'disconnected': disconnected,
+    }
+
+
+class Journal(object):
+    """ An append-only, write-ahead journal of stepford operations
+
+    Long provisioning runs that crash halfway leave behind users nobody
+    knows about, counting towards :data:`API_EC_TEST_ACCOUNTS_TOO_MANY`. Calls
+    made through a journal are recorded in ``path`` (as lines of JSON) before
+    they're sent, and their outcome once they complete, so that an
+    interrupted run can be finished or rolled back with
+    :meth:`~stepford.Journal.resume`:
+
+    .. code-block:: python
+
+        with stepford.Journal('provision.journal') as journal:
+            users = [journal.create(client_id, app_token) for _ in range(100)]
+            journal.connect(users[0], users[1])
+
+        # after a crash
+        with stepford.Journal('provision.journal') as journal:
+            report = journal.resume()
+
+    Each intent is flushed to disk before the call is sent. Calls made
+    concurrently share ``fsync`` calls (group commit), and outcomes are only
+    written to disk along with later intents, so the journal stays cheap
+    under load. Users created without a name are given a unique one, which
+    is how users created right before a crash are found again.
+
+    Journals hold the access tokens that operations were called with.
+
+    :param path: The journal file, which is appended to if it exists (after
+                 discarding any record torn by a crash)
+    :param fsync: Whether or not to ``fsync`` intents before sending calls.
+                  Without it, the journal only survives crashes of the
+                  process, not of the machine.
+    """
+    def __init__(self, path, fsync=True):
+        self.path = path
+        self.fsync = fsync
+        self.entries = {}
+        self._seq = 0
+        self._run = uuid.uuid4().hex[:8]
+        if os.path.exists(path):
+            with open(path, 'rb+') as journal:
+                complete = 0
+                for line in journal:
+                    if not line.endswith(b'\n'):
+                        # a line torn by a crash, which must go before new
+                        # records are appended
+                        break
+                    self._replay(line.decode('utf-8'))
+                    complete += len(line)
+                journal.truncate(complete)
+
+        self._file = open(path, 'a')
+        self._cond = threading.Condition()
+        self._written = 0
+        self._synced = 0
+        self._syncing = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _replay(self, line):
+        """ Applies a line read back from the journal """
+        try:
+            record = json.loads(line)
+        except ValueError:
+            # a record that didn't make it to disk intact
+            return
+        self._apply(record)
+
+    def _apply(self, record):
+        """ Applies a record to ``entries`` """
+        seq = record['seq']
+        if 'op' in record:
+            self.entries[seq] = {
+                'op': record['op'],
+                'args': record['args'],
+                'kwargs': record['kwargs'],
+                'state': None,
+                'result': None,
+            }
+            self._seq = max(self._seq, seq)
+        elif seq in self.entries:
+            self.entries[seq]['state'] = record['state']
+            self.entries[seq]['result'] = record.get('result')
+
+    def _append(self, record):
+        """ Writes a record, the lock must be held
+
+        :return: The number of records written so far
+        """
+        self._file.write(json.dumps(record, separators=(',', ':'),
+            sort_keys=True) + '\n')
+        self._apply(record)
+        self._written += 1
+        return self._written
+
+    def _sync(self, upto):
+        """ Waits for the first ``upto`` records to be on disk
+
+        A single thread flushes and syncs all records written so far while
+        the others wait, so concurrent callers share ``fsync`` calls.
+        """
+        with self._cond:
+            while self._synced < upto:
+                if self._syncing:
+                    self._cond.wait()
+                    continue
+
+                self._syncing, target = True, self._written
+                self._file.flush()
+                self._cond.release()
+                try:
+                    if self.fsync:
+                        os.fsync(self._file.fileno())
+                finally:
+                    self._cond.acquire()
+                    self._syncing, self._synced = False, target
+                    self._cond.notify_all()
+
+    def _begin(self, op, args, kwargs):
+        """ Records the intent to perform an operation
+
+        :return: The operation's sequence number
+        """
+        with self._cond:
+            self._seq += 1
+            seq = self._seq
+            if op == 'create' and kwargs.get('name') is None:
+                kwargs = dict(kwargs, name='stepford {}-{}'.format(self._run,
+                    seq))
+            written = self._append({'seq': seq, 'op': op, 'args': args,
+                'kwargs': kwargs})
+        self._sync(written)
+        return seq
+
+    def _finish(self, seq, state, result=None):
+        """ Records the outcome of an operation """
+        with self._cond:
+            self._append({'seq': seq, 'state': state, 'result': result})
+
+    @translate_http_error
+    def _perform(self, seq):
+        """ Performs a recorded operation """
+        entry = self.entries[seq]
+        op, args, kwargs = entry['op'], entry['args'], entry['kwargs']
+        if op == 'create':
+            return dict(create(*args, **kwargs))
+        if op == 'connect':
+            return connect(*args, **kwargs)
+        return install(*args, **kwargs)
+
+    def _execute(self, seq):
+        """ Performs an operation, recording its outcome """
+        try:
+            result = self._perform(seq)
+        except FacebookError as err:
+            self._finish(seq, 'failed', str(err))
+            raise
+        self._finish(seq, 'done', result)
+        return result
+
+    def create(self, client_id, access_token, **kwargs):
+        """ Creates a test user, see :meth:`stepford.create`
+
+        :return: The new user, as a :class:`stepford.User` record
+        """
+        return User(self._execute(self._begin('create',
+            [client_id, access_token], kwargs)))
+
+    def connect(self, user_a, user_b):
+        """ Makes friends of two test users, see :meth:`stepford.connect` """
+        return self._execute(self._begin('connect', [
+            {'id': user_a['id'], 'access_token': user_a['access_token']},
+            {'id': user_b['id'], 'access_token': user_b['access_token']},
+        ], {}))
+
+    def install(self, userid, install_to_token, clientid, access_token,
+        scope=None):
+        """ Installs an app for a test user, see :meth:`stepford.install` """
+        return self._execute(self._begin('install',
+            [userid, install_to_token, clientid, access_token],
+            {'scope': scope}))
+
+    def close(self):
+        """ Syncs and closes the journal """
+        with self._cond:
+            written = self._written
+        self._sync(written)
+        self._file.close()
+
+    def _reconcile(self, workers):
+        """ Works out whether users whose creation was interrupted exist """
+        unknown = [seq for seq, entry in self.entries.items()
+            if entry['op'] == 'create' and entry['state'] is None]
+        apps = set(tuple(self.entries[seq]['args']) for seq in unknown)
+
+        def _list(app): # pylint: disable=C0111
+            users = dict((user['id'], user) for user in iter_users(*app))
+            by_name = {}
+            for userid, name in names(users, app[1]).items():
+                by_name[name] = users[userid]
+            return by_name
+
+        existing = _check(_imap(_list, apps, workers))
+        for seq in unknown:
+            entry = self.entries[seq]
+            user = existing[tuple(entry['args'])].get(entry['kwargs']['name'])
+            if user is not None:
+                self._finish(seq, 'done', dict(user))
+
+    def resume(self, rollback=False, workers=DEFAULT_WORKERS):
+        """ Finishes or rolls back an interrupted run
+
+        Users whose creation was interrupted are first looked up by name.
+        Then, either the operations that didn't complete are performed again
+        (users are created first, then apps installed and friendships
+        created), or every completed operation is undone: users created by
+        the run are deleted, and apps installed for and friendships created
+        between other users are removed. Completed work is skipped, and
+        calling ``resume`` again only deals with what's still left to do.
+
+        :param rollback: Whether to roll the run back rather than finish it
+        :param workers: The number of concurrent operations
+
+        :return: A ``dict`` with the number of operations ``skipped``, the
+                 sequence numbers of the operations ``completed`` or
+                 ``rolled_back``, a ``failed`` ``dict`` mapping sequence
+                 numbers to errors and the ``users`` created by the run (when
+                 not rolling back)
+        """
+        self._reconcile(workers)
+        report = {'completed': [], 'rolled_back': [], 'failed': {}}
+        report['skipped'] = sum(1 for entry in self.entries.values()
+            if entry['state'] in ('done', 'undone'))
+
+        phases = ('create', 'install', 'connect')
+        if rollback:
+            created = set(entry['result']['id']
+                for entry in self.entries.values()
+                if entry['op'] == 'create' and entry['state'] == 'done')
+            func, phases, key = self._undo(created), phases[::-1], \
+                'rolled_back'
+        else:
+            func, key = self._execute, 'completed'
+
+        states = (None, 'failed', 'done') if rollback else (None, 'failed')
+        for phase in phases:
+            seqs = sorted(seq for seq, entry in self.entries.items()
+                if entry['op'] == phase and entry['state'] in states)
+            for seq, _, err in _imap(func, seqs, workers):
+                if err is None:
+                    report[key].append(seq)
+                else:
+                    report['failed'][seq] = err
+
+        report[key].sort()
+        report['users'] = [] if rollback else [User(entry['result'])
+            for _, entry in sorted(self.entries.items())
+            if entry['op'] == 'create' and entry['state'] == 'done']
+        return report
+
+    def _undo(self, created):
+        """ Builds the function undoing operations, given the IDs of the
+        users created by the run
+        """
+        @translate_http_error
+        def _undo(seq): # pylint: disable=C0111
+            entry = self.entries[seq]
+            args = entry['args']
+            if entry['state'] == 'done':
+                if entry['op'] == 'create':
+                    delete(entry['result']['id'], args[1])
+                elif entry['op'] == 'install' and args[0] not in created:
+                    # app tokens are prefixed with the app's client ID
+                    uninstall(args[0], args[1].split('|', 1)[0], args[1])
+                elif entry['op'] == 'connect' and not created.intersection(
+                    user['id'] for user in args):
+                    _call(*_unfriend_op(*args))
+            self._finish(seq, 'undone')
+            return True
+        return _undo
+
+
+# the statistics of a worker process of create_parallel
+_worker_stats = None # pylint: disable=C0103
+
+
+def _init_worker(root, pool_size, timeout, retry, limiter):
+    """ Sets up a worker process of :meth:`stepford.create_parallel` with a
+    session and token cache of its own, applying the parent's retry policy
+    and rate limits
+    """
+    global _URIROOT, _worker_stats # pylint: disable=W0603,C0103
+    _URIROOT = root
+    _worker_stats = StatsCollector()
+    session = Session(pool_size, timeout, retry, limiter)
+    session.add_hook(_worker_stats)
+    # connections and registry handles inherited from the parent can't be
+    # shared with it
+    set_session(session)
+    set_token_cache(TokenCache())
+    set_registry(None)
+
+
+def _create_group(task):
+    """ Creates (and optionally connects) a group of users in a worker
+
+    :return: A ``(users, errors, stats)`` tuple, with the users as ``dict``
+             elements and the errors as ``(api_code, message)`` tuples, as
+             exceptions don't survive being sent back to the parent
+    """
+    client_id, client_secret, size, friends, kwargs, workers = task
+    users, errors = [], []
+    try:
+        token = app_token(client_id, client_secret)
+        for _, user, err in _imap(lambda _: create(client_id, token,
+            **kwargs), range(size), workers):
+            if err is None:
+                users.append(user)
+            else:
+                errors.append((getattr(err, 'api_code', None), str(err)))
+
+        if friends and len(users) > 1:
+            # the users are new, so there are no friendships to skip
+            for res in connect(*users, workers=workers,
+                skip_existing=False).values():
+                if res is not True:
+                    errors.append((getattr(res, 'api_code', None), str(res)))
+    except Exception as err: # pylint: disable=W0703
+        # whatever happens, the users created so far must be reported
+        errors.append((getattr(err, 'api_code', None), str(err)))
+
+    stats = _worker_stats.snapshot()
+    _worker_stats.reset()
+    return [dict(user) for user in users], errors, stats
+
+
+def create_parallel(client_id, client_secret, count, group_size=None,
+    processes=None, workers=DEFAULT_WORKERS, progress=None, **kwargs):
+    """ Creates a large number of users on a pool of worker processes
+
+    A single process is eventually limited by JSON decoding and TLS overhead
+    under the GIL. Here, users are created in groups, each group being a task
+    for a pool of processes. Tasks are handed out one at a time as workers
+    become free, so that slow groups don't hold up the rest. Each worker has
+    its own :class:`stepford.Session` and :class:`stepford.TokenCache`, and
+    creates the users of a group (and connects them) on ``workers`` threads.
+
+    Worker sessions use copies of the current session's timeout,
+    :class:`stepford.RetryPolicy` and :class:`stepford.RateLimiter`, which
+    must therefore be picklable. As a copy of a
+    :class:`stepford.TokenBucket` limits each worker separately, use
+    :class:`stepford.FileTokenBucket` to share a limit across workers.
+
+    .. code-block:: python
+
+        # create 20k users, making friends in groups of 10
+        report = stepford.create_parallel([client_id], [client_secret],
+            20000, group_size=10, processes=8)
+
+    :param client_id: Your app's client ID, as provided by Facebook
+    :param client_secret: Your app's client secret, as provided by Facebook
+    :param count: The number of users to create
+    :param group_size (optional): The number of users in each group of
+                                  friends. If not given, users aren't
+                                  connected and are created in groups of
+                                  ``workers * 4``.
+    :param processes (optional): The number of worker processes, defaults to
+                                 the number of CPUs
+    :param workers: The number of concurrent requests in each process
+    :param progress (optional): A callable invoked with ``(users, errors)``
+                                as each group completes
+    :param kwargs: Any of the optional arguments of :meth:`stepford.create`
+
+    :return: A ``dict`` with the ``groups`` of users created (as lists of
+             :class:`stepford.User` records), the number of users
+             ``created``, the ``(api_code, message)`` of the errors that were
+             ``failed``, the merged request ``stats`` (see
+             :meth:`stepford.StatsCollector.snapshot`), the ``elapsed`` time
+             in seconds and the ``rate`` of creations per second
+    """
+    size = group_size or workers * 4
+    tasks = [(client_id, client_secret, min(size, count - idx),
+        group_size is not None, kwargs, workers)
+        for idx in range(0, count, size)]
+
+    report = {'groups': [], 'created': 0, 'failed': []}
+    stats = StatsCollector()
+    start = time.time()
+    session = get_session()
+    pool = multiprocessing.Pool(processes, _init_worker,
+        (_URIROOT, max(DEFAULT_POOL_SIZE, workers), session.timeout,
+        session.retry, session.limiter))
+    try:
+        for users, errors, snapshot in pool.imap_unordered(_create_group,
+            tasks, chunksize=1):
+            users = [User(user) for user in users]
+            report['groups'].append(users)
+            report['created'] += len(users)
+            report['failed'].extend(errors)
+            stats.merge(snapshot)
+            if progress is not None:
+                progress(users, errors)
+    except BaseException:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+    report['stats'] = stats.snapshot()
+    report['elapsed'] = time.time() - start
+    report['rate'] = report['created'] / report['elapsed'] \
+        if report['elapsed'] else 0.0
+    return report
+
+
+class Registry(object):
+    """ A local index of test users, stored in SQLite
+
+    Looking a user up through the Graph API means listing all of an app's
+    test users. A :class:`stepford.Registry` keeps users' details locally,
+    keyed by ID. Once installed with :meth:`stepford.set_registry`, it is kept
+    up to date by :meth:`stepford.create`, :meth:`stepford.update`,
+    :meth:`stepford.delete`, :meth:`stepford.install` and
+    :meth:`stepford.uninstall`, and can be synchronized with Facebook using
+    :meth:`~stepford.Registry.refresh`.
+
+    Each user is stored as a ``dict`` with the details returned by
+    :meth:`stepford.create` along with the ``client_id`` of the app owning
+    them, their ``name``, ``locale`` and ``permissions`` (when known) and the
+    client IDs of the ``apps`` installed for them.
+
+    :param path: The database file, by default the registry is kept in memory
+    """
+    def __init__(self, path=':memory:'):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS users ('
+                'id TEXT PRIMARY KEY, client_id TEXT, name TEXT, data TEXT)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS users_name '
+                'ON users (name)')
+
+    def close(self):
+        """ Closes the database """
+        with self._lock:
+            self._db.close()
+
+    def _load(self, rows):
+        """ Builds users from database rows """
+        return [json.loads(data) for data, in rows]
+
+    def _store(self, user):
+        """ Inserts or replaces a user, the lock must be held """
+        self._db.execute('INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?)', (
+            user['id'], user.get('client_id'), user.get('name'),
+            json.dumps(user)))
+
+    def add(self, user, client_id=None, **attrs):
+        """ Adds a user, or merges details into an existing one
+
+        :param user: The user details, as returned by :meth:`stepford.create`
+        :param client_id (optional): The client ID of the app owning the user
+        :param attrs: Any other attributes to store
+        """
+        with self._lock:
+            with self._db:
+                stored = self._get(user['id']) or {'apps': []}
+                stored.update(user)
+                if client_id is not None:
+                    stored['client_id'] = client_id
+                stored.update((key, value) for key, value in attrs.items()
+                    if value is not None or key not in stored)
+                self._store(stored)
+
+    def update(self, userid, **attrs):
+        """ Updates a known user's attributes
+
+        :return: ``False`` if the user isn't known
+        """
+        with self._lock:
+            with self._db:
+                user = self._get(userid)
+                if user is None:
+                    return False
+                user.update(attrs)
+                self._store(user)
+                return True
+
+    def add_app(self, userid, client_id):
+        """ Records an app as installed for a user """
+        with self._lock:
+            with self._db:
+                user = self._get(userid)
+                if user is not None and client_id not in user['apps']:
+                    user['apps'].append(client_id)
+                    self._store(user)
+
+    def remove_app(self, userid, client_id):
+        """ Records an app as uninstalled for a user """
+        with self._lock:
+            with self._db:
+                user = self._get(userid)
+                if user is not None and client_id in user['apps']:
+                    user['apps'].remove(client_id)
+                    self._store(user)
+
+    def remove(self, userid):
+        """ Removes a user """
+        with self._lock:
+            with self._db:
+                self._db.execute('DELETE FROM users WHERE id = ?',
+                    (str(userid),))
+
+    def _get(self, userid):
+        """ Gets a user, the lock must be held """
+        users = self._load(self._db.execute(
+            'SELECT data FROM users WHERE id = ?', (str(userid),)))
+        return users[0] if users else None
+
+    def get(self, userid):
+        """ Gets a user by ID
+
+        :return: The user's details, or ``None`` if the user isn't known
+        """
+        with self._lock:
+            return self._get(userid)
+
+    def find(self, name=None, client_id=None, **attrs):
+        """ Finds users by name, owning app and/or any other attribute
+
+        :return: A list of matching users
+        """
+        query, params = 'SELECT data FROM users WHERE 1 = 1', []
+        if name is not None:
+            query += ' AND name = ?'
+            params.append(name)
+        if client_id is not None:
+            query += ' AND client_id = ?'
+            params.append(client_id)
+
+        with self._lock:
+            users = self._load(self._db.execute(query + ' ORDER BY id',
+                params))
+        return [user for user in users
+            if all(user.get(key) == value for key, value in attrs.items())]
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+
+    def refresh(self, client_id, access_token, limit=None):
+        """ Synchronizes the registry with an app's test user listing
+
+        Listed users are added (or have their tokens refreshed) and users of
+        the app that are no longer listed are removed.
+
+        :param client_id: Your app's client ID, as provided by Facebook
+        :param access_token: Your app's access_token
+        :param limit (optional): The number of users to fetch per page
+
+        :return: The number of users listed
+        """
+        seen = set()
+        for user in iter_users(client_id, access_token, limit):
+            seen.add(user['id'])
+            self.add(user, client_id, access_token=user.get('access_token'))
+
+        with self._lock:
+            with self._db:
+                stale = [userid for userid, in self._db.execute(
+                    'SELECT id FROM users WHERE client_id = ?', (client_id,))
+                    if userid not in seen]
+                self._db.executemany('DELETE FROM users WHERE id = ?',
+                    [(userid,) for userid in stale])
+        return len(seen)
+
+    def refresh_token(self, userid, client_id, access_token):
+        """ Refreshes a single user's access token from the app's listing
+
+        The listing is only paged through until the user is found.
+
+        :return: The user's details, or ``None`` if the user isn't listed
+        """
+        user = refresh_tokens(client_id, access_token, [userid]).get(
+            str(userid))
+        if user is None:
+            self.remove(userid)
+            return None
+        self.add(user, client_id, access_token=user.get('access_token'))
+        return self.get(userid)
+
+
+_registry = None # pylint: disable=C0103
+
+
+# the _register_* helpers are shared with stepford_aio
+def _register_users(users, client_id):
+    """ Records listed users """
+    if _registry is not None:
+        for user in users:
+            _registry.add(user, client_id)
+
+
+def _register_create(user, client_id, installed, name, locale, permissions):
+    """ Records a created user """
+    if _registry is not None:
+        _registry.add(user, client_id, name=name, locale=locale,
+            permissions=permissions, apps=[client_id] if installed else [])
+
+
+def _register_delete(userid):
+    """ Records the deletion of a user """
+    if _registry is not None:
+        _registry.remove(userid)
+
+
+def _register_update(userid, name, pwd):
+    """ Records an update of a user """
+    if _registry is not None:
+        attrs = {} if name is None else {'name': name}
+        if pwd is not None:
+            # changing the password invalidates the user's token
+            attrs['access_token'] = None
+        _registry.update(userid, **attrs)
+
+
+def _register_install(userid, install_to_token):
+    """ Records the installation of an app for a user """
+    if _registry is not None and '|' in install_to_token:
+        # app tokens are prefixed with the app's client ID
+        _registry.add_app(userid, install_to_token.split('|', 1)[0])
+
+
+def _register_uninstall(userid, client_id):
+    """ Records the removal of an app for a user """
+    if _registry is not None:
+        _registry.remove_app(userid, client_id)
+
+
+def set_registry(registry):
+    """ Sets the registry kept up to date by the module-level functions
+
+    :param registry: A :class:`stepford.Registry`, or ``None`` to stop
+                     recording users
+
+    :return: The previously active registry
+    """
+    global _registry # pylint: disable=W0603,C0103
+    previous, _registry = _registry, registry
+    return previous
+
+
+def _app(value):
+    """ Parses a ``client_id:client_secret`` command line argument """
+    client_id, sep, client_secret = value.partition(':')
+    if not sep:
+        raise argparse.ArgumentTypeError(
+            'expected client_id:client_secret, got {!r}'.format(value))
+    return client_id, client_secret
+
+
+class _Progress(object):
+    """ Reports the progress and throughput of a command on ``stream``
+
+    A status line is kept up to date while the stream is a terminal, and a
+    summary is written once the command completes. Instances can be passed as
+    the ``progress`` callback of :meth:`stepford.purge`.
+    """
+    def __init__(self, verb, noun, quiet=False, stream=None, interval=0.2):
+        self.verb = verb
+        self.noun = noun
+        self.quiet = quiet
+        self.stream = sys.stderr if stream is None else stream
+        self.interval = interval
+        self.done = 0
+        self.failed = 0
+        self.start = time.time()
+        self._live = not quiet and getattr(self.stream, 'isatty',
+            lambda: False)()
+        self._shown = 0
+        self._width = 0
+
+    def _rate(self):
+        """ Gets the number of successful operations per second """
+        elapsed = time.time() - self.start
+        return elapsed, self.done / elapsed if elapsed else 0.0
+
+    def _write(self, line):
+        """ Replaces the status line """
+        self.stream.write('\r{}\r{}'.format(' ' * self._width, line))
+        self._width = len(line)
+        self.stream.flush()
+
+    def __call__(self, item=None, err=None): # pylint: disable=W0613
+        if err is None:
+            self.done += 1
+        else:
+            self.failed += 1
+
+        now = time.time()
+        if self._live and now - self._shown >= self.interval:
+            self._shown = now
+            self._write('{} {} {}, {} failed ({:.1f} {}/s)'.format(self.verb,
+                self.done, self.noun, self.failed, self._rate()[1],
+                self.noun))
+
+    def fail(self, label, err):
+        """ Reports a failed operation """
+        self(err=err)
+        if self.quiet:
+            return
+        if self._live:
+            self._write('')
+        self.stream.write('{}: {} {}\n'.format(label,
+            getattr(err, 'api_code', None), getattr(err, 'msg', err)))
+
+    def close(self):
+        """ Writes the summary """
+        if self.quiet:
+            return
+        if self._live:
+            self._write('')
+        elapsed, rate = self._rate()
+        self.stream.write('{} {} {} in {:.2f}s ({:.1f} {}/s), {} failed\n'.format(
+            self.verb, self.done, self.noun, elapsed, rate, self.noun,
+            self.failed))
+
+
+def _read_users(path):
+    """ Reads users from a file (or ``-`` for stdin) of JSON lines
+
+    Lines that aren't JSON objects are taken to be user IDs.
+    """
+    lines = sys.stdin if path == '-' else open(path)
+    try:
+        for line in lines:
+            line = line.strip()
+            if line.startswith('{'):
+                yield User(json.loads(line))
+            elif line:
+                yield User(id=line)
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+
+
+def _write_user(user):
+    """ Writes a user to stdout as a line of JSON """
+    sys.stdout.write(json.dumps(dict(user), sort_keys=True) + '\n')
+
+
+def _cmd_token(args):
+    """ Handles ``stepford token`` """
+    sys.stdout.write(app_token(args.client_id, args.client_secret) + '\n')
+    return 0
+
+
+def _cmd_list(args):
+    """ Handles ``stepford list`` """
+    progress = _Progress('listed', 'users', args.quiet)
+    for user in iter_users(args.client_id, app_token(args.client_id,
+        args.client_secret), args.limit):
+        _write_user(user)
+        progress(user)
+    progress.close()
+    return 0
+
+
+def _cmd_create(args):
+    """ Handles ``stepford create`` """
+    token = app_token(args.client_id, args.client_secret)
+
+    def _create(idx): # pylint: disable=C0111
+        return create(args.client_id, token, not args.no_install,
+            None if args.name is None else args.name.format(idx),
+            args.locale, args.permissions)
+
+    progress = _Progress('created', 'users', args.quiet)
+    for idx, user, err in _imap(_create, range(args.count), args.concurrency):
+        if err is None:
+            _write_user(user)
+            progress(user)
+        else:
+            progress.fail('user {}'.format(idx), err)
+    progress.close()
+    return 1 if progress.failed else 0
+
+
+def _cmd_purge(args):
+    """ Handles ``stepford purge`` """
+    token = app_token(args.client_id, args.client_secret)
+    apps = [(app_id, app_token(app_id, secret))
+        for app_id, secret in args.uninstall]
+
+    progress = _Progress('deleted', 'users', args.quiet)
+    report = purge(args.client_id, token, apps, args.concurrency, progress)
+    for userid, err in sorted(report['failed'].items()):
+        sys.stderr.write('{}: {} {}\n'.format(userid,
+            getattr(err, 'api_code', None), getattr(err, 'msg', err)))
+    progress.close()
+    return 1 if report['failed'] else 0
+
+
+def _cmd_connect(args):
+    """ Handles ``stepford connect`` """
+    users = list(_read_users(args.input))
+    size = args.group_size or len(users)
+    progress = _Progress('connected', 'edges', args.quiet)
+    for idx in range(0, len(users), size):
+        group = users[idx:idx + size]
+        if len(group) < 2:
+            continue
+        report = connect(*group, workers=args.concurrency)
+        for edge, res in sorted(report.items()):
+            if res is True:
+                progress(edge)
+            else:
+                progress.fail('{} {}'.format(*edge), res)
+
+    for user in users:
+        _write_user(user)
+    progress.close()
+    return 1 if progress.failed else 0
+
+
+def _cmd_install(args):
+    """ Handles ``stepford install`` """
+    token = app_token(args.client_id, args.client_secret)
+    app_id, app_secret = args.app
+    install_token = app_token(app_id, app_secret)
+    return _apply(args, 'installed', lambda user: install(user['id'],
+        install_token, args.client_id, token, args.scope))
+
+
+def _cmd_uninstall(args):
+    """ Handles ``stepford uninstall`` """
+    token = app_token(args.client_id, args.client_secret)
+    return _apply(args, 'uninstalled', lambda user: uninstall(user['id'],
+        args.client_id, token))
+
+
+def _apply(args, verb, func):
+    """ Applies ``func`` to the users read from ``args.input`` concurrently,
+    writing the users it succeeded for to stdout
+    """
+    progress = _Progress(verb, 'users', args.quiet)
+    for user, _, err in _imap(func, _read_users(args.input), args.concurrency):
+        if err is None:
+            _write_user(user)
+            progress(user)
+        else:
+            progress.fail(user['id'], err)
+    progress.close()
+    return 1 if progress.failed else 0
+
+
+def _input_argument(parser):
+    """ Adds the ``--input`` option of commands reading users """
+    parser.add_argument('--input', metavar='PATH', default='-',
+        help='read users as JSON lines from PATH rather than stdin')
+
+
+def main(argv=None):
+    """ The ``stepford`` console entry point
+
+    Commands reading users take JSON lines (i.e. the output of ``stepford
+    create`` or ``stepford list``) from a file or stdin, and write the users
+    they succeeded for to stdout in the same format so that commands can be
+    piped into one another. Progress and errors are reported on stderr.
+
+    :param argv (optional): The command line arguments, defaults to
+                            ``sys.argv[1:]``
+
+    :return: The process exit status
+    """
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--concurrency', type=int, default=DEFAULT_WORKERS,
+        help='the number of concurrent requests')
+    common.add_argument('--rate', type=float,
+        help='the maximum number of requests per second')
+    common.add_argument('--quiet', '-q', action='store_true',
+        help='do not report progress')
+
+    app = argparse.ArgumentParser(add_help=False, parents=[common])
+    app.add_argument('client_id')
+    app.add_argument('client_secret')
+
+    parser = argparse.ArgumentParser(prog='stepford',
+        description='Manage Facebook test users')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    cmd = commands.add_parser('token', parents=[app],
+        help="print an app's access token")
+    cmd.set_defaults(func=_cmd_token)
+
+    cmd = commands.add_parser('list', parents=[app],
+        help='list all test users of an app as JSON lines')
+    cmd.add_argument('--limit', type=int,
+        help='the number of users to fetch per page')
+    cmd.set_defaults(func=_cmd_list)
+
+    cmd = commands.add_parser('create', parents=[app],
+        help='create test users, writing them as JSON lines')
+    cmd.add_argument('count', type=int, help='the number of users to create')
+    cmd.add_argument('--name',
+        help='the users\' name, "{}" is replaced with a sequence number')
+    cmd.add_argument('--locale', default='en_US')
+    cmd.add_argument('--permissions', default='read_stream')
+    cmd.add_argument('--no-install', action='store_true',
+        help='do not install the app for the users')
+    cmd.set_defaults(func=_cmd_create)
+
+    cmd = commands.add_parser('purge', parents=[app],
+        help='delete all test users of an app')
+    cmd.add_argument('--uninstall', metavar='CLIENT_ID:CLIENT_SECRET',
+        type=_app, action='append', default=[],
+        help='another app to uninstall from users that cannot be deleted '
+            'while it is installed (may be repeated)')
+    cmd.add_argument('--workers', dest='concurrency', type=int,
+        default=DEFAULT_WORKERS, help=argparse.SUPPRESS)
+    cmd.set_defaults(func=_cmd_purge)
+
+    cmd = commands.add_parser('connect', parents=[common],
+        help='make friends of users')
+    _input_argument(cmd)
+    cmd.add_argument('--group-size', type=int,
+        help='connect consecutive groups of this many users rather than all')
+    cmd.set_defaults(func=_cmd_connect)
+
+    cmd = commands.add_parser('install', parents=[app],
+        help='install another app for test users of an app')
+    _input_argument(cmd)
+    cmd.add_argument('app', metavar='CLIENT_ID:CLIENT_SECRET', type=_app,
+        help='the app to install')
+    cmd.add_argument('--scope', help='the permissions to grant the app')
+    cmd.set_defaults(func=_cmd_install)
+
+    cmd = commands.add_parser('uninstall', parents=[app],
+        help='uninstall an app for its test users')
+    _input_argument(cmd)
+    cmd.set_defaults(func=_cmd_uninstall)
+
+    args = parser.parse_args(argv)
+    limiter = None if args.rate is None else RateLimiter(TokenBucket(
+        args.rate))
+    previous = set_session(Session(max(DEFAULT_POOL_SIZE, args.concurrency),
+        limiter=limiter))
+    try:
+        return args.func(args)
+    except FacebookError as err:
+        sys.stderr.write('error: {} {}\n'.format(err.api_code, err.msg))
+        return 1
+    finally:
+        set_session(previous).close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,464 @@
+""" Asyncio implementation of the Facebook test user API
+
+Mirrors the module-level functions of :mod:`stepford` as coroutines, using a
+non-blocking HTTP client so that calls don't block the event loop.
+"""
+
+import asyncio
+import time
+from functools import wraps
+from io import BytesIO
+from http.client import HTTPMessage
+from urllib.error import HTTPError
+from urllib.parse import urlencode, parse_qsl, urlsplit, urlunsplit
+
+import stepford
+from stepford import FacebookError
+
+# the private operation builders are shared with the stepford module
+# pylint: disable=W0212
+
+
+class AsyncSession(object):
+    """ A pool of keep-alive HTTP(S) connections for use with asyncio
+
+    This is the asyncio counterpart of :class:`stepford.Session`. Connections
+    are bound to the event loop they were opened on, so a single session can
+    safely be used from several (consecutive) event loops.
+
+    :param pool_size: The maximum number of idle connections kept per host.
+    :param timeout: The timeout (in seconds) for a single request.
+    :param retry (optional): The :class:`stepford.RetryPolicy` applied to
+                             failed requests. A default policy is used if not
+                             specified.
+    :param limiter (optional): A :class:`stepford.RateLimiter` consulted
+                               before every request (including retries)
+    """
+    # pylint: disable=R0913
+    def __init__(self, pool_size=stepford.DEFAULT_POOL_SIZE, timeout=None,
+        retry=None, limiter=None):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retry = stepford.RetryPolicy() if retry is None else retry
+        self.limiter = limiter
+        self.hooks = []
+        self._pools = {}
+
+    def add_hook(self, hook):
+        """ Registers a callable invoked with an event for every request,
+        see :meth:`stepford.Session.add_hook`
+        """
+        self.hooks = self.hooks + [hook]
+
+    def remove_hook(self, hook):
+        """ Unregisters a hook """
+        self.hooks = [other for other in self.hooks if other is not hook]
+
+    async def _acquire(self, key):
+        """ Gets an idle connection for ``key`` or opens a new one
+
+        :return: A ``(reader, writer, reused)`` tuple
+        """
+        idle = self._pools.get(key)
+        while idle:
+            reader, writer = idle.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer, True
+            writer.close()
+
+        _, scheme, netloc = key
+        host, _, port = netloc.rpartition(':')
+        if not host or not port.isdigit():
+            host, port = netloc, 443 if scheme == 'https' else 80
+
+        reader, writer = await asyncio.open_connection(host, int(port),
+            ssl=True if scheme == 'https' else None)
+        return reader, writer, False
+
+    def _release(self, key, reader, writer):
+        """ Returns a connection to the pool, closing it if the pool is full
+        """
+        idle = self._pools.setdefault(key, [])
+        if len(idle) < self.pool_size:
+            idle.append((reader, writer))
+        else:
+            writer.close()
+
+    async def urlopen(self, url, data=None):
+        """ Performs a request against ``url``
+
+        :param url: The absolute URL to request
+        :param data (optional): A form-encoded request body. If given, the
+                                request is sent as a ``POST`` rather than a
+                                ``GET``.
+
+        :raises: :py:class:`urllib.error.HTTPError` for responses with a
+                 status code >= 400
+        :return: A file-like response object exposing ``code`` and ``read``
+        """
+        hooks, attempt = self.hooks, 1
+        start = time.time() if hooks else None
+        while True:
+            try:
+                if self.timeout is None:
+                    resp = await self._urlopen(url, data)
+                else:
+                    resp = await asyncio.wait_for(self._urlopen(url, data),
+                        self.timeout)
+            except (HTTPError, OSError) as err:
+                delay = self.retry.delay(attempt, err)
+                if delay is None:
+                    if hooks:
+                        stepford._notify(hooks, url, data, start, attempt,
+                            err=err)
+                    raise
+            else:
+                if hooks:
+                    stepford._notify(hooks, url, data, start, attempt,
+                        resp=resp)
+                return resp
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def _urlopen(self, url, data):
+        """ Performs a request, without applying the session's timeout """
+        if self.limiter is not None:
+            await asyncio.sleep(self.limiter.reserve(url, data))
+
+        parts = urlsplit(url)
+        key = (asyncio.get_event_loop(), parts.scheme, parts.netloc)
+        path = urlunsplit(('', '', parts.path or '/', parts.query, ''))
+
+        head = ['{} {} HTTP/1.1'.format('GET' if data is None else 'POST',
+            path), 'Host: {}'.format(parts.netloc)]
+        if data is not None:
+            head.extend([
+                'Content-Type: application/x-www-form-urlencoded',
+                'Content-Length: {}'.format(len(data)),
+            ])
+        request = '\r\n'.join(head + ['', '']).encode() + (data or b'')
+
+        reader, writer, reused = await self._acquire(key)
+        while True:
+            try:
+                writer.write(request)
+                await writer.drain()
+                status, reason, headers, body, will_close = \
+                    await _read_response(reader)
+                break
+            except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+                writer.close()
+                if not reused:
+                    raise
+                # the server dropped an idle connection, try a fresh one
+                reader, writer, reused = await self._acquire(key)
+
+        if will_close:
+            writer.close()
+        else:
+            self._release(key, reader, writer)
+
+        if status >= 400:
+            raise HTTPError(url, status, reason, headers, BytesIO(body))
+        return stepford._Response(url, status, headers, body)
+
+    def close(self):
+        """ Closes all idle connections """
+        pools, self._pools = self._pools, {}
+        for idle in pools.values():
+            for _, writer in idle:
+                writer.close()
+
+
+async def _read_response(reader):
+    """ Reads a single HTTP/1.1 response off of ``reader``
+
+    :return: A ``(status, reason, headers, body, will_close)`` tuple
+    """
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError('connection closed by server')
+
+    version, status, reason = (line.decode('latin-1').rstrip('\r\n').split(
+        ' ', 2) + [''])[:3]
+    headers = HTTPMessage()
+    while True:
+        line = (await reader.readline()).decode('latin-1').rstrip('\r\n')
+        if not line:
+            break
+        name, _, value = line.partition(':')
+        headers[name.strip()] = value.strip()
+
+    will_close = (version == 'HTTP/1.0' or
+        headers.get('Connection', '').lower() == 'close')
+
+    if 'chunked' in headers.get('Transfer-Encoding', '').lower():
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if not size:
+                # skip over any trailers
+                while (await reader.readline()).strip():
+                    pass
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+        body = b''.join(chunks)
+    elif headers.get('Content-Length') is not None:
+        body = await reader.readexactly(int(headers['Content-Length']))
+    else:
+        body = await reader.read()
+        will_close = True
+
+    return int(status), reason, headers, body, will_close
+
+
+_session = AsyncSession() # pylint: disable=C0103
+
+
+def get_session():
+    """ Gets the session shared by all module-level coroutines """
+    return _session
+
+
+def set_session(session):
+    """ Replaces the session shared by all module-level coroutines
+
+    :param session: A :class:`stepford_aio.AsyncSession`, or any object
+                    providing a compatible ``urlopen`` coroutine (i.e. a fake
+                    transport for testing)
+
+    :return: The previously active session
+    """
+    global _session # pylint: disable=W0603,C0103
+    previous, _session = _session, session
+    return previous
+
+
+async def urlopen(url, data=None):
+    """ Opens ``url`` using the shared session
+
+    :param url: The absolute URL to request
+    :param data (optional): A form-encoded ``POST`` body
+    """
+    return await _session.urlopen(url, data)
+
+
+def translate_http_error(func):
+    """ HTTPError to FacebookError translation decorator for coroutines
+
+    Behaves the same as :meth:`stepford.translate_http_error`.
+
+    :param func: The coroutine function to decorate with translation handling
+    """
+    @wraps(func)
+    async def inner(*args, **kwargs): # pylint: disable=C0111
+        try:
+            return await func(*args, **kwargs)
+        except FacebookError:
+            raise
+        except HTTPError as err:
+            raise stepford._translate(err, args, kwargs)
+    return inner
+
+
+async def _call(method, path, query, parse):
+    """ Performs a single Graph API operation, see :meth:`stepford._call` """
+    if method != 'GET':
+        query = dict(query, method=method.lower())
+    resp = await urlopen('{}/{}'.format(stepford._URIROOT,
+        stepford._relative_url(path, query)))
+    return parse(resp.code, resp.read())
+
+
+@translate_http_error
+async def app_token(client_id, client_secret):
+    """ Gets the app token, see :meth:`stepford.app_token`
+
+    Tokens are shared with the synchronous API's token cache.
+    """
+    cache = stepford._token_cache
+    if cache is not None:
+        token = cache.get(client_id, client_secret)
+        if token is not None:
+            return token
+
+    resp = await urlopen('{}/oauth/access_token?{}'.format(stepford._URIROOT,
+        urlencode({
+            'client_id': client_id,
+            'client_secret': client_secret,
+            'grant_type': 'client_credentials',
+        })))
+
+    token = dict(parse_qsl(resp.read().decode()))['access_token']
+    if cache is not None:
+        cache.set(client_id, client_secret, token)
+    return token
+
+
+@translate_http_error
+async def get(client_id, access_token):
+    """ Gets a list of available test users, see :meth:`stepford.get` """
+    _, path, query, _ = stepford._get_op(client_id, access_token)
+    users = [user async for user in _iter_pages(path, query, None,
+        (client_id, access_token))]
+    stepford._register_users(users, client_id)
+    return users
+
+
+def iter_users(client_id, access_token, limit=None):
+    """ Lazily iterates over all test users, see :meth:`stepford.iter_users`
+    """
+    _, path, query, _ = stepford._get_op(client_id, access_token)
+    return _iter_pages(path, query, limit, (client_id, access_token),
+        stepford.User)
+
+
+def iter_friends(userid, access_token, limit=None):
+    """ Lazily iterates over a test user's friends, see
+    :meth:`stepford.iter_friends`
+    """
+    return _iter_pages('{}/friends'.format(userid),
+        {'access_token': access_token}, limit, (userid, access_token))
+
+
+async def _iter_pages(path, query, limit, args, wrap=None):
+    """ Iterates over the ``data`` of a paged listing, see
+    :meth:`stepford._iter_pages`
+    """
+    if limit is not None:
+        query = dict(query, limit=limit)
+
+    url = '{}/{}'.format(stepford._URIROOT, stepford._relative_url(path,
+        query))
+    while url:
+        try:
+            resp = await urlopen(url)
+        except HTTPError as err:
+            raise stepford._translate(err, args, {})
+
+        page = stepford._PageDecoder(resp, wrap)
+        for item in page:
+            yield item
+
+        url = page.count and page.extra.get('paging', {}).get('next')
+
+
+# pylint: disable=R0913
+@translate_http_error
+async def create(client_id, access_token, installed=True, name=None,
+    locale='en_US', permissions='read_stream'):
+    """ Creates a test user, see :meth:`stepford.create` """
+    user = await _call(*stepford._create_op(client_id, access_token,
+        installed, name, locale, permissions))
+    stepford._register_create(user, client_id, installed, name, locale,
+        permissions)
+    return user
+
+
+@translate_http_error
+async def delete(userid, access_token):
+    """ Deletes a test user, see :meth:`stepford.delete` """
+    deleted = await _call(*stepford._delete_op(userid, access_token))
+    if deleted:
+        stepford._register_delete(userid)
+    return deleted
+
+
+async def _friend_state(users, workers):
+    """ Fetches the friends and incoming friend requests of ``users``, see
+    :meth:`stepford._friend_state`
+    """
+    by_id = dict((user['id'], user) for user in users)
+    semaphore = asyncio.Semaphore(workers)
+
+    async def _state(user): # pylint: disable=C0111
+        async with semaphore:
+            friends = set([friend['id'] async for friend in iter_friends(
+                user['id'], user['access_token'])])
+            requests = set([request['from']['id'] async for request in
+                _iter_pages('{}/friendrequests'.format(user['id']),
+                    {'access_token': user['access_token']}, None,
+                    (user['id'], user['access_token']))])
+            return friends, requests
+
+    states = await asyncio.gather(*[_state(user) for user in by_id.values()])
+    return dict(zip(by_id, states))
+
+
+@translate_http_error
+async def connect(*users, workers=None, skip_existing=True):
+    """ Creates friendships between test user accounts
+
+    See :meth:`stepford.connect`. When ``workers`` is given, at most that many
+    friendships are created concurrently and a per-edge report is returned.
+    Unless ``skip_existing`` is ``False``, existing friendships and requests
+    are skipped.
+    """
+    if len(users) <= 1:
+        raise ValueError('len(users) must be > 1')
+
+    state = await _friend_state(users, workers or 1) if skip_existing else {}
+
+    async def _connect(halves): # pylint: disable=C0111
+        # the two halves of an edge must be sent in order
+        for sender, recipient in halves:
+            await _call(*stepford._friend_op(sender, recipient))
+        return True
+
+    pairs = [(user_a, user_b) for idx, user_a in enumerate(users[:-1])
+        for user_b in users[idx + 1:]]
+
+    if workers is None:
+        for user_a, user_b in pairs:
+            await _connect(stepford._missing_halves(user_a, user_b, state))
+        return None
+
+    semaphore = asyncio.Semaphore(workers)
+
+    async def _edge(user_a, user_b): # pylint: disable=C0111
+        async with semaphore:
+            try:
+                return await _connect(stepford._missing_halves(user_a,
+                    user_b, state))
+            except HTTPError as err:
+                return stepford._translate(err, (user_a.get('access_token'),
+                    user_b.get('access_token')), {})
+            except Exception as err: # pylint: disable=W0703
+                return err
+
+    results = await asyncio.gather(*[_edge(*pair) for pair in pairs])
+    return dict(((user_a['id'], user_b['id']), res)
+        for (user_a, user_b), res in zip(pairs, results))
+
+
+@translate_http_error
+async def update(userid, access_token, name=None, pwd=None):
+    """ Updates the given user, see :meth:`stepford.update` """
+    updated = await _call(*stepford._update_op(userid, access_token, name,
+        pwd))
+    if updated:
+        stepford._register_update(userid, name, pwd)
+    return updated
+
+
+@translate_http_error
+async def install(userid, install_to_token, clientid, access_token,
+    scope=None):
+    """ Installs an app for the given user, see :meth:`stepford.install` """
+    installed = await _call(*stepford._install_op(userid, install_to_token,
+        clientid, access_token, scope))
+    if installed:
+        stepford._register_install(userid, install_to_token)
+    return installed
+
+
+@translate_http_error
+async def uninstall(userid, clientid, access_token):
+    """ Uninstalls an app for the given user, see :meth:`stepford.uninstall`
+    """
+    uninstalled = await _call(*stepford._uninstall_op(userid, clientid,
+        access_token))
+    if uninstalled:
+        stepford._register_uninstall(userid, clientid)
+    return uninstalled
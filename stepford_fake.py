@@ -0,0 +1,585 @@
+""" A fake implementation of the Facebook test user API
+
+Runs a local HTTP server implementing the Graph API endpoints used by
+``stepford``, so that it can be exercised quickly, offline and at volume:
+
+.. code-block:: python
+
+    import stepford
+    from stepford_fake import FakeGraphAPI
+
+    with FakeGraphAPI(latency=0.05, failure_rate=0.01) as fake:
+        fake.add_app('1234', 'secret', name='my_app')
+        token = stepford.app_token('1234', 'secret')
+        [...]
+
+While the context manager is active, ``stepford._URIROOT`` points at the
+fake server.
+"""
+
+import itertools
+import random
+import threading
+import time
+import uuid
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urllib import urlencode
+    from urlparse import parse_qsl, urlsplit
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlencode, parse_qsl, urlsplit
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+import stepford
+
+# the number of users returned per page by default
+DEFAULT_PAGE_SIZE = 25
+
+# the (arbitrary) number of test users an app may have
+DEFAULT_MAX_USERS = 2000
+
+
+class GraphError(Exception):
+    """ An error response, as sent by the Graph API
+
+    :param code: The Facebook error code
+    :param message: The error message
+    :param status: The HTTP status code
+    :param type: The error category
+    """
+    # pylint: disable=W0622
+    def __init__(self, code, message, status=400, type='OAuthException'):
+        Exception.__init__(self, message)
+        self.code = code
+        self.message = message
+        self.status = status
+        self.type = type
+
+    def payload(self):
+        """ Gets the JSON error payload """
+        return {'error': {
+            'message': self.message,
+            'type': self.type,
+            'code': self.code,
+        }}
+
+
+def _unable_to_access():
+    """ The error Facebook sends for most things it doesn't want you doing """
+    return GraphError(stepford.API_EC_UNABLE_TO_ACCESS_APPLICATION,
+        '(#200) You do not have sufficient permissions to perform this action')
+
+
+def _invalid_token():
+    """ The error Facebook sends for bad access tokens """
+    return GraphError(stepford.API_EC_INVALID_OAUTH_TOKEN,
+        'Invalid OAuth access token.')
+
+
+def _flag(value):
+    """ Parses a boolean query parameter """
+    return str(value).lower() in ('true', '1')
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    """ A threaded HTTP server """
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """ Hands requests over to the :class:`FakeGraphAPI` serving them """
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, avoid delayed ACK stalls
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args): # pylint: disable=W0221
+        pass
+
+    def _handle(self, method):
+        """ Handles any request """
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode() if length else ''
+        status, content_type, payload = self.server.api.handle(method,
+            self.path, body)
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self): # pylint: disable=C0103,C0111
+        self._handle('GET')
+
+    def do_POST(self): # pylint: disable=C0103,C0111
+        self._handle('POST')
+
+    def do_DELETE(self): # pylint: disable=C0103,C0111
+        self._handle('DELETE')
+
+
+class FakeGraphAPI(object):
+    """ An in-process fake of the Facebook test user API
+
+    Implements app tokens, listing, creating and deleting test users,
+    installing and uninstalling apps, friend requests and listings, user
+    updates and batch requests, along with Facebook's error payloads for the
+    common failure cases (:data:`stepford.API_EC_TEST_ACCOUNTS_TOO_MANY`
+    through :data:`stepford.API_EC_TEST_ACCOUNTS_CANT_DELETE` and
+    :data:`stepford.API_EC_UNABLE_TO_ACCESS_APPLICATION`).
+
+    :param latency: Seconds of latency added to every request
+    :param failure_rate: The probability of any given request failing with a
+                         transient error
+    :param failure_status: The HTTP status of injected failures
+    :param failure_code: The Facebook error code of injected failures
+    :param max_users: The number of test users each app is allowed
+    :param page_size: The default number of users per listing page
+    :param seed (optional): Seeds the random failure injection
+    """
+    # pylint: disable=R0902,R0913
+    def __init__(self, latency=0, failure_rate=0, failure_status=500,
+        failure_code=stepford.API_EC_SERVICE, max_users=DEFAULT_MAX_USERS,
+        page_size=DEFAULT_PAGE_SIZE, seed=None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+        self.failure_code = failure_code
+        self.max_users = max_users
+        self.page_size = page_size
+        self.requests = 0
+        self.root = None
+        self._random = random.Random(seed)
+        self._ids = itertools.count(100000000000000)
+        self._lock = threading.RLock()
+        self._apps = {}
+        self._users = {}
+        self._tokens = {}
+        self._server = None
+        self._previous_root = None
+
+    def __enter__(self):
+        self.start()
+        self._previous_root = stepford._URIROOT # pylint: disable=W0212
+        stepford._URIROOT = self.root # pylint: disable=W0212
+        return self
+
+    def __exit__(self, *exc_info):
+        stepford._URIROOT = self._previous_root # pylint: disable=W0212
+        self.stop()
+
+    def start(self, host='127.0.0.1', port=0):
+        """ Starts serving in a background thread
+
+        :return: The root URL of the fake, for use as ``stepford._URIROOT``
+        """
+        self._server = _Server((host, port), _Handler)
+        self._server.api = self
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        self.root = 'http://{}:{}'.format(*self._server.server_address[:2])
+        return self.root
+
+    def stop(self):
+        """ Stops serving """
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def add_app(self, client_id, client_secret, name=None):
+        """ Registers an app
+
+        :param client_id: The app's client ID
+        :param client_secret: The app's client secret
+        :param name (optional): The app's name, defaults to the client ID
+
+        :return: The app's access token
+        """
+        client_id = str(client_id)
+        token = '{}|{}'.format(client_id, uuid.uuid4().hex)
+        with self._lock:
+            self._apps[client_id] = {
+                'id': client_id,
+                'secret': client_secret,
+                'name': name or client_id,
+                'token': token,
+            }
+        return token
+
+    def users(self, client_id=None):
+        """ Gets a snapshot of the fake's test users
+
+        :param client_id (optional): Only return users owned by this app
+        """
+        with self._lock:
+            return [dict(user, apps=dict(user['apps']),
+                friends=set(user['friends']), requests=set(user['requests']))
+                for user in self._users.values()
+                if client_id is None or user['owner'] == client_id]
+
+    def handle(self, method, path, body=''):
+        """ Handles a single request
+
+        :return: A ``(status, content_type, payload)`` tuple
+        """
+        with self._lock:
+            self.requests += 1
+            fail = self._random.random() < self.failure_rate
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        try:
+            if fail:
+                raise GraphError(self.failure_code,
+                    'An unexpected error has occurred. Please retry your '
+                    'request later.', status=self.failure_status,
+                    type='FacebookApiException')
+
+            parts = urlsplit(path)
+            params = dict(parse_qsl(parts.query))
+            params.update(parse_qsl(body))
+            method = params.pop('method', method).upper()
+            segments = [seg for seg in parts.path.split('/') if seg]
+
+            with self._lock:
+                result = self._dispatch(method, segments, params)
+        except GraphError as err:
+            return (err.status, 'application/json',
+                json.dumps(err.payload()).encode())
+
+        if isinstance(result, bytes):
+            return 200, 'text/plain', result
+        return 200, 'application/json', json.dumps(result).encode()
+
+    # pylint: disable=R0911,R0912
+    def _dispatch(self, method, segments, params):
+        """ Routes a request to its handler """
+        if not segments:
+            if method == 'POST' and 'batch' in params:
+                return self._batch(params)
+            if method == 'GET' and 'ids' in params:
+                return self._get_users(params)
+        elif segments == ['oauth', 'access_token']:
+            return self._app_token(params)
+        elif len(segments) == 3 and segments[1:] == ['accounts',
+            'test-users']:
+            if method == 'GET':
+                return self._list(segments[0], params)
+            if method == 'POST' and 'uid' in params:
+                return self._install(segments[0], params)
+            if method == 'POST':
+                return self._create(segments[0], params)
+            if method == 'DELETE':
+                return self._uninstall(segments[0], params)
+        elif len(segments) == 3 and segments[1] == 'friends':
+            if method == 'POST':
+                return self._befriend(segments[0], segments[2], params)
+            if method == 'DELETE':
+                return self._unfriend(segments[0], segments[2], params)
+        elif len(segments) == 2 and method == 'GET':
+            if segments[1] == 'friends':
+                return self._friends(segments[0], params)
+            if segments[1] == 'friendrequests':
+                return self._friend_requests(segments[0], params)
+            if segments[1] == 'ownerapps':
+                return self._owner_apps(segments[0], params)
+        elif len(segments) == 1:
+            if method == 'GET':
+                return self._get_user(segments[0], params)
+            if method == 'POST':
+                return self._update(segments[0], params)
+            if method == 'DELETE':
+                return self._delete(segments[0], params)
+
+        raise GraphError(2500, 'Unknown path components: /{}'.format(
+            '/'.join(segments)))
+
+    def _app(self, client_id, params):
+        """ Gets an app, checking that the request carries its token """
+        app = self._apps.get(client_id)
+        if app is None:
+            raise _unable_to_access()
+        if params.get('access_token') != app['token']:
+            raise _invalid_token()
+        return app
+
+    def _token_app(self, params):
+        """ Gets the app an app token belongs to """
+        for app in self._apps.values():
+            if app['token'] == params.get('access_token'):
+                return app
+        raise _invalid_token()
+
+    def _token_user(self, userid, params):
+        """ Gets a user, checking that the request carries their token """
+        user = self._users.get(self._tokens.get(params.get('access_token')))
+        if user is None:
+            raise _invalid_token()
+        if userid not in ('me', user['id']):
+            raise _unable_to_access()
+        return user
+
+    def _owned_user(self, userid, params):
+        """ Gets a user, checking that the request carries the owning app's
+        token
+        """
+        app = self._token_app(params)
+        user = self._users.get(userid)
+        if user is None or user['owner'] != app['id']:
+            raise _unable_to_access()
+        return user
+
+    def _new_token(self, user):
+        """ Issues a new access token for ``user`` """
+        self._tokens.pop(user.get('access_token'), None)
+        user['access_token'] = uuid.uuid4().hex
+        self._tokens[user['access_token']] = user['id']
+
+    @staticmethod
+    def _public(user):
+        """ The user details exposed by listings """
+        data = {
+            'id': user['id'],
+            'login_url': user['login_url'],
+        }
+        if user['owner'] in user['apps']:
+            data['access_token'] = user['access_token']
+        return data
+
+    def _app_token(self, params):
+        app = self._apps.get(params.get('client_id'))
+        if app is None or app['secret'] != params.get('client_secret'):
+            raise GraphError(101, 'Error validating application. Invalid '
+                'application ID or client secret.')
+        return urlencode({'access_token': app['token']}).encode()
+
+    def _page(self, items, params, path):
+        """ Pages through ``items`` using cursors """
+        limit = int(params.get('limit') or self.page_size)
+        offset = int(params.get('after') or 0)
+        page = {'data': items[offset:offset + limit]}
+        if offset + limit < len(items):
+            query = dict(params, after=offset + limit, limit=limit)
+            page['paging'] = {
+                'cursors': {'after': str(offset + limit)},
+                'next': '{}/{}?{}'.format(self.root, path, urlencode(query)),
+            }
+        return page
+
+    def _list(self, client_id, params):
+        app = self._app(client_id, params)
+        users = sorted((user for user in self._users.values()
+            if user['owner'] == app['id']), key=lambda user: int(user['id']))
+        return self._page([self._public(user) for user in users], params,
+            '{}/accounts/test-users'.format(client_id))
+
+    def _create(self, client_id, params):
+        app = self._app(client_id, params)
+        if len([user for user in self._users.values()
+            if user['owner'] == app['id']]) >= self.max_users:
+            raise GraphError(stepford.API_EC_TEST_ACCOUNTS_TOO_MANY,
+                '(#2900) Too many test accounts')
+
+        userid = str(next(self._ids))
+        name = params.get('name')
+        user = {
+            'id': userid,
+            'name': 'Test User {}'.format(userid) if name in (None, 'None')
+                else name,
+            'owner': app['id'],
+            'login_url': 'https://www.facebook.com/platform/test_account_'
+                'login.php?user_id={}'.format(userid),
+            'email': '{}@tfbnw.net'.format(userid),
+            'password': uuid.uuid4().hex[:12],
+            'locale': params.get('locale', 'en_US'),
+            'apps': {},
+            'friends': set(),
+            'requests': set(),
+        }
+        if _flag(params.get('installed', 'true')):
+            user['apps'][app['id']] = params.get('permissions', '')
+        self._new_token(user)
+        self._users[userid] = user
+
+        data = self._public(user)
+        data.update({
+            'access_token': user['access_token'],
+            'email': user['email'],
+            'password': user['password'],
+        })
+        return data
+
+    def _install(self, client_id, params):
+        # the path and owner token are those of the app owning the user, the
+        # access token that of the app being installed
+        owner = self._app(client_id, {
+            'access_token': params.get('owner_access_token')})
+        app = self._token_app(params)
+        user = self._users.get(params['uid'])
+        if user is None or user['owner'] != owner['id']:
+            raise GraphError(stepford.API_EC_TEST_ACCOUNTS_INVALID_ID,
+                '(#2901) Invalid test user id')
+        user['apps'][app['id']] = params.get('scope', '')
+        return b'true'
+
+    def _uninstall(self, client_id, params):
+        app = self._app(client_id, params)
+        user = self._users.get(params.get('uid'))
+        if user is None or app['id'] not in user['apps']:
+            raise GraphError(stepford.API_EC_TEST_ACCOUNTS_INVALID_ID,
+                '(#2901) Invalid test user id')
+        if user['owner'] == app['id']:
+            raise GraphError(stepford.API_EC_TEST_ACCOUNTS_CANT_REMOVE_APP,
+                '(#2902) Cannot remove the owner app from a test user')
+        del user['apps'][app['id']]
+        return b'true'
+
+    def _delete(self, userid, params):
+        user = self._owned_user(userid, params)
+        if set(user['apps']) - set([user['owner']]):
+            raise GraphError(stepford.API_EC_TEST_ACCOUNTS_CANT_DELETE,
+                '(#2903) Cannot delete this test account because it is '
+                'associated with other applications.')
+
+        for other in self._users.values():
+            other['friends'].discard(userid)
+            other['requests'].discard(userid)
+        self._tokens.pop(user['access_token'], None)
+        del self._users[userid]
+        return b'true'
+
+    def _update(self, userid, params):
+        user = self._owned_user(userid, params)
+        if 'name' in params:
+            user['name'] = params['name']
+        if 'password' in params:
+            user['password'] = params['password']
+            # as with Facebook, changing the password invalidates the token
+            self._new_token(user)
+        return b'true'
+
+    def _get_user(self, userid, params):
+        if self._tokens.get(params.get('access_token')) is not None:
+            user = self._token_user(userid, params)
+        else:
+            self._token_app(params)
+            user = self._users.get(userid)
+            if user is None:
+                raise _unable_to_access()
+        return {'id': user['id'], 'name': user['name'],
+            'locale': user['locale']}
+
+    def _get_users(self, params):
+        result = {}
+        for userid in params['ids'].split(','):
+            result[userid] = self._get_user(userid, params)
+        return result
+
+    def _befriend(self, userid, friendid, params):
+        user = self._token_user(userid, params)
+        friend = self._users.get(friendid)
+        if friend is None or friend['id'] == user['id']:
+            raise _unable_to_access()
+
+        if friend['id'] in user['requests']:
+            # confirming the other user's request
+            user['requests'].discard(friend['id'])
+            user['friends'].add(friend['id'])
+            friend['friends'].add(user['id'])
+        elif friend['id'] not in user['friends']:
+            friend['requests'].add(user['id'])
+        return b'true'
+
+    def _unfriend(self, userid, friendid, params):
+        user = self._token_user(userid, params)
+        friend = self._users.get(friendid)
+        if friend is None or friend['id'] not in user['friends']:
+            raise _unable_to_access()
+        user['friends'].discard(friend['id'])
+        friend['friends'].discard(user['id'])
+        return b'true'
+
+    def _friends(self, userid, params):
+        user = self._token_user(userid, params)
+        friends = [{'id': friend, 'name': self._users[friend]['name']}
+            for friend in sorted(user['friends'], key=int)]
+        return self._page(friends, params, '{}/friends'.format(userid))
+
+    def _friend_requests(self, userid, params):
+        user = self._token_user(userid, params)
+        requests = [{'from': {'id': sender,
+            'name': self._users[sender]['name']}, 'to': {'id': user['id']}}
+            for sender in sorted(user['requests'], key=int)]
+        return self._page(requests, params,
+            '{}/friendrequests'.format(userid))
+
+    def _owner_apps(self, userid, params):
+        self._token_app(params)
+        user = self._users.get(userid)
+        if user is None:
+            raise _unable_to_access()
+        apps = [{'id': app, 'name': self._apps[app]['name']}
+            for app in sorted(user['apps'])]
+        return {'data': apps}
+
+    def _batch(self, params):
+        try:
+            requests = json.loads(params['batch'])
+        except ValueError:
+            raise GraphError(100, '(#100) batch parameter must be a JSON '
+                'array')
+        if len(requests) > stepford.MAX_BATCH_SIZE:
+            raise GraphError(100, '(#100) Too many requests in batch '
+                'message. Maximum batch size is {}'.format(
+                stepford.MAX_BATCH_SIZE))
+
+        failed, responses = set(), []
+        for request in requests:
+            name = request.get('name')
+            if request.get('depends_on') is not None and \
+                request['depends_on'] in failed:
+                if name is not None:
+                    failed.add(name)
+                responses.append(None)
+                continue
+
+            parts = urlsplit(request['relative_url'])
+            query = dict(parse_qsl(parts.query))
+            query.setdefault('access_token', params.get('access_token'))
+            query.pop('method', None)
+
+            try:
+                result = self._dispatch(request.get('method', 'GET').upper(),
+                    [seg for seg in parts.path.split('/') if seg], query)
+            except GraphError as err:
+                if name is not None:
+                    failed.add(name)
+                responses.append({
+                    'code': err.status,
+                    'headers': [],
+                    'body': json.dumps(err.payload()),
+                })
+                continue
+
+            if name and request.get('omit_response_on_success', True):
+                responses.append(None)
+                continue
+
+            responses.append({
+                'code': 200,
+                'headers': [],
+                'body': result.decode() if isinstance(result, bytes)
+                    else json.dumps(result),
+            })
+        return responses
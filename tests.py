@@ -1,29 +1,63 @@
 import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
 from io import BytesIO
-from unittest import TestCase
+from unittest import SkipTest, TestCase
 
 try:
     from urllib2 import HTTPError, urlopen
     from urllib import urlencode
+    from StringIO import StringIO
 except ImportError:
+    from io import StringIO
     from urllib.request import urlopen
     from urllib.parse import urlencode, parse_qsl
     from urllib.error import HTTPError
 
 import stepford
+from stepford_fake import FakeGraphAPI
+if sys.version_info >= (3, 7):
+    from aiotests import AsyncioTests
+else:
+    class AsyncioTests(object):
+        """ The asyncio tests require Python 3.7 """
 
 
 NUM_TEST_USERS = 3
 
-CLIENT_ID = '290035784470436'
-CLIENT_SECRET = '96b81e5dec11ef0081a8b02fa1054b66'
-CLIENT_B_ID = '570048633057536'
-CLIENT_B_SECRET = '97699b4b2deb8959131c861dc653f81e'
+# TestStepford runs against the Graph API using two apps, given as
+# "client_id:client_secret,client_id:client_secret". Otherwise, only
+# TestStepfordFake runs, with made up apps.
+LIVE_APPS = os.environ.get('STEPFORD_TEST_APPS')
+if LIVE_APPS:
+    (CLIENT_ID, CLIENT_SECRET), (CLIENT_B_ID, CLIENT_B_SECRET) = [
+        app.split(':', 1) for app in LIVE_APPS.split(',')]
+else:
+    CLIENT_ID, CLIENT_SECRET = '290035784470436', 'secret_a'
+    CLIENT_B_ID, CLIENT_B_SECRET = '570048633057536', 'secret_b'
 
 
-class TestStepford(TestCase):
+def _main(argv, stdin=''):
+    """ Runs the command line interface, capturing its output """
+    streams = sys.stdin, sys.stdout, sys.stderr
+    sys.stdin, sys.stdout, sys.stderr = StringIO(stdin), StringIO(), StringIO()
+    try:
+        return stepford.main(argv), sys.stdout.getvalue(), sys.stderr.getvalue()
+    finally:
+        sys.stdin, sys.stdout, sys.stderr = streams
+
+
+class TestStepford(AsyncioTests, TestCase):
+    client_id = CLIENT_ID
+    live = True
+
     @classmethod
     def setUpClass(cls):
+        if cls.live and not LIVE_APPS:
+            raise SkipTest('STEPFORD_TEST_APPS is not set')
         cls.access_token = stepford.app_token(CLIENT_ID, CLIENT_SECRET)
         cls.users = []
         for _ in range(NUM_TEST_USERS):
@@ -43,8 +77,36 @@ class TestStepford(TestCase):
 
         self.assertEqual(len(user_ids - fetched_user_ids), 0)
 
+    def test_iter_users_paged(self):
+        user_ids = set(map(lambda u: u['id'], self.users))
+        fetched_user_ids = set(map(lambda u: u['id'], stepford.iter_users(
+            CLIENT_ID, self.access_token, limit=1)))
+
+        self.assertEqual(len(user_ids - fetched_user_ids), 0)
+
+    def test_iter_users_streamed(self):
+        chunk_size, stepford._CHUNK_SIZE = stepford._CHUNK_SIZE, 7
+        try:
+            users = list(stepford.iter_users(CLIENT_ID, self.access_token))
+            listed = stepford.get(CLIENT_ID, self.access_token)
+        finally:
+            stepford._CHUNK_SIZE = chunk_size
+
+        # get() and create() still return plain dicts
+        self.assertEqual(json.loads(json.dumps(listed)), listed)
+        self.assertEqual(sorted(user['id'] for user in listed),
+            sorted(user['id'] for user in users))
+
+        user = [u for u in users if u['id'] == self.users[0]['id']][0]
+        self.assertTrue(isinstance(user, stepford.User))
+        self.assertEqual(user.access_token, user['access_token'])
+        self.assertEqual(sorted(dict(user)), sorted(user.keys()))
+        self.assertTrue('login_url' in user)
+        self.assertEqual(user.get('missing'), None)
+
     def test_create_delete_success(self):
         user = stepford.create(CLIENT_ID, self.access_token)
+        self.assertTrue(isinstance(user, dict))
 
         self.assertTrue(user['id'] in map(lambda u: u['id'], stepford.get(
             CLIENT_ID, self.access_token)))
@@ -60,6 +122,93 @@ class TestStepford(TestCase):
             self.assertEqual(e.api_code, 
                 stepford.API_EC_UNABLE_TO_ACCESS_APPLICATION)
 
+    def test_batch_create_delete(self):
+        batch = stepford.Batch(self.access_token)
+        batch.create(CLIENT_ID, self.access_token)
+        batch.create(CLIENT_ID, self.access_token)
+        users = batch.execute()
+
+        self.assertEqual(len(batch), 0)
+        self.assertEqual(len(users), 2)
+
+        # a failed operation doesn't affect the ones that follow it
+        batch.delete('123', self.access_token)
+        for user in users:
+            batch.delete(user['id'], self.access_token)
+        results = batch.execute()
+
+        self.assertTrue(isinstance(results[0], stepford.FacebookError))
+        self.assertEqual(results[1:], [True, True])
+
+    def test_batch_partial_failure(self):
+        urlopen_, calls = stepford.urlopen, []
+        def _urlopen(url, data=None, **kwargs):
+            calls.append(url)
+            if len(calls) == 2:
+                raise HTTPError(url, 500, 'err..', {}, BytesIO(b''))
+            return urlopen_(url, data, **kwargs)
+
+        batch = stepford.Batch(self.access_token, size=2)
+        for _ in range(4):
+            batch.create(CLIENT_ID, self.access_token)
+        stepford.urlopen = _urlopen
+        try:
+            results = batch.execute()
+        finally:
+            stepford.urlopen = urlopen_
+
+        # the users created by the first batch request are still returned
+        for user in results[:2]:
+            self.assertTrue(stepford.delete(user['id'], self.access_token))
+        for err in results[2:]:
+            self.assertTrue(isinstance(err, stepford.FacebookError))
+            self.assertEqual(err.code, 500)
+
+    def test_purge(self):
+        b_token = stepford.app_token(CLIENT_B_ID, CLIENT_B_SECRET)
+        users = [stepford.create(CLIENT_B_ID, b_token) for _ in range(2)]
+        stepford.install(users[0]['id'], self.access_token, CLIENT_B_ID,
+            b_token)
+
+        report = stepford.purge(CLIENT_B_ID, b_token,
+            apps=[(CLIENT_ID, self.access_token)])
+
+        self.assertEqual(report['failed'], {})
+        self.assertTrue(report['deleted'] >= 2)
+        self.assertEqual(stepford.get(CLIENT_B_ID, b_token), [])
+
+    def test_cli_pipeline(self):
+        code, created, _ = _main(['create', CLIENT_ID, CLIENT_SECRET, '2',
+            '--concurrency', '2', '--rate', '100'])
+        users = [json.loads(line) for line in created.splitlines()]
+        self.assertEqual(code, 0)
+        self.assertEqual(len(users), 2)
+
+        try:
+            self.assertEqual(_main(['connect'], created)[:2], (0, created))
+            code, listed, _ = _main(['list', CLIENT_ID, CLIENT_SECRET])
+            self.assertEqual(code, 0)
+            for user in users:
+                self.assertTrue(user['id'] in listed)
+        finally:
+            for user in users:
+                stepford.delete(user['id'], self.access_token)
+
+        self.assertEqual(_main(['uninstall', CLIENT_ID, CLIENT_SECRET],
+            users[0]['id'])[0], 1)
+
+    def test_cli_purge_errors(self):
+        purge = stepford.purge
+        stepford.purge = lambda *args: {'deleted': 1,
+            'failed': {'123': socket.timeout('timed out')}}
+        try:
+            code, _, errors = _main(['purge', CLIENT_ID, CLIENT_SECRET, '-q'])
+        finally:
+            stepford.purge = purge
+
+        self.assertEqual(code, 1)
+        self.assertEqual(errors, '123: None timed out\n')
+
     def test_connect_success(self):
         stepford.connect(*self.users)
 
@@ -80,6 +229,12 @@ class TestStepford(TestCase):
         # TODO: reset connections if any other tests end up depending on clean
         # user state.
 
+    def test_connect_concurrent(self):
+        report = stepford.connect(*self.users, workers=4)
+
+        self.assertEqual(len(report), NUM_TEST_USERS * (NUM_TEST_USERS - 1) / 2)
+        self.assertTrue(all(res is True for res in report.values()))
+
     def test_connect_single_user_error(self):
         self.assertRaises(ValueError, stepford.connect, (self.users[0],))
 
@@ -101,6 +256,19 @@ class TestStepford(TestCase):
 
         self.assertEqual(_getname(user['access_token']), 'foo')
 
+    def test_update_many(self):
+        updates = dict((user['id'], {'name': 'many', 'pwd': 'flyingcircus'})
+            for user in self.users)
+        updates['123'] = {'name': 'WRONG'}
+
+        results = stepford.update_many(CLIENT_ID, self.access_token, updates)
+        self.assertTrue(isinstance(results.pop('123'), stepford.FacebookError))
+        for user in self.users:
+            user['access_token'] = results[user['id']]['access_token']
+            resp = urlopen('{}/me?{}'.format(stepford._URIROOT, urlencode({
+                'access_token': user['access_token']})))
+            self.assertEqual(json.loads(resp.read().decode())['name'], 'many')
+
     def test_update_error(self):
         try:
             stepford.update('123', self.access_token, name='WRONG')
@@ -132,18 +300,539 @@ class TestStepford(TestCase):
 
         self.assertTrue(stepford.uninstall(user['id'], CLIENT_B_ID, b_token))
 
+    def test_install_many(self):
+        apps = [(CLIENT_B_ID, CLIENT_B_SECRET)]
+        users = self.users[:2] + ['123']
+
+        grid = stepford.install_many(users, apps, CLIENT_ID,
+            self.access_token)
+        self.assertEqual(len(grid), 3)
+        for user in self.users[:2]:
+            self.assertTrue(grid[user['id'], CLIENT_B_ID] is True)
+        self.assertTrue(isinstance(grid['123', CLIENT_B_ID],
+            stepford.FacebookError))
+
+        grid = stepford.uninstall_many(self.users[:2], apps)
+        self.assertTrue(all(res is True for res in grid.values()))
+
+    def test_user_pool_lease_release(self):
+        with stepford.UserPool(CLIENT_ID, self.access_token, size=1,
+            adopt=False) as pool:
+            user = pool.lease(locale='fr_FR')
+            self.assertTrue('id' in user)
+
+            # released users have their name restored and token refreshed
+            name = stepford.names([user['id']], self.access_token)[user['id']]
+            stepford.update(user['id'], self.access_token, name='changed',
+                pwd='flyingcircus')
+            pool.release(user)
+            leased = pool.lease(locale='fr_FR')
+            self.assertEqual(leased['id'], user['id'])
+            self.assertEqual(stepford.names([user['id']], self.access_token),
+                {user['id']: name})
+            self.assertEqual(stepford.refresh_tokens(CLIENT_ID,
+                self.access_token, [user['id']])[user['id']]['access_token'],
+                leased['access_token'])
+            pool.release(leased)
+
+            pool.close(delete_users=True)
+            self.assertEqual(len(pool), 0)
+
+        # adoption stops at the size of the pool
+        with stepford.UserPool(CLIENT_ID, self.access_token, size=1,
+            adopt=True) as pool:
+            self.assertEqual(len(pool), 1)
+
+    def test_shared_user_pool(self):
+        tmp = tempfile.mkdtemp()
+        path = os.path.join(tmp, 'pool.json')
+        pools = [stepford.SharedUserPool(path, CLIENT_ID, self.access_token,
+            size=2, adopt=False) for _ in range(2)]
+        users = []
+        try:
+            users = [pool.lease() for pool in pools]
+            self.assertNotEqual(users[0]['id'], users[1]['id'])
+            self.assertEqual(len(pools[1]), 0)
+
+            pools[0].release(users[0])
+            self.assertEqual(pools[1].lease()['id'], users[0]['id'])
+        finally:
+            for user in users:
+                stepford.delete(user['id'], self.access_token)
+            shutil.rmtree(tmp)
+
+    def test_snapshot_restore(self):
+        b_token = stepford.app_token(CLIENT_B_ID, CLIENT_B_SECRET)
+        users = self.users[:2]
+        tmp = tempfile.mkdtemp()
+        path = os.path.join(tmp, 'snapshot.json')
+        try:
+            snap = stepford.snapshot(users, self.access_token, path)
+            friends = [users[0]['id'], users[1]['id']] in snap['edges']
+
+            stepford.update(users[0]['id'], self.access_token, name='dirty')
+            stepford.install(users[1]['id'], b_token, CLIENT_ID,
+                self.access_token)
+            if friends:
+                stepford._call(*stepford._unfriend_op(*users))
+            else:
+                stepford.connect(*users)
+
+            report = stepford.restore(path, CLIENT_ID, self.access_token,
+                {CLIENT_B_ID: b_token})
+            self.assertEqual(report['renamed'], [users[0]['id']])
+            self.assertEqual(report['uninstalled'],
+                [(users[1]['id'], CLIENT_B_ID)])
+            self.assertEqual(len(report['connected' if friends else
+                'disconnected']), 1)
+
+            self.assertEqual(stepford.snapshot(users, self.access_token),
+                snap)
+            report = stepford.restore(snap, CLIENT_ID, self.access_token)
+            self.assertFalse(any(report.values()))
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_restore_not_installed(self):
+        users = [stepford.create(CLIENT_ID, self.access_token,
+            installed=False) for _ in range(2)]
+        try:
+            snap = stepford.snapshot(users, self.access_token)
+            stepford.update(users[0]['id'], self.access_token, name='dirty')
+
+            # listed without a token, so their friendships are left alone
+            report = stepford.restore(snap, CLIENT_ID, self.access_token)
+            self.assertEqual(report['renamed'], [users[0]['id']])
+            self.assertEqual(report['connected'], [])
+        finally:
+            for user in users:
+                stepford.delete(user['id'], self.access_token)
+
+    def test_app_shards(self):
+        shards = stepford.AppShards([(CLIENT_ID, CLIENT_SECRET),
+            (CLIENT_B_ID, CLIENT_B_SECRET)])
+        # leave room for at least one more user on each app
+        shards.capacity = max(shards.counts().values()) + 1
+
+        users = []
+        try:
+            for _ in range(shards.capacity * 2):
+                users.append(shards.create())
+        except RuntimeError:
+            pass
+
+        try:
+            self.assertEqual(set(shards.owner(user)[0] for user in users),
+                set([CLIENT_ID, CLIENT_B_ID]))
+            self.assertEqual(shards.counts(), {
+                CLIENT_ID: shards.capacity,
+                CLIENT_B_ID: shards.capacity,
+            })
+        finally:
+            for user in users:
+                self.assertTrue(shards.delete(user))
+        self.assertEqual(len(shards.get()), len(shards))
+
+    def test_journal_resume(self):
+        tmp = tempfile.mkdtemp()
+        path = os.path.join(tmp, 'journal')
+        try:
+            with stepford.Journal(path) as journal:
+                users = [journal.create(CLIENT_ID, self.access_token)
+                    for _ in range(2)]
+                journal.connect(*users)
+
+                # crashed after sending the request
+                seq = journal._begin('create', [CLIENT_ID, self.access_token],
+                    {})
+                stepford.create(CLIENT_ID, self.access_token,
+                    name=journal.entries[seq]['kwargs']['name'])
+                # crashed before sending the request
+                journal._begin('create', [CLIENT_ID, self.access_token], {})
+
+            with stepford.Journal(path) as journal:
+                report = journal.resume()
+            self.assertEqual(report['skipped'], 4)
+            self.assertEqual(report['completed'], [5])
+            self.assertEqual(len(report['users']), 4)
+
+            with stepford.Journal(path) as journal:
+                self.assertEqual(journal.resume()['completed'], [])
+                report = journal.resume(rollback=True)
+            self.assertEqual(report['rolled_back'], [1, 2, 3, 4, 5])
+            self.assertEqual(report['failed'], {})
+        finally:
+            shutil.rmtree(tmp)
+
+        userids = set(user['id'] for user in stepford.get(CLIENT_ID,
+            self.access_token))
+        self.assertFalse(userids.intersection(user['id']
+            for user in users))
+
+    def test_journal_torn_tail(self):
+        tmp = tempfile.mkdtemp()
+        path = os.path.join(tmp, 'journal')
+        try:
+            with stepford.Journal(path) as journal:
+                users = [journal.create(CLIENT_ID, self.access_token)]
+            with open(path, 'a') as journal:
+                # crashed halfway through writing a record
+                journal.write('{"seq":2,"op":"cre')
+
+            with stepford.Journal(path) as journal:
+                users.append(journal.create(CLIENT_ID, self.access_token))
+            with stepford.Journal(path) as journal:
+                self.assertEqual(sorted(journal.entries), [1, 2])
+                report = journal.resume(rollback=True)
+            self.assertEqual(report['rolled_back'], [1, 2])
+        finally:
+            shutil.rmtree(tmp)
+
+        userids = set(user['id'] for user in stepford.get(CLIENT_ID,
+            self.access_token))
+        self.assertFalse(userids.intersection(user['id']
+            for user in users))
+
+    def test_create_parallel(self):
+        report = stepford.create_parallel(CLIENT_ID, CLIENT_SECRET, 4,
+            group_size=2, processes=2, workers=2)
+        try:
+            self.assertEqual(report['created'], 4)
+            self.assertEqual(report['failed'], [])
+            self.assertEqual(report['stats']['POST /{id}/accounts/test-users'][
+                'count'], 4)
+            for user_a, user_b in report['groups']:
+                self.assertEqual([friend['id'] for friend in
+                    stepford.iter_friends(user_a['id'],
+                    user_a['access_token'])], [user_b['id']])
+        finally:
+            for group in report['groups']:
+                for user in group:
+                    stepford.delete(user['id'], self.access_token)
+
+    def test_create_parallel_limiter(self):
+        tmp = tempfile.mkdtemp()
+        path = os.path.join(tmp, 'bucket')
+        session = stepford.set_session(stepford.Session(
+            retry=stepford.RetryPolicy(max_attempts=1),
+            limiter=stepford.RateLimiter(default=stepford.FileTokenBucket(
+            path, 1000))))
+        try:
+            report = stepford.create_parallel(CLIENT_ID, CLIENT_SECRET, 2,
+                processes=2, workers=1)
+            # only the workers made requests
+            with open(path) as state:
+                tokens, _ = json.load(state)
+        finally:
+            stepford.set_session(session)
+            shutil.rmtree(tmp)
+
+        for group in report['groups']:
+            for user in group:
+                stepford.delete(user['id'], self.access_token)
+        self.assertEqual(report['created'], 2)
+        self.assertTrue(tokens < 1000)
+
+    def test_create_group_errors(self):
+        def _connect(*users, **kwargs):
+            return {(users[0]['id'], users[1]['id']): socket.timeout(
+                'timed out')}
+        def _app_token(*args):
+            raise socket.timeout('timed out')
+
+        connect_, app_token_ = stepford.connect, stepford.app_token
+        stats, stepford._worker_stats = (stepford._worker_stats,
+            stepford.StatsCollector())
+        stepford.connect, users = _connect, []
+        try:
+            users, errors, _ = stepford._create_group((CLIENT_ID,
+                CLIENT_SECRET, 2, True, {}, 2))
+            stepford.app_token = _app_token
+            self.assertEqual(stepford._create_group((CLIENT_ID,
+                CLIENT_SECRET, 2, True, {}, 2))[:2],
+                ([], [(None, 'timed out')]))
+        finally:
+            stepford.connect, stepford.app_token = connect_, app_token_
+            stepford._worker_stats = stats
+            for user in users:
+                stepford.delete(user['id'], self.access_token)
+
+        self.assertEqual((len(users), errors), (2, [(None, 'timed out')]))
+
+    def test_session_keep_alive(self):
+        session = stepford.Session(pool_size=1)
+        previous = stepford.set_session(session)
+        try:
+            stepford.get(CLIENT_ID, self.access_token)
+            idle = list(session._pools.values())[0]
+            self.assertEqual(len(idle), 1)
+            conn = idle[0]
+
+            stepford.get(CLIENT_ID, self.access_token)
+            self.assertTrue(list(session._pools.values())[0][0] is conn)
+        finally:
+            stepford.set_session(previous)
+            session.close()
+
+    def test_app_token_cached(self):
+        urlopen_ = stepford.urlopen
+        cache = stepford.set_token_cache(stepford.TokenCache())
+        try:
+            token = stepford.app_token(CLIENT_ID, CLIENT_SECRET)
+
+            stepford.urlopen = None
+            self.assertEqual(stepford.app_token(CLIENT_ID, CLIENT_SECRET),
+                token)
+        finally:
+            stepford.urlopen = urlopen_
+            stepford.set_token_cache(cache)
+
+    def test_retry_transient_errors(self):
+        policy = stepford.RetryPolicy(backoff=0)
+        session = stepford.Session(retry=policy)
+        responses = [
+            HTTPError('url', 503, 'unavailable', {}, BytesIO(b'')),
+            HTTPError('url', 400, 'throttled', {}, BytesIO(json.dumps({
+                'error': {'code': stepford.API_EC_USER_TOO_MANY_CALLS,
+                    'message': 'throttled', 'type': 'OAuthException'},
+            }).encode())),
+            'ok',
+        ]
+
+        def _urlopen(url, data):
+            res = responses.pop(0)
+            if isinstance(res, Exception):
+                raise res
+            return res
+
+        session._urlopen = _urlopen
+        self.assertEqual(session.urlopen('url'), 'ok')
+        self.assertEqual(policy.retries, 2)
+
+        responses.extend([HTTPError('url', 404, 'not found', {},
+            BytesIO(b''))])
+        self.assertRaises(HTTPError, session.urlopen, 'url')
+        self.assertEqual(policy.retries, 2)
+
+    def test_rate_limiter(self):
+        limiter = stepford.RateLimiter()
+        limiter.set_limit(CLIENT_ID, stepford.TokenBucket(10, burst=1))
+
+        url = '{}/{}/accounts/test-users'.format(stepford._URIROOT, CLIENT_ID)
+        self.assertEqual(limiter.reserve(url), 0)
+        self.assertTrue(limiter.reserve(url) > 0)
+
+        # requests for other apps aren't limited
+        self.assertEqual(limiter.reserve('{}/123?access_token=123|abc'.format(
+            stepford._URIROOT)), 0)
+
+        # requests made with user tokens count towards the owning app's limit
+        url = '{}/{{}}/friends/456?access_token=abc'.format(stepford._URIROOT)
+        limiter.set_limit(CLIENT_B_ID, stepford.TokenBucket(10, burst=1))
+        limiter.set_owner(CLIENT_B_ID, '123')
+        self.assertEqual(limiter.reserve(url.format('123')), 0)
+        self.assertTrue(limiter.reserve(url.format('123')) > 0)
+
+        registry = stepford.Registry()
+        registry.add({'id': '789'}, CLIENT_ID)
+        previous = stepford.set_registry(registry)
+        try:
+            self.assertTrue(limiter.reserve(url.format('789')) > 0)
+            self.assertEqual(limiter.reserve(url.format('000')), 0)
+        finally:
+            stepford.set_registry(previous)
+            registry.close()
+
+    def test_request_hooks(self):
+        stats, events = stepford.StatsCollector(), []
+        session = stepford.Session()
+        session.add_hook(stats)
+        session.add_hook(events.append)
+        previous = stepford.set_session(session)
+        try:
+            stepford.get(CLIENT_ID, self.access_token)
+            self.assertRaises(stepford.FacebookError, stepford.delete, '123',
+                self.access_token)
+        finally:
+            stepford.set_session(previous)
+
+        snapshot = stats.snapshot()
+        self.assertEqual(snapshot['GET /{id}/accounts/test-users']['count'], 1)
+        self.assertEqual(snapshot['DELETE /{id}']['errors'], 1)
+        self.assertEqual(events[-1]['api_code'],
+            stepford.API_EC_UNABLE_TO_ACCESS_APPLICATION)
+        self.assertTrue(stats.percentile('DELETE /{id}', 50) > 0)
+
+        # HTTP error responses are reported once retries are exhausted
+        session = stepford.Session(retry=stepford.RetryPolicy(max_attempts=2,
+            backoff=0))
+        session.add_hook(events.append)
+        def _urlopen(url, data):
+            raise HTTPError(url, 503, 'unavailable', {}, BytesIO(b''))
+        session._urlopen = _urlopen
+        self.assertRaises(HTTPError, session.urlopen,
+            '{}/123'.format(stepford._URIROOT))
+        self.assertEqual((events[-1]['status'], events[-1]['retries']),
+            (503, 1))
+
+    def test_registry(self):
+        registry = stepford.Registry()
+        previous = stepford.set_registry(registry)
+        try:
+            user = stepford.create(CLIENT_ID, self.access_token, name='reg')
+            self.assertEqual(registry.get(user['id'])['access_token'],
+                user['access_token'])
+            self.assertEqual(registry.get(user['id'])['apps'], [CLIENT_ID])
+
+            stepford.update(user['id'], self.access_token, pwd='flyingcircus')
+            self.assertEqual(registry.get(user['id'])['access_token'], None)
+            self.assertEqual([other['id'] for other in registry.find(
+                name='reg', client_id=CLIENT_ID)], [user['id']])
+
+            refreshed = registry.refresh_token(user['id'], CLIENT_ID,
+                self.access_token)
+            self.assertTrue(refreshed['access_token'])
+
+            self.assertTrue(registry.refresh(CLIENT_ID, self.access_token) >=
+                NUM_TEST_USERS + 1)
+            self.assertTrue(registry.get(self.users[0]['id']))
+
+            stepford.delete(user['id'], self.access_token)
+            self.assertEqual(registry.get(user['id']), None)
+        finally:
+            stepford.set_registry(previous)
+            registry.close()
+
     def test_something_bad_happened(self):
         urlopen_ = stepford.urlopen
         def _raise(url, *args, **kwargs):
             raise HTTPError(url, 500, 'err..', {},
-                BytesIO('something bad happened'))
+                BytesIO(b'something bad happened'))
 
         stepford.urlopen = _raise
+        cache = stepford.set_token_cache(None)
         try:
             token = stepford.app_token(CLIENT_ID, CLIENT_SECRET)
         except stepford.FacebookError as e:
             stepford.urlopen = urlopen_
+            stepford.set_token_cache(cache)
 
             self.assertEqual(e.api_code, None)
             self.assertEqual(e.type, None)
             self.assertEqual(e.msg, 'Unhandled error')
+
+
+class TestStepfordFake(TestStepford):
+    """ Runs the test suite against a local fake of the Graph API """
+    live = False
+
+    @classmethod
+    def setUpClass(cls):
+        cls.fake = FakeGraphAPI()
+        cls.fake.__enter__()
+        cls.fake.add_app(CLIENT_ID, CLIENT_SECRET, name='stepford')
+        cls.fake.add_app(CLIENT_B_ID, CLIENT_B_SECRET, name='stepford_b')
+        cls.token_cache = stepford.set_token_cache(stepford.TokenCache())
+        super(TestStepfordFake, cls).setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super(TestStepfordFake, cls).tearDownClass()
+        stepford.set_token_cache(cls.token_cache)
+        cls.fake.__exit__(None, None, None)
+
+    def test_fake_too_many_users(self):
+        max_users = self.fake.max_users
+        self.fake.max_users = len(self.fake.users(CLIENT_ID))
+        try:
+            stepford.create(CLIENT_ID, self.access_token)
+        except stepford.FacebookError as e:
+            self.assertEqual(e.api_code,
+                stepford.API_EC_TEST_ACCOUNTS_TOO_MANY)
+        else:
+            self.fail('FacebookError not raised')
+        finally:
+            self.fake.max_users = max_users
+
+    def test_fake_purge_pages(self):
+        b_token = stepford.app_token(CLIENT_B_ID, CLIENT_B_SECRET)
+        page_size, self.fake.page_size = self.fake.page_size, 2
+        try:
+            for _ in range(7):
+                stepford.create(CLIENT_B_ID, b_token)
+            report = stepford.purge(CLIENT_B_ID, b_token, workers=2)
+        finally:
+            self.fake.page_size = page_size
+
+        self.assertEqual((report['deleted'], report['failed']), (7, {}))
+        self.assertEqual(self.fake.users(CLIENT_B_ID), [])
+
+    def test_fake_injected_failures(self):
+        policy = stepford.RetryPolicy(max_attempts=10, backoff=0)
+        previous = stepford.set_session(stepford.Session(retry=policy))
+        self.fake.failure_rate = 0.5
+        try:
+            for _ in range(10):
+                stepford.get(CLIENT_ID, self.access_token)
+        finally:
+            self.fake.failure_rate = 0
+            stepford.set_session(previous)
+
+        self.assertTrue(policy.retries > 0)
+
+    def test_fake_provision_incremental(self):
+        b_token = stepford.app_token(CLIENT_B_ID, CLIENT_B_SECRET)
+        spec = {
+            'users': {
+                'alice': {'locale': 'fr_FR', 'apps': [CLIENT_B_ID]},
+                'bob': {'name': 'Bob'},
+                'carol': {},
+            },
+            'edges': [['alice', 'bob'], ['bob', 'carol']],
+        }
+
+        result = stepford.provision(CLIENT_ID, self.access_token, spec,
+            apps={CLIENT_B_ID: b_token})
+        self.assertEqual(sorted(result['created']), ['alice', 'bob', 'carol'])
+        self.assertEqual(result['installs'], [('alice', CLIENT_B_ID)])
+        self.assertEqual(len(result['edges']), 2)
+
+        spec['edges'].append(['carol', 'alice'])
+        again = stepford.provision(CLIENT_ID, self.access_token, spec,
+            apps={CLIENT_B_ID: b_token})
+        self.assertEqual(again['created'], [])
+        self.assertEqual(again['installs'], [])
+        self.assertEqual(again['edges'], [('carol', 'alice')])
+        self.assertEqual(again['users']['bob']['id'],
+            result['users']['bob']['id'])
+
+        for label in ('alice', 'bob', 'carol'):
+            user = again['users'][label]
+            if label == 'alice':
+                stepford.uninstall(user['id'], CLIENT_B_ID, b_token)
+            stepford.delete(user['id'], self.access_token)
+
+    def test_fake_connect_skips_existing(self):
+        users = [stepford.create(CLIENT_ID, self.access_token)
+            for _ in range(4)]
+        stepford.connect(*users[:3])
+
+        # a pending request only needs confirming
+        stepford._call(*stepford._friend_op(users[3], users[0]))
+
+        requests = self.fake.requests
+        stepford.connect(*users)
+        # one friend and one request listing per user, the 3 missing edges
+        # and the confirmation of the pending request
+        self.assertEqual(self.fake.requests - requests, 2 * 4 + 2 * 2 + 1)
+
+        for user in self.fake.users(CLIENT_ID):
+            if user['id'] in [u['id'] for u in users]:
+                self.assertEqual(len(user['friends']), 3)
+
+        requests = self.fake.requests
+        stepford.connect(*users, workers=4)
+        self.assertEqual(self.fake.requests - requests, 2 * 4)
+
+        for user in users:
+            stepford.delete(user['id'], self.access_token)